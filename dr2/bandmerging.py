@@ -9,12 +9,21 @@ from __future__ import print_function, division
 import os
 import sys
 import numpy as np
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse import csgraph
+from astropy.io import fits
+from astropy.table import Table
 from astropy import log
 from multiprocessing import Pool
 import constants
 import util
+import stiltsworker
+import derivedcolumns
+from derivedcolumns import BANDS, NULL_VALUES
 from constants import IPHASQC
 import socket
+from collections import OrderedDict
 
 __author__ = 'Geert Barentsen'
 __copyright__ = 'Copyright, The Authors'
@@ -29,6 +38,14 @@ __credits__ = ['Geert Barentsen', 'Hywel Farnhill',
 # Where to write the output catalogues?
 MYDESTINATION = os.path.join(constants.DESTINATION, 'bandmerged')
 
+# How to band-merge? 'numpy' (in-process), 'tpipe' (in-process matching,
+# derived columns added by stilts) or 'stilts' (tmatchn).
+# Use `BandMerge.validate` on real fields before switching away from stilts.
+BANDMERGER = 'stilts'
+# We filter out sources detected at <0.5sigma
+# (i.e. magnitude error < -2.5*log(1+3) = 1.19)
+MAX_APERMAG2ERR = 1.19
+
 
 ###########
 # CLASSES
@@ -59,6 +76,78 @@ class BandMerge():
                             'detected',
                             '{}_det.fits'.format(run))
 
+    def get_run(self, band):
+        """Returns the run number of a band."""
+        return {'r': self.run_r, 'i': self.run_i, 'ha': self.run_ha}[band]
+
+    def read_catalogue(self, run):
+        """Returns the detections of a run which pass the preselection.
+
+        This is the selection applied by the icmd parameters of
+        `get_stilts_command`.
+        """
+        data = fits.getdata(self.get_catalogue_path(run), 1)
+        mask = (data['aperMag2Err'] > 0) & (data['aperMag2Err'] < MAX_APERMAG2ERR)
+        return data[mask]
+
+    def get_matched_columns(self):
+        """Returns the columns of the band-matched table.
+
+        The result mirrors the output of `stilts tmatchn` before `ocmd` is
+        applied: every column of each band is included with the suffix
+        _1 (r), _2 (i) or _3 (H-alpha), and the bands in which a source is
+        not detected are null (NaN for floats, TNULL for integers,
+        blank for strings and False for booleans).
+
+        Returns
+        -------
+        columns : list of `astropy.io.fits.Column`
+        """
+        catalogues = [self.read_catalogue(self.get_run(band))
+                      for band in BANDS]
+        idx = group_match([cat['ra'] for cat in catalogues],
+                          [cat['dec'] for cat in catalogues],
+                          constants.MATCHING_DISTANCE)
+        columns = []
+        for k, cat in enumerate(catalogues):
+            missing = idx[:, k] < 0
+            for col in cat.columns:
+                if len(cat) > 0:
+                    array = cat[col.name][np.maximum(idx[:, k], 0)]
+                else:
+                    array = np.zeros(len(idx), dtype=cat[col.name].dtype)
+                null = None
+                if array.dtype.kind == 'f':
+                    array[missing] = np.nan
+                elif array.dtype.kind in 'iu':
+                    null = NULL_VALUES[col.format[-1]]
+                    array[missing] = null
+                elif array.dtype.kind == 'b':
+                    array[missing] = False
+                else:
+                    array[missing] = ''
+                columns.append(fits.Column(name='{0}_{1}'.format(col.name,
+                                                                 k + 1),
+                                           format=col.format, unit=col.unit,
+                                           null=null, array=array))
+        return columns
+
+    def get_tpipe_command(self, matched):
+        """Returns the stilts command which adds the derived columns."""
+        config = {'stilts': constants.STILTS,
+                  'matched': matched,
+                  'fieldgrade': self.fieldgrade,
+                  'fieldid': self.fieldid,
+                  'ocmd': os.path.join(constants.LIBDIR,
+                                       'stilts-band-merging.cmd'),
+                  'output': self.output}
+        cmd = """{stilts} tpipe in={matched} \
+                  cmd='setparam fieldID "{fieldid}";
+                       setparam fieldGrade "{fieldgrade}";' \
+                  cmd=@{ocmd} \
+                  out='{output}'""".format(**config)
+        return cmd
+
     def get_stilts_command(self):
         """Returns the stilts command used to perform a band-merge."""
 
@@ -69,12 +158,12 @@ class BandMerge():
                   'runha': self.get_catalogue_path(self.run_ha),
                   'fieldgrade': self.fieldgrade,
                   'fieldid': self.fieldid,
+                  'maxerr': MAX_APERMAG2ERR,
                   'ocmd': os.path.join(constants.LIBDIR,
                                        'stilts-band-merging.cmd'),
                   'output': self.output}
 
-        # Note: we filter out sources detected at <0.5sigma
-        # (i.e. magnitude error < -2.5*log(1+3) = 1.19)
+        # Note: we filter out sources detected at <0.5sigma (MAX_APERMAG2ERR)
         cmd = """{stilts} tmatchn matcher=sky params={MATCHING_DISTANCE} \
                   multimode=group nin=3 \
                   in1={runr} in2={runi} in3={runha} \
@@ -82,28 +171,250 @@ class BandMerge():
                   values1='ra dec' values2='ra dec' values3='ra dec' \
                   icmd1='setparam fieldID "{fieldid}";
                          setparam fieldGrade "{fieldgrade}";
-                         select "aperMag2Err > 0 & aperMag2Err < 1.19";' \
-                  icmd2='select "aperMag2Err > 0 & aperMag2Err < 1.19";' \
-                  icmd3='select "aperMag2Err > 0 & aperMag2Err < 1.19";' \
+                         select "aperMag2Err > 0 & aperMag2Err < {maxerr}";' \
+                  icmd2='select "aperMag2Err > 0 & aperMag2Err < {maxerr}";' \
+                  icmd3='select "aperMag2Err > 0 & aperMag2Err < {maxerr}";' \
                   ocmd=@{ocmd} \
                   progress=none \
                   out='{output}'""".format(**config)
 
         return cmd
 
-    def run(self):
-        """Perform the band-merging."""
-        cmd = self.get_stilts_command()
-        status = os.system(cmd)
+    def run(self, method=BANDMERGER):
+        """Perform the band-merging.
+
+        Parameters
+        ----------
+        method : str {'numpy', 'tpipe', 'stilts'}
+            'numpy' matches the bands in-process (cf. `group_match`) and
+            computes the derived columns using `derivedcolumns`;
+            'tpipe' matches the bands in-process and calls stilts to add
+            the derived columns;
+            'stilts' uses `stilts tmatchn` for the entire band-merge.
+        """
+        if method == 'stilts':
+            return self._system(self.get_stilts_command())
+        elif method == 'tpipe':
+            return self.run_tpipe()
+        elif method == 'numpy':
+            return self.run_numpy()
+        raise ValueError('Unknown band-merging method: {0}'.format(method))
+
+    def run_numpy(self):
+        """Band-merges the field without calling stilts."""
+        columns, descriptions = derivedcolumns.bandmerged_columns(
+                                                self.get_matched_columns(),
+                                                self.fieldid.strip(),
+                                                self.fieldgrade.strip())
+        hdu = fits.BinTableHDU.from_columns(columns)
+        for k, description in enumerate(descriptions):
+            if description is not None:
+                hdu.header['TCOMM{0}'.format(k + 1)] = description
+        hdu.writeto(self.output, overwrite=True)
+        return 0
+
+    def run_tpipe(self):
+        """Band-merges the field using the in-process matcher and stilts tpipe."""
+        matched = self.output + '.matched.fits'
+        hdu = fits.BinTableHDU.from_columns(self.get_matched_columns())
+        hdu.writeto(matched, overwrite=True)
+        try:
+            status = self._system(self.get_tpipe_command(matched))
+        finally:
+            os.remove(matched)
+        return status
+
+    def _system(self, cmd):
+        """Executes a stilts command, logging an unexpected exit status."""
+        status = stiltsworker.system(cmd)
         if status != 0:
             log.error('{0}: Unexpected status ("{1}"): command was: {2}'.format(self.fieldid, status, cmd))
         return status
 
+    def validate(self, reference='stilts'):
+        """Compares the output of the numpy band-merger against stilts.
+
+        Parameters
+        ----------
+        reference : str {'stilts', 'tpipe'}
+            Band-merging method to compare against, cf. `run`. 'tpipe' uses
+            the same matches as 'numpy', hence tests the derived columns
+            (cf. `derivedcolumns`) in isolation.
+
+        Returns
+        -------
+        differences : dict
+            As returned by `compare_catalogues`.
+        """
+        output = self.output
+        try:
+            self.output = output + '.numpy.fits'
+            self.run('numpy')
+            self.output = output + '.stilts.fits'
+            self.run(reference)
+            differences = compare_catalogues(output + '.numpy.fits',
+                                             output + '.stilts.fits')
+        finally:
+            self.output = output
+            for suffix in ['.numpy.fits', '.stilts.fits']:
+                if os.path.exists(output + suffix):
+                    os.remove(output + suffix)
+        for key, value in differences.items():
+            if value:
+                log.warning('{0}: numpy and {1} differ: {2}: {3}'.format(
+                                        self.fieldid, reference, key, value))
+        return differences
+
 
 ###########
 # FUNCTIONS
 ###########
 
+def group_match(ra, dec, radius):
+    """Matches the sources of several catalogues into rows on the sky.
+
+    This mirrors `stilts tmatchn matcher=sky multimode=group` with
+    join=always for all inputs: sources from different catalogues which
+    lie within `radius` are linked, and each group of linked sources forms
+    an output row. Unmatched sources form rows on their own.
+    If a group contains several sources of the same catalogue, or sources
+    which are not all within `radius` of each other (e.g. a chain of
+    sources), it is split by a greedy nearest-neighbour pass: the links are
+    taken in order of increasing distance, and two partial rows are joined
+    only if they have no catalogue in common and all their sources are
+    linked to each other. The sources which are left over form rows of
+    their own, hence every source appears exactly once and every row only
+    contains sources within `radius` of each other.
+
+    Parameters
+    ----------
+    ra, dec : lists of arrays
+        Coordinates (degrees) of the sources in each catalogue.
+
+    radius : float
+        Matching radius (arcsec).
+
+    Returns
+    -------
+    idx : array of int, shape (n_rows, n_catalogues)
+        Index of the source of each catalogue in each row (-1 if absent).
+    """
+    n_cats = len(ra)
+    catalogue = np.concatenate([np.repeat(k, len(ra[k]))
+                                for k in range(n_cats)]).astype(int)
+    row = np.concatenate([np.arange(len(ra[k]))
+                          for k in range(n_cats)]).astype(int)
+    n = len(row)
+    if n == 0:
+        return np.zeros((0, n_cats), dtype=int)
+    ra_rad = np.radians(np.concatenate(ra).astype(float))
+    dec_rad = np.radians(np.concatenate(dec).astype(float))
+    xyz = np.column_stack((np.cos(dec_rad) * np.cos(ra_rad),
+                           np.cos(dec_rad) * np.sin(ra_rad),
+                           np.sin(dec_rad)))
+    # Chord length corresponding to the angular radius
+    chord = 2 * np.sin(np.radians(radius / 3600.) / 2)
+    pairs = cKDTree(xyz).query_pairs(chord, output_type='ndarray')
+    pairs = pairs[catalogue[pairs[:, 0]] != catalogue[pairs[:, 1]]]
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                       shape=(n, n))
+    n_groups, group = csgraph.connected_components(graph, directed=False)
+
+    # A group forms a single row if it holds at most one source of each
+    # catalogue and all its sources are linked to each other
+    size = np.bincount(group, minlength=n_groups)
+    n_links = np.bincount(group[pairs[:, 0]], minlength=n_groups)
+    per_catalogue = np.bincount(group * n_cats + catalogue,
+                                minlength=n_groups * n_cats)
+    simple = ((per_catalogue.reshape(n_groups, n_cats).max(axis=1) <= 1)
+              & (n_links == size * (size - 1) // 2))
+    # Each source is labelled by the first source of its row
+    first = np.repeat(n, n_groups)
+    np.minimum.at(first, group, np.arange(n))
+    label = np.where(simple[group], first[group], np.arange(n))
+
+    # Greedy nearest-neighbour matching of the other groups
+    pairs = pairs[~simple[group[pairs[:, 0]]]]
+    distance = ((xyz[pairs[:, 0]] - xyz[pairs[:, 1]])**2).sum(axis=1)
+    linked = set(zip(pairs[:, 0], pairs[:, 1]))
+    linked.update([(j, i) for i, j in linked])
+    members = {}
+    for i, j in pairs[np.argsort(distance, kind='mergesort')]:
+        a, b = label[i], label[j]
+        if a == b:
+            continue
+        row_a, row_b = members.get(a, [a]), members.get(b, [b])
+        if np.intersect1d(catalogue[row_a], catalogue[row_b]).size > 0:
+            continue
+        if not all((u, v) in linked for u in row_a for v in row_b):
+            continue
+        a, b = min(a, b), max(a, b)
+        members[a] = row_a + row_b
+        members.pop(b, None)
+        label[members[a]] = a
+
+    # Rows are ordered by group, i.e. roughly by their first source
+    rows, position = np.unique(label, return_inverse=True)
+    order = np.lexsort((rows, group[rows]))
+    rank = np.empty(len(rows), dtype=int)
+    rank[order] = np.arange(len(rows))
+    idx = -np.ones((len(rows), n_cats), dtype=int)
+    idx[rank[position], catalogue] = row
+    return idx
+
+
+def compare_catalogues(path1, path2, key='sourceID', rtol=1e-6):
+    """Compares two band-merged catalogues row by row.
+
+    Parameters
+    ----------
+    path1, path2 : str
+        Paths of the catalogues.
+
+    key : str
+        Column used to identify the same source in both catalogues.
+
+    rtol : float
+        Relative tolerance of the comparison of floating point columns.
+
+    Returns
+    -------
+    differences : dict
+        'columns' lists the columns which are not present in both files,
+        'missing' counts the sources which are not present in both files,
+        and every other key is a column name, mapped onto the number of
+        sources for which the values (or their null status) differ.
+    """
+    cat1, cat2 = Table.read(path1), Table.read(path2)
+    differences = OrderedDict()
+    differences['columns'] = sorted(set(cat1.colnames) ^ set(cat2.colnames))
+    ids1 = np.char.strip(np.asarray(cat1[key], dtype=str))
+    ids2 = np.char.strip(np.asarray(cat2[key], dtype=str))
+    common = np.intersect1d(ids1, ids2)
+    order1, order2 = np.argsort(ids1), np.argsort(ids2)
+    idx1 = order1[np.searchsorted(ids1[order1], common)]
+    idx2 = order2[np.searchsorted(ids2[order2], common)]
+    differences['missing'] = len(ids1) + len(ids2) - 2 * len(common)
+    for name in cat1.colnames:
+        if name not in cat2.colnames:
+            continue
+        col1, col2 = cat1[name][idx1], cat2[name][idx2]
+        null1 = np.asarray(getattr(col1, 'mask', np.zeros(len(col1), bool)))
+        null2 = np.asarray(getattr(col2, 'mask', np.zeros(len(col2), bool)))
+        values1, values2 = np.asarray(col1), np.asarray(col2)
+        if values1.dtype.kind == 'f':
+            null1 = null1 | np.isnan(values1)
+            null2 = null2 | np.isnan(values2)
+            with np.errstate(invalid='ignore'):
+                same = np.isclose(values1, values2, rtol=rtol, atol=0)
+        elif values1.dtype.kind in 'SU':
+            same = np.char.strip(values1) == np.char.strip(values2)
+        else:
+            same = values1 == values2
+        differ = (null1 != null2) | (~null1 & ~null2 & ~same)
+        differences[name] = int(differ.sum())
+    return differences
+
 def bandmerge_one(fieldid):
     """Band-merge a single field """
     with log.log_to_file(os.path.join(constants.LOGDIR, 'bandmerging.log')):
@@ -129,6 +440,19 @@ def bandmerge_one(fieldid):
         return status
 
 
+def validate_one(fieldid, reference='stilts'):
+    """Compares the numpy and stilts band-merge of a single field."""
+    idx = np.where(IPHASQC.field('id') == fieldid)[0]
+    if len(idx) < 1:
+        raise IPHASException('{}: error identifying runs'.format(fieldid))
+    bm = BandMerge(fieldid,
+                   IPHASQC.field('qflag')[idx[0]],
+                   IPHASQC.field('run_ha')[idx[0]],
+                   IPHASQC.field('run_r')[idx[0]],
+                   IPHASQC.field('run_i')[idx[0]])
+    return bm.validate(reference)
+
+
 def bandmerge(clusterview):
     """Band-merge all fields."""
     util.setup_dir(MYDESTINATION)
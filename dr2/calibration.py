@@ -17,11 +17,21 @@ and functions to plot colour-colour diagrams for quality control.
 """
 import numpy as np
 import os
+import json
+from collections import OrderedDict
+import time
+import threading
+import Queue
+import multiprocessing
 import matplotlib
 matplotlib.use('Agg')  # Cluster does not have an X backend
 from matplotlib import pyplot as plt
+from matplotlib import image
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from scipy import sparse
 from scipy.sparse import linalg
+from scipy.sparse import csgraph
 from astropy.io import ascii
 from astropy.io import fits
 from astropy import log
@@ -31,6 +41,8 @@ from constants import IPHASQC
 from constants import IPHASQC_COND_RELEASE
 from constants import CALIBDIR
 import util
+import shiftstore
+import stiltsworker
 
 __author__ = 'Geert Barentsen'
 __copyright__ = 'Copyright, The Authors'
@@ -41,15 +53,343 @@ __credits__ = ['Geert Barentsen', 'Hywel Farnhill', 'Janet Drew']
 # CONSTANTS
 ############
 
+# Data file defining the rules used to select anchors
+ANCHOR_RULES = os.path.join(constants.LIBDIR, 'anchor-rules.json')
+
+# How to apply the calibration to the catalogues? ('numpy' or 'stilts')
+APPLICATOR = 'numpy'
+# Magnitude columns in the bandmerged catalogues which require calibration
+MAGNITUDE_COLUMNS = shiftstore.MAGNITUDE_COLUMNS
+
+# Runs whose shifts are not corrected against APASS
+# Hack: take account of exposure time changes
+MANUALLY_SHIFTED = [364687,
+    368903, 368904, 368923, 368925,
+    369998, 370073, 370076, 370084,
+    370095, 371652, 371695, 372557,
+    372684, 372707, 372751, 372771,
+    372880, 373106, 373111, 373698,
+    374904, 376449, 376461, 376463,
+    376481, 376493, 376530, 401548,
+    401566, 402270, 407505, 407580,
+    407586, 407598, 408287, 408296,
+    413548, 413566, 413596, 413783,
+    413804, 414671, 418169, 418190,
+    418196, 418310, 427588, 427820,
+    457662, 460468, 470277, 470592,
+    470822, 470852, 474652, 476050,
+    476131, 478320, 478434, 478609,
+    478645, 478720, 478795, 537478,
+    537544, 537550, 537565, 537623,
+    538318, 538354, 538366, 538406,
+    538595, 538601, 538759, 540932,
+    541185, 541717, 541948, 568871,
+    568892, 568937, 568970, 568982,
+    569666, 569768, 569816, 
+    570005, 570559, 570601, 570754,
+    571311, 571362, 571377, 571704,
+    597412, 597469, 597778, 598536,
+    598710, 598865, 598880, 647562,
+    649761, 686153, 686264, 687199,
+    687757, 702703, 702724, 702769,
+    703360, 703408, 703741]
+
+# Joint calibration of all bands (cf. `JointGlazebrook`):
+# weight of the constraint shift(r) = shift(ha) for runs of the same field,
+# in the same units as the offset weights, i.e. sqrt(number of stars)
+JOINT_COUPLING = 10.
+# ... and for the fields which are H-alpha anchors (cf. `select_anchors`)
+JOINT_ANCHOR_COUPLING = 1000.
+# Weight of the APASS shifts, which act as soft anchors in r and i
+JOINT_APASS_WEIGHT = 10.
+
 # When to trust other surveys?
 TOLERANCE = 0.03 # abs(iphas-apass) tolerated
 MIN_MATCHES = 30 # minimum number of matches in a field against reference survey
 
+# Check the overlap offsets for consistency around short cycles before
+# solving (cf. `closure_errors`), and drop the inconsistent ones?
+# This is a diagnostic which costs several sparse matrix products per band,
+# hence it is off by default
+CLOSURE_CHECK = False
+CLOSURE_REJECT = False
+# An overlap is inconsistent if the mean closure error of the cycles
+# through it exceeds this tolerance (mag), given enough cycles
+CLOSURE_TOLERANCE = 0.05
+CLOSURE_MIN_CYCLES = 3
+
+# Which algorithm to use to solve the Glazebrook equation?
+# One of 'lsqr', 'cg', 'minres', 'gmres' or 'direct'
+# (cf. `solve_glazebrook_system`)
+SOLVER = 'lsqr'
+# Which preconditioner to use with the iterative solvers? ('jacobi' or False;
+# 'ilu' is not symmetric, hence it is only accepted by 'gmres')
+PRECONDITIONER = 'jacobi'
+# Solve the connected components of the overlap graph independently?
+SPLIT_COMPONENTS = True
+# Number of processes used to solve the components in parallel
+PROCESSES = 1
+# Model the shifts as a zeropoint per night plus a residual per run?
+# (cf. `solve_hierarchical`)
+NIGHT_MODEL = False
+# Weight of the penalty on the deviation of a run from its night zeropoint
+NIGHT_REGULARISATION = 1.
+# Number of replicates of the anchor stability analysis (0 to skip);
+# 'bootstrap' resamples the anchors, 'jackknife' drops groups of anchors
+STABILITY_REPLICATES = 0
+STABILITY_MODE = 'bootstrap'
+# Solve overlapping longitude strips in parallel? (cf. `solve_schwarz`)
+DOMAIN_DECOMPOSITION = False
+# Convergence criterion (mag) and maximum number of Schwarz iterations
+SCHWARZ_TOLERANCE = 1e-5
+SCHWARZ_MAXITER = 100
+# How to estimate the uncertainties of the shifts? (None, 'stochastic', 'exact')
+# None skips them; 'stochastic' is cheap but can be off by up to 30 per cent
+# for individual runs (cf. `inverse_diagonal`), hence it is not used by default
+UNCERTAINTIES = None
+# Number of random probe vectors used by the 'stochastic' estimator
+UNCERTAINTY_SAMPLES = 200
+
+# How to produce the diagnostic plots of the calibration steps?
+# 'none' (skip), 'async' (background thread) or 'sync' (inline)
+PLOTS = 'async'
+# Render the spatial plots as a cheap binned raster rather than a scatter plot?
+PLOT_RASTER = False
+# Extent and resolution of the spatial plots (galactic l/b, degrees)
+PLOT_L_RANGE = [28, 217]
+PLOT_B_RANGE = [-5.2, +5.2]
+PLOT_BINSIZE = 0.2
+
 
 ##########
 # CLASSES
 ##########
 
+class OverlapTable(object):
+    """Array-based table of the magnitude offsets between overlapping runs.
+
+    The overlaps are sorted by the index of the reference run (`idx1`) and
+    grouped in a CSR-like fashion, i.e. the overlaps of `runs[k]` are found
+    at positions `indptr[k]:indptr[k+1]` of the arrays below.
+
+    Attributes
+    ----------
+    runs : array of int
+        The runs which are being calibrated.
+    idx1, idx2 : array of int
+        Index into `runs` of the reference and comparison run of each overlap
+        (idx2 is -1 if the comparison run is not part of `runs`).
+    run1, run2 : array of int
+        Reference and comparison run number of each overlap.
+    offsets : array of float
+        Magnitude offset (run1 - run2) of each overlap.
+    weights : array of float
+        Weight of each overlap.
+    indptr : array of int
+        Segment offsets of the overlaps of each run.
+    """
+
+    def __init__(self, runs, idx1, idx2, run2, offsets, weights):
+        # Stable sort: the overlaps of a run retain their original order
+        order = np.argsort(idx1, kind='mergesort')
+        self.runs = runs
+        self.idx1 = np.asarray(idx1, dtype=int)[order]
+        self.idx2 = np.asarray(idx2, dtype=int)[order]
+        self.run1 = np.asarray(runs)[self.idx1]
+        self.run2 = np.asarray(run2)[order]
+        self.offsets = np.asarray(offsets, dtype=float)[order]
+        self.weights = np.asarray(weights, dtype=float)[order]
+        counts = np.bincount(self.idx1, minlength=len(runs))
+        self.indptr = np.concatenate(([0], np.cumsum(counts)))
+
+    def __len__(self):
+        return len(self.idx1)
+
+    @classmethod
+    def from_dict(cls, runs, overlaps):
+        """Creates a table from a dictionary of overlaps.
+
+        Parameters
+        ----------
+        runs : array of int
+
+        overlaps : dict
+            Of the form {run1: {'runs': [...], 'offsets': [...],
+            'weights': [...]}}, as returned by `Calibration.get_overlaps`.
+            Reference runs which are not part of `runs` are ignored.
+        """
+        run1, run2, offsets, weights = [], [], [], []
+        for myrun in overlaps:
+            run1.extend([myrun] * len(overlaps[myrun]['runs']))
+            run2.extend(overlaps[myrun]['runs'])
+            offsets.extend(overlaps[myrun]['offsets'])
+            weights.extend(overlaps[myrun]['weights'])
+        idx1 = util.run_index(runs, run1)
+        idx2 = util.run_index(runs, run2)
+        use = idx1 >= 0
+        return cls(runs, idx1[use], idx2[use], np.array(run2)[use],
+                   np.array(offsets)[use], np.array(weights)[use])
+
+    def subset(self, mask):
+        """Returns a table with the overlaps selected by a boolean mask."""
+        return OverlapTable(self.runs, self.idx1[mask], self.idx2[mask],
+                            self.run2[mask], self.offsets[mask],
+                            self.weights[mask])
+
+    def as_dict(self):
+        """Returns the overlaps in the dictionary format.
+
+        Returns
+        -------
+        overlaps : dict
+            Of the form {run1: {'runs': [...], 'offsets': [...],
+            'weights': [...]}}.
+        """
+        overlaps = {}
+        for k in np.where(np.diff(self.indptr) > 0)[0]:
+            start, end = self.indptr[k], self.indptr[k+1]
+            overlaps[self.runs[k]] = {'runs': list(self.run2[start:end]),
+                                      'offsets': list(self.offsets[start:end]),
+                                      'weights': list(self.weights[start:end])}
+        return overlaps
+
+
+class PlotQueue(object):
+    """Renders diagnostic plots without blocking the calculation.
+
+    Plotting jobs are submitted as a function and its arguments.
+    Depending on `mode`, the jobs are dropped ('none'), executed
+    immediately ('sync'), or handed to a background thread ('async').
+    A single thread is used because matplotlib is not thread-safe.
+
+    Parameters
+    ----------
+    mode : str {'none', 'async', 'sync'}
+    """
+
+    def __init__(self, mode=PLOTS):
+        assert(mode in ['none', 'async', 'sync'])
+        self.mode = mode
+        self.queue = None
+        self.thread = None
+
+    def submit(self, function, *args):
+        """Schedules function(*args) to be executed."""
+        if self.mode == 'none':
+            return
+        if self.mode == 'sync':
+            self._render(function, args)
+            return
+        if self.thread is None:
+            self.queue = Queue.Queue()
+            self.thread = threading.Thread(target=self._worker,
+                                           name='calibration-plots')
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put((function, args))
+
+    def join(self):
+        """Blocks until all submitted plots have been rendered."""
+        if self.queue is not None:
+            self.queue.join()
+
+    def _worker(self):
+        while True:
+            function, args = self.queue.get()
+            try:
+                self._render(function, args)
+            finally:
+                self.queue.task_done()
+
+    def _render(self, function, args):
+        try:
+            function(*args)
+        except Exception as e:
+            # A failing plot should never break the calibration
+            log.warning('Plotting failed: {0}: {1}'.format(function.__name__, e))
+
+
+def plot_spatial(path, l, b, shifts, title='', anchor_l=None, anchor_b=None):
+    """Creates a spatial plot of l/b against shifts.
+
+    Uses the object-oriented matplotlib API (rather than pyplot), so that it
+    can safely be called from a background thread.
+
+    Parameters
+    ----------
+    path : str
+        Output filename; '-without-anchors.png' and '-with-anchors.png'
+        are appended.
+
+    l, b, shifts : arrays of float
+
+    anchor_l, anchor_b : arrays of float (optional)
+        Positions of the anchors.
+    """
+    fig = Figure(figsize=(12,6))
+    canvas = FigureCanvasAgg(fig)
+    fig.subplots_adjust(0.06, 0.15, 0.97, 0.9)
+    p = fig.add_subplot(111)
+    p.set_title(title)
+    scat = p.scatter(l, b, c=shifts, vmin=-0.13, vmax=+0.13,
+                     edgecolors='none',
+                     s=7, marker='h')
+    fig.colorbar(scat)
+    p.set_xlim(PLOT_L_RANGE)
+    p.set_ylim(PLOT_B_RANGE)
+    p.set_xlabel('l')
+    p.set_ylabel('b')
+
+    canvas.print_figure(path+'-without-anchors.png', dpi=200)
+    log.info('Wrote {0}'.format(path+'-without-anchors.png'))
+
+    # Indicate anchors
+    if anchor_l is not None:
+        p.scatter(anchor_l, anchor_b,
+                  edgecolors='black', facecolor='none',
+                  s=15, marker='x', alpha=0.9, lw=0.3)
+        canvas.print_figure(path+'-with-anchors.png', dpi=200)
+        log.info('Wrote {0}'.format(path+'-with-anchors.png'))
+
+
+def plot_spatial_raster(path, l, b, shifts, title='',
+                        anchor_l=None, anchor_b=None):
+    """Cheap alternative to `plot_spatial`, rendering a binned raster.
+
+    The mean shift is computed in bins of PLOT_BINSIZE degrees, and the
+    resulting image is written directly, i.e. without axes. In the image
+    '-with-anchors.png', bins containing an anchor are shown in black.
+    The `title` argument is ignored.
+    """
+    bins = [np.arange(PLOT_B_RANGE[0], PLOT_B_RANGE[1] + PLOT_BINSIZE,
+                      PLOT_BINSIZE),
+            np.arange(PLOT_L_RANGE[0], PLOT_L_RANGE[1] + PLOT_BINSIZE,
+                      PLOT_BINSIZE)]
+    counts, _, _ = np.histogram2d(b, l, bins=bins)
+    sums, _, _ = np.histogram2d(b, l, bins=bins, weights=shifts)
+    mean = sums / np.maximum(counts, 1)
+    # Galactic longitude increases towards the left
+    rgba = plt.cm.jet(plt.Normalize(-0.13, +0.13)(mean[::-1, ::-1]))
+    rgba[(counts == 0)[::-1, ::-1]] = [1, 1, 1, 1]
+    image.imsave(path+'-without-anchors.png', rgba)
+    log.info('Wrote {0}'.format(path+'-without-anchors.png'))
+
+    if anchor_l is not None:
+        has_anchor, _, _ = np.histogram2d(anchor_b, anchor_l, bins=bins)
+        rgba[(has_anchor > 0)[::-1, ::-1]] = [0, 0, 0, 1]
+        image.imsave(path+'-with-anchors.png', rgba)
+        log.info('Wrote {0}'.format(path+'-with-anchors.png'))
+
+
+def comparison_statistics(delta):
+    """Returns a string summarising the offsets against a reference survey."""
+    stats =  "mean={0:.3f}+/-{1:.3f}, ".format(np.mean(delta),
+                                               np.std(delta))
+    stats += "min/max={0:.3f}/{1:.3f}".format(np.min(delta),
+                                              np.max(delta))
+    return stats
+
+
 class Calibration(object):
     """Container for calibration information in a single band.
 
@@ -69,25 +409,40 @@ class Calibration(object):
         List of exposure numbers for `band` which are part of the data release.
     shifts : array of float
         The calibration shifts to be *added* to the magnitudes of `runs`.
+    errors : array of float or None
+        The 1-sigma uncertainties of `shifts`, if they have been estimated.
+    nights : array of int
+        The night during which each run was observed.
+    longitudes : array of float
+        The galactic longitude of each run.
     anchors : array of bool
         Which exposures can be trusted?
+    plots : PlotQueue
+        Renders the diagnostic plots produced by `evaluate`.
     """
 
-    def __init__(self, band):
+    def __init__(self, band, plots=PLOTS):
         """Loads the necessary information about the survey zeropoints.
 
         Parameters
         ----------
         band : str {'r', 'i', 'ha'}
             Name of the photometric filter being calibrated.
+
+        plots : str {'none', 'async', 'sync'}
+            How to produce the diagnostic plots, cf. `PlotQueue`.
         """
         #self.calib = np.array(zip(runs, np.zeros(len(runs))),
         #                      dtype=[('runs', 'i4'), ('shifts', 'f4')])
         assert(band in constants.BANDS)
         self.band = band
+        self.plots = PlotQueue(plots)
 
         self.runs = IPHASQC['run_'+band][IPHASQC_COND_RELEASE]
+        self.nights = IPHASQC['night'][IPHASQC_COND_RELEASE]
+        self.longitudes = IPHASQC['l'][IPHASQC_COND_RELEASE]
         self.shifts = np.zeros(len(self.runs))  # Shifts to be *ADDED* - init to 0
+        self.errors = None
 
         # Load broad-band comparison data
         if band in ['r', 'i']:
@@ -113,37 +468,78 @@ class Calibration(object):
     def get_anchors(self):
         return self.anchors
 
+    def get_overlap_table(self, weights=True):
+        """Returns an OverlapTable with the offsets between run overlaps.
+
+        Takes the current calibration into account.
+        """
+        log.info('Loading calibration-corrected magnitude offsets between overlaps')
+        idx1 = util.run_index(self.runs, self.offsetdata['run1'])
+        idx2 = util.run_index(self.runs, self.offsetdata['run2'])
+        use = (idx1 >= 0) & (idx2 >= 0)
+        idx1, idx2 = idx1[use], idx2[use]
+        # Offset is computed as (run1 - run2), hence correcting 
+        # for calibration means adding (shift_run1 - shift_run2)
+        offsets = (np.asarray(self.offsetdata['offset'])[use]
+                   + self.shifts[idx1]
+                   - self.shifts[idx2])
+        if weights:
+            myweights = np.sqrt(np.asarray(self.offsetdata['n'])[use])
+        else:
+            myweights = np.ones(use.sum())
+        return OverlapTable(self.runs, idx1, idx2, self.runs[idx2],
+                            offsets, myweights)
+
     def get_overlaps(self, weights=True):
         """Returns a dict with the magnitude offsets between run overlaps.
 
         Takes the current calibration into account.
         """
-        log.info('Loading calibration-corrected magnitude offsets between overlaps')
-        # Prepare look-up dictionary which links runs to calibration shifts
-        current_shifts = dict(zip(self.runs, self.shifts))
+        return self.get_overlap_table(weights=weights).as_dict()
 
-        # Dictionary of field overlaps
-        overlaps = {}
-        for row in self.offsetdata:
-            myrun1 = row['run1']
-            myrun2 = row['run2']
-            if myrun1 in self.runs and myrun2 in self.runs:
-                # Offset is computed as (run1 - run2), hence correcting 
-                # for calibration means adding (shift_run1 - shift_run2)
-                myoffset = (row['offset'] 
-                            + current_shifts[myrun1]
-                            - current_shifts[myrun2])
-                if myrun1 not in overlaps:
-                    overlaps[myrun1] = {'runs': [], 'offsets': [], 'weights': []}
-                overlaps[myrun1]['runs'].append(myrun2)
-                overlaps[myrun1]['offsets'].append(myoffset)
-
-                if weights:
-                    overlaps[myrun1]['weights'].append(np.sqrt(row['n']))
-                else:
-                    overlaps[myrun1]['weights'].append(1.0)
+    def check_closure(self, filename=None, reject=CLOSURE_REJECT):
+        """Flags the overlaps with offsets which are inconsistent with others.
 
-        return overlaps
+        Parameters
+        ----------
+        filename : str (optional)
+            The inconsistent overlaps are written to this csv file.
+
+        reject : bool
+            If True, the inconsistent overlaps are removed from the offsets,
+            such that they are not used in the calibration.
+
+        Returns
+        -------
+        inconsistent : array of bool
+            Which overlaps of `get_overlap_table` are inconsistent.
+        """
+        table = self.get_overlap_table()
+        inconsistent, error = inconsistent_overlaps(table)
+        log.info('Closure: {0} of {1} overlaps are inconsistent'.format(
+                                        inconsistent.sum(), len(table)))
+        if filename is not None:
+            with open(filename, 'w') as out:
+                out.write('run1,run2,offset,error\n')
+                for k in np.where(inconsistent)[0]:
+                    out.write('{0},{1},{2},{3}\n'.format(table.run1[k],
+                                                        table.run2[k],
+                                                        table.offsets[k],
+                                                        error[k]))
+        if reject:
+            # Remove both directions of each inconsistent pair
+            def pair_keys(run1, run2):
+                run1 = np.asarray(run1, dtype=np.int64)
+                run2 = np.asarray(run2, dtype=np.int64)
+                return (np.minimum(run1, run2) * 10**7
+                        + np.maximum(run1, run2))
+            bad = np.in1d(pair_keys(self.offsetdata['run1'],
+                                    self.offsetdata['run2']),
+                          pair_keys(table.run1[inconsistent],
+                                    table.run2[inconsistent]))
+            log.info('Closure: removing {0} offsets'.format(bad.sum()))
+            self.offsetdata = self.offsetdata[~bad]
+        return inconsistent
 
     def write_anchor_list(self, filename):
         """Writes the list of anchors to a csv files.
@@ -176,6 +572,11 @@ class Calibration(object):
         return self.shifts[self.runs == run][0]
 
     def evaluate(self, name, title):
+        """Reports on the current calibration.
+
+        The statistics against APASS are computed immediately, while the
+        plots are handed to the `PlotQueue`.
+        """
         # Plot the absolute calibration shifts
         l = IPHASQC['l'][IPHASQC_COND_RELEASE]
         b = IPHASQC['b'][IPHASQC_COND_RELEASE]
@@ -186,64 +587,43 @@ class Calibration(object):
             with open(statsfile, 'w') as out:
                 # Against APASS
                 mask_use = (self.apass_matches >= MIN_MATCHES)
-                l = IPHASQC['l'][IPHASQC_COND_RELEASE][mask_use]
-                b = IPHASQC['b'][IPHASQC_COND_RELEASE][mask_use]
                 delta = self.apass_shifts[mask_use] - self.shifts[mask_use]
-                self._spatial_plot(l, b, delta, 'apass-'+name, 'APASS: '+title)
-
-                stats =  "mean={0:.3f}+/-{1:.3f}, ".format(np.mean(delta),
-                                                           np.std(delta))
-                stats += "min/max={0:.3f}/{1:.3f}".format(np.min(delta),
-                                                          np.max(delta))
+                self._spatial_plot(l[mask_use], b[mask_use], delta,
+                                   'apass-'+name, 'APASS: '+title)
 
+                stats = comparison_statistics(delta)
                 out.write(stats)
                 log.info(stats)
 
                 # Against SDSS
                 mask_use = (self.sdss_matches >= MIN_MATCHES)
-                l = IPHASQC['l'][IPHASQC_COND_RELEASE][mask_use]
-                b = IPHASQC['b'][IPHASQC_COND_RELEASE][mask_use]
                 delta = self.sdss_shifts[mask_use] - self.shifts[mask_use]
-                self._spatial_plot(l, b, delta, 'sdss-'+name, 'SDSS '+title)
-
+                self._spatial_plot(l[mask_use], b[mask_use], delta,
+                                   'sdss-'+name, 'SDSS '+title)
 
     def _spatial_plot(self, l, b, shifts, name, title=''):
-        """Creates a spatial plot of l/b against shifts."""
+        """Schedules a spatial plot of l/b against shifts."""
+        if self.plots.mode == 'none':
+            return
         plotdir = os.path.join(CALIBDIR, 'plots')
         util.setup_dir(plotdir)
-
-        fig = plt.figure(figsize=(12,6))
-        fig.subplots_adjust(0.06, 0.15, 0.97, 0.9)
-        p = fig.add_subplot(111)
-        p.set_title(title)
-        scat = p.scatter(l, b, c=shifts, vmin=-0.13, vmax=+0.13,
-                         edgecolors='none',
-                         s=7, marker='h')
-        plt.colorbar(scat)
-        p.set_xlim([28, 217])
-        p.set_ylim([-5.2, +5.2])
-        p.set_xlabel('l')
-        p.set_ylabel('b')
-
-        path = os.path.join(plotdir, self.band+'-'+name+'-without-anchors.png')
-        fig.savefig(path, dpi=200)
-        log.info('Wrote {0}'.format(path))
-
-        # Indicate anchors
-        p.scatter(IPHASQC['l'][IPHASQC_COND_RELEASE][self.anchors],
-                  IPHASQC['b'][IPHASQC_COND_RELEASE][self.anchors],
-                  edgecolors='black', facecolor='none',
-                  s=15, marker='x', alpha=0.9, lw=0.3)
-        path = os.path.join(plotdir, self.band+'-'+name+'-with-anchors.png')
-        fig.savefig(path, dpi=200)
-        log.info('Wrote {0}'.format(path))
-
-        plt.close()
-        return fig
+        path = os.path.join(plotdir, self.band+'-'+name)
+        if PLOT_RASTER:
+            function = plot_spatial_raster
+        else:
+            function = plot_spatial
+        # Copies are passed because the shifts and anchors change in-place
+        anchors = self.anchors.copy()
+        self.plots.submit(function, path,
+                          np.array(l), np.array(b), np.array(shifts), title,
+                          IPHASQC['l'][IPHASQC_COND_RELEASE][anchors],
+                          IPHASQC['b'][IPHASQC_COND_RELEASE][anchors])
 
     def write(self, filename):
         """Writes calibration shifts to a CSV file on disk.
 
+        The uncertainties are written in an 'err' column if they are known.
+
         Parameters
         ----------
         filename : string
@@ -251,168 +631,992 @@ class Calibration(object):
         """
         log.info('Writing results to {0}'.format(filename))
         f = open(filename, 'w')
-        f.write('run,shift\n')
-        for myrun, myshift in zip(self.runs, self.shifts):
-            f.write('{0},{1}\n'.format(myrun, myshift))
+        if self.errors is None:
+            f.write('run,shift\n')
+            for myrun, myshift in zip(self.runs, self.shifts):
+                f.write('{0},{1}\n'.format(myrun, myshift))
+        else:
+            f.write('run,shift,err\n')
+            for myrun, myshift, myerr in zip(self.runs, self.shifts,
+                                             self.errors):
+                f.write('{0},{1},{2}\n'.format(myrun, myshift, myerr))
         f.close()
 
     def _load_offsetdata(self):
+        """Loads the offsets between overlapping runs.
+
+        The binary offsets-{band}.npy file written by `dr2.offsets` is
+        memory-mapped if it is available and up to date; the csv file is
+        only parsed otherwise.
+        """
         filename_offsets = os.path.join(CALIBDIR,
                                         'offsets-{0}.csv'.format(self.band))
-        log.info('Reading {0}'.format(filename_offsets))
-        mydata = ascii.read(filename_offsets)
+        filename_binary = os.path.join(CALIBDIR,
+                                       'offsets-{0}.npy'.format(self.band))
+        if (os.path.exists(filename_binary) and
+            (not os.path.exists(filename_offsets) or
+             os.path.getmtime(filename_binary) >= os.path.getmtime(filename_offsets))):
+            log.info('Reading {0}'.format(filename_binary))
+            mydata = np.load(filename_binary, mmap_mode='r')
+        else:
+            log.info('Reading {0}'.format(filename_offsets))
+            mydata = ascii.read(filename_offsets)
         # Do not use the offsets unless enough stars were used
         #mask_use = (mydata['n'] >= 5) & (mydata['std'] < 0.1)
         self.offsetdata = mydata
 
     def select_anchors(self):
-        """Returns a boolean array indicating which runs are suitable anchors."""
-        median_pair_offset = -0.008 
-        IS_STABLE = ( (IPHASQC.field('med_dr') < (median_pair_offset+0.03)) &
-                      (IPHASQC.field('med_dr') > (median_pair_offset-0.03)) &
-                      (IPHASQC.field('med_di') < (median_pair_offset+0.03)) &
-                      (IPHASQC.field('med_di') > (median_pair_offset-0.03)) &
-                      (IPHASQC.field('med_dh') < (median_pair_offset+0.03)) &
-                      (IPHASQC.field('med_dh') > (median_pair_offset-0.03))
-                    )
-
-        if self.band == 'ha':
-            # Because the H-alpha calibration is tied to the r-band,
-            # we require fields to be "stable" to be an anchor in H-alpha.
-            # "Stable" is defined as the fieldpair not showing great shifts.
-
-            # Eyeballing has revealed that the H-alpha shifts should be 
-            # equal to the r-band shift for these fields:
-            KEEP_FIXED = ['0151_nov2005', '0151o_nov2005',
-                          '0207_jul2012', '0207o_jul2012',
-                          '0296_nov2006b',
-                          '0818_nov2003', '0818o_nov2003',
-                          '0922o_oct2004',
-                          '0943_sep2010', '0943o_sep2010',
-                          '0978_sep2012', '0978o_sep2010',
-                          '0983_oct2005b', '0983o_oct2005b',
-                          '0985_oct2005b', '0985o_oct2005b',
-                          '1000_dec2003', '1000o_dec2003',
-                          '1037_dec2003', '1037o_dec2003',
-                          '1054_dec2003', '1054o_dec2003',
-                          '1065_oct2004', '1065o_oct2004',
-                          '1069_nov2006c', '1069o_nov2006c',
-                          '1071_nov2012', '1071o_nov2012',
-                          '1076_oct2012', '1076o_oct2012',
-                          '1084_oct2004', '1084o_oct2004',
-                          '1116_dec2004', 
-                          '1232_nov2012', '1232o_nov2012',
-                          '1262_nov2003b', '1262o_nov2003b',
-                          '1285_nov2006c',
-                          '1370_oct2004', '1370o_oct2004',
-                          '1371_oct2004', '1371o_oct2004',
-                          '1374_oct2004', '1374o_oct2004',
-                          '1375_oct2004', '1375o_oct2004',
-                          '1381_oct2010', '1381o_oct2010',
-                          '1383_oct2010', '1383o_oct2010',
-                          '1384_oct2004', '1384o_oct2004',
-                          '1387_oct2004', '1387o_oct2004',
-                          '1388_oct2004', '1388o_oct2004',
-                          '1397_nov2012', '1397o_nov2012',
-                          '1423_nov2006b', '1423o_nov2006b',
-                          '1432_nov2012', '1432o_nov2012',
-                          '1436_nov2006d', '1436o_nov2006d',
-                          '1685_oct2004', '1685o_oct2004',
-                          '1819_nov2012', '1819o_nov2012',
-                          '2021_nov2004', '2021o_nov2004',
-                          '2361_oct2006', '2361o_oct2006',
-                          '2529_nov2003', '2529o_nov2003',
-                          '2694_dec2005', '2694o_dec2005',
-                          '2767_dec2003', '2767o_dec2003',
-                          '2845_nov2006d', '2845o_nov2006d',
-                          '2881_dec2003', '2881o_dec2003',
-                          '2975_oct2005a', '2975o_oct2005a',
-                          '3002_dec2005', '3002o_dec2005',
-                          '3004_oct2005b', '3004o_oct2005b',
-                          '3632_nov2007', '3632o_nov2007',
-                          '3855_nov2012', '3855o_nov2012',
-                          '4016_dec2008', '4016o_dec2008',
-                          '5127_aug2004b', '5127o_aug2004b',
-                          '6476_oct2005b', '6476o_oct2005b',
-                          '6494_jun2005', '6494o_jun2005',
-                          '6616_dec2008', '6616o_dec2008',
-                          ]
-
-            IS_KEEP_FIXED = np.array([myfield in KEEP_FIXED 
-                                     for myfield in IPHASQC.field('id')])
-            anchors = (IS_STABLE | IS_KEEP_FIXED)[IPHASQC_COND_RELEASE]
-            log.info('IS_STABLE: {0} fields are H-alpha anchors'.format(anchors.sum()))
-            return anchors
+        """Returns a boolean array indicating which runs are suitable anchors.
 
-        else:
-            tolerance = 0.03  # Default = 0.03
-            min_matches = 30  # Default = 20
-            anchors = []
-            IS_APASS_ANCHOR = ( (IPHASQC.field('rmatch_apassdr7') >= min_matches)
-                              & (IPHASQC.field('imatch_apassdr7') >= min_matches)
-                              & (np.abs(IPHASQC.field('rshift_apassdr7')) <= tolerance)
-                              & (np.abs(IPHASQC.field('ishift_apassdr7')) <= tolerance)
-                              & (np.abs(IPHASQC.field('rshift_apassdr7') - IPHASQC.field('ishift_apassdr7')) <= tolerance) )
-
-            IS_OLD_ANCHOR = (IPHASQC.field('anchor') == 1)
-
-            # Extra anchors selected in the final phases of the data release,
-            # when a few areas with poor anchor coverage were spotted
-            EXTRA_ANCHORS = ascii.read(os.path.join(constants.LIBDIR,
-                                                    'anchor-extra.txt'))['field']
-            IS_EXTRA_ANCHOR = np.array([myfield in EXTRA_ANCHORS 
-                                        for myfield in IPHASQC.field('id')])
-            # Make sure the following runs are no anchors
-            # cf. e-mail Janet to Geert, 13 Aug 2013
-            ANCHOR_BLACKLIST = ascii.read(os.path.join(constants.LIBDIR,
-                                                       'anchor-blacklist.txt'))['field']
-            IS_BLACKLIST = np.array([myfield in ANCHOR_BLACKLIST 
-                                     for myfield in IPHASQC.field('id')])
-
-            # Extra night with good conditions
-            ANCHOR_NIGHTS = [20030915, 20031018, 20031101, 20031104, 20031108,
-                             20031117, 20040707, 20040805, 20040822, 20041022,
-                             20050629, 20050709, 20050710, 20050711, 20050916,
-                             20050917, 20050918, 20051023, 20051101, 20051102,
-                             20061129, 20061130, 20061214, 20070627, 20070630,
-                             20080722, 20080723, 20090808, 20090810, 20091029,
-                             20091031]
-            IS_IN_EXTRA_NIGHT = np.array([mynight in ANCHOR_NIGHTS 
-                                       for mynight in IPHASQC.field('night')])
-
-            # Nights which should NOT provide anchors
-            NIGHT_BLACKLIST = [20031117, 20051109, 20061128, 20091029, 20101029,]
-            IS_IN_NIGHT_BLACKLIST = np.array([night in NIGHT_BLACKLIST 
-                                              for night in IPHASQC.field('night')])
-
-            # Anchors must not have known quality issues
-            IS_QUALITY_OK = ((IPHASQC.field('seeing_max') < 2.0) &
-                               (IPHASQC.field('airmass_max') < 1.4) &
-                               (IPHASQC.field('qflag') != 'C') &
-                               (IPHASQC.field('qflag') != 'D'))
-
-            anchors = (-IS_BLACKLIST &
-                       -IS_IN_NIGHT_BLACKLIST &
-                       IS_STABLE & 
-                       IS_QUALITY_OK &
-                       (IS_OLD_ANCHOR | IS_EXTRA_ANCHOR | IS_IN_EXTRA_NIGHT | IS_APASS_ANCHOR)
-                      )
-            result = anchors[IPHASQC_COND_RELEASE]
-
-            log.info('IS_APASS_ANCHOR: {0} fields'.format(IS_APASS_ANCHOR.sum()))
-            log.info('IS_OLD_ANCHOR: {0} fields'.format(IS_OLD_ANCHOR.sum()))
-            log.info('IS_EXTRA_ANCHOR: {0} fields'.format(IS_EXTRA_ANCHOR.sum()))
-            log.info('IS_IN_EXTRA_NIGHT: {0} fields'.format(IS_IN_EXTRA_NIGHT.sum()))
-            log.info('IS_BLACKLIST: {0} fields'.format(IS_BLACKLIST.sum()))            
-            log.info('Anchors in data release: {0} fields'.format(result.sum()))
-
-            return result
+        The anchors are selected using the rules in `ANCHOR_RULES`.
+        """
+        anchors, counts = evaluate_anchor_rules(IPHASQC, self.band,
+                                                load_anchor_rules())
+        for name in counts:
+            log.info('{0}: {1} fields'.format(name, counts[name]))
+        result = anchors[IPHASQC_COND_RELEASE]
+        log.info('Anchors in data release: {0} fields'.format(result.sum()))
+        return result
+
+
+def load_anchor_rules(filename=ANCHOR_RULES):
+    """Returns the anchor selection rules stored in a json file.
+
+    Conditions which refer to a list of fields in a file, e.g.
+    {"column": "id", "op": "in", "file": "anchor-extra.txt"},
+    are replaced by the contents of that file (read from `constants.LIBDIR`).
+    """
+    with open(filename) as fh:
+        rules = json.load(fh)
+    for rule in rules['rules'].values():
+        for condition in rule['all']:
+            if 'file' in condition:
+                path = os.path.join(constants.LIBDIR, condition.pop('file'))
+                condition['value'] = ascii.read(path)['field']
+    return rules
+
+
+def _evaluate_condition(table, condition):
+    """Returns a boolean array indicating where a condition is true."""
+    values = table[condition['column']]
+    if 'subtract' in condition:
+        values = values - table[condition['subtract']]
+    if condition.get('abs', False):
+        values = np.abs(values)
+    op, value = condition['op'], condition['value']
+    if op == 'in':
+        return np.in1d(values, value)
+    if op == 'not_in':
+        return ~np.in1d(values, value)
+    if op == 'lt':
+        return values < value
+    if op == 'le':
+        return values <= value
+    if op == 'gt':
+        return values > value
+    if op == 'ge':
+        return values >= value
+    if op == 'eq':
+        return values == value
+    if op == 'ne':
+        return values != value
+    raise ValueError('Unknown operator in anchor rules: {0}'.format(op))
+
+
+def evaluate_anchor_rules(table, band, rules):
+    """Selects the anchors in a table of fields.
+
+    Parameters
+    ----------
+    table : structured array
+        Quality control table, e.g. IPHASQC.
+
+    band : str {'r', 'i', 'ha'}
+
+    rules : dict
+        Rules as returned by `load_anchor_rules`.
+
+    Returns
+    -------
+    anchors, counts : array of bool, OrderedDict
+        Which rows of `table` are anchors, and the number of rows
+        passing each of the rules used.
+    """
+    selection = rules['bands'][band]
+    counts = OrderedDict()
+    masks = {}
+    for name in (selection.get('require', []) + selection.get('any', [])
+                 + selection.get('exclude', [])):
+        if name in masks:
+            continue
+        mask = np.ones(len(table), dtype=bool)
+        for condition in rules['rules'][name]['all']:
+            mask &= _evaluate_condition(table, condition)
+        masks[name] = mask
+        counts[name] = mask.sum()
+
+    anchors = np.ones(len(table), dtype=bool)
+    for name in selection.get('require', []):
+        anchors &= masks[name]
+    if selection.get('any'):
+        anchors &= np.any([masks[name] for name in selection['any']], axis=0)
+    for name in selection.get('exclude', []):
+        anchors &= ~masks[name]
+    return anchors, counts
 
 
 #############
 # GLAZEBROOK
 #############
 
+def offset_graph(table):
+    """Returns the overlap graph as sparse matrices.
+
+    Parameters
+    ----------
+    table : `OverlapTable`
+
+    Returns
+    -------
+    O, B : `scipy.sparse.csr_matrix`
+        O[i,j] holds the offset (run_i - run_j), averaged over all overlaps
+        between the two runs in both directions, such that O is
+        antisymmetric; B is the binary adjacency matrix with the same
+        sparsity pattern.
+    """
+    n = len(table.runs)
+    use = (table.idx2 >= 0) & (table.idx1 != table.idx2)
+    i, j = table.idx1[use], table.idx2[use]
+    rows, cols = np.concatenate((i, j)), np.concatenate((j, i))
+    offsets = table.offsets[use]
+    # Both matrices are built from the same indices, hence their data
+    # arrays are aligned once the duplicates have been summed
+    O = sparse.coo_matrix((np.concatenate((offsets, -offsets)),
+                           (rows, cols)), shape=(n, n)).tocsr()
+    counts = sparse.coo_matrix((np.ones(len(rows)), (rows, cols)),
+                               shape=(n, n)).tocsr()
+    O.data /= counts.data
+    B = counts
+    B.data[:] = 1.0
+    return O, B
+
+
+def closure_errors(table, quadrilaterals=True):
+    """Returns the closure errors of the short cycles through each overlap.
+
+    The offsets around a cycle of the overlap graph should sum to zero,
+    e.g. O[i,j] + O[j,k] + O[k,i] = 0 for a triangle. A bad offset, such as
+    one affected by clouds, spoils all the cycles it is part of, such that
+    the mean closure error of the cycles through an overlap estimates the
+    error of its offset, whereas a good overlap which shares only one cycle
+    with a bad one is affected by a fraction of the error
+    (cf. `inconsistent_overlaps`).
+
+    The sums over all cycles are computed at once using sparse matrix
+    products. For the triangles through an edge (i,j):
+
+        sum_k (O_ij + O_jk + O_ki) = (C * O - B O - O B)_ij
+
+    where C = (B B) * B counts the triangles and * is the element-wise
+    product. The quadrilaterals are treated in the same way using B B B,
+    after removing the walks which return along the same edge (their
+    closure is zero by construction).
+
+    Parameters
+    ----------
+    table : `OverlapTable`
+
+    quadrilaterals : bool
+        Also compute the closure of the quadrilaterals (the most expensive
+        step).
+
+    Returns
+    -------
+    closure : dict
+        'n_triangles' and 'triangles' (the mean closure error), and
+        'n_quadrilaterals' and 'quadrilaterals' if requested, as arrays
+        aligned with the overlaps of `table`; the mean is NaN if an
+        overlap is not part of any cycle.
+    """
+    t_start = time.time()
+    O, B = offset_graph(table)
+    BO, OB = B.dot(O), O.dot(B)
+    B2 = B.dot(B)
+    n_triangles = B2.multiply(B)
+    sum_triangles = n_triangles.multiply(O) - BO.multiply(B) - OB.multiply(B)
+
+    use = table.idx2 >= 0
+    i, j = table.idx1[use], table.idx2[use]
+
+    def at_overlaps(M):
+        result = np.nan * np.ones(len(table))
+        result[use] = np.asarray(sparse.csr_matrix(M)[i, j]).ravel()
+        return result
+
+    closure = OrderedDict()
+    closure['n_triangles'] = at_overlaps(n_triangles)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        closure['triangles'] = at_overlaps(sum_triangles) / closure['n_triangles']
+    if quadrilaterals:
+        degree = np.asarray(B.sum(axis=1)).ravel()
+        walks = B2.dot(B).multiply(B)
+        sum_quadrilaterals = (walks.multiply(O)
+                              - B2.dot(O).multiply(B)
+                              - BO.dot(B).multiply(B)
+                              - O.dot(B2).multiply(B))
+        n_quadrilaterals = at_overlaps(walks)
+        n_quadrilaterals[use] += 1 - degree[i] - degree[j]
+        closure['n_quadrilaterals'] = n_quadrilaterals
+        with np.errstate(invalid='ignore', divide='ignore'):
+            closure['quadrilaterals'] = (at_overlaps(sum_quadrilaterals)
+                                         / n_quadrilaterals)
+    for key in closure:
+        if key.startswith('n_'):
+            closure[key][~use] = 0
+        else:
+            closure[key][closure['n_' + key] == 0] = np.nan
+    log.info('Closure: checked the cycles through {0} overlaps in '
+             '{1:.2f}s'.format(len(table), time.time() - t_start))
+    return closure
+
+
+def closure_estimate(closure, min_cycles=CLOSURE_MIN_CYCLES):
+    """Returns the error of each offset as estimated from its cycles.
+
+    This is the mean closure error of the triangles through the overlap;
+    overlaps in fewer than `min_cycles` triangles are judged by their
+    quadrilaterals instead (if available), or not at all (NaN).
+
+    Parameters
+    ----------
+    closure : dict
+        As returned by `closure_errors`.
+    """
+    error = np.where(closure['n_triangles'] >= min_cycles,
+                     closure['triangles'], np.nan)
+    if 'quadrilaterals' in closure:
+        use_quadrilaterals = (np.isnan(error) &
+                              (closure['n_quadrilaterals'] >= min_cycles))
+        error[use_quadrilaterals] = closure['quadrilaterals'][use_quadrilaterals]
+    return error
+
+
+def inconsistent_overlaps(table, tolerance=CLOSURE_TOLERANCE,
+                          min_cycles=CLOSURE_MIN_CYCLES, quadrilaterals=True):
+    """Returns which overlaps have inconsistent offsets.
+
+    A bad offset also raises the closure errors of the good overlaps with
+    which it shares a cycle, albeit by a fraction. The worst offsets are
+    therefore removed first: in each pass, the overlaps with an error
+    above half the largest remaining error (or above `tolerance`) are
+    flagged, and the closure errors are recomputed without them, until no
+    error exceeds `tolerance`.
+
+    Parameters
+    ----------
+    table : `OverlapTable`
+
+    tolerance : float
+        Maximum error of a consistent offset (mag), cf. `closure_estimate`.
+
+    min_cycles, quadrilaterals : cf. `closure_estimate` and `closure_errors`
+
+    Returns
+    -------
+    inconsistent, error : array of bool, array of float
+        Which overlaps are inconsistent, and their estimated error
+        at the time they were flagged (or in the final pass otherwise).
+    """
+    inconsistent = np.zeros(len(table), dtype=bool)
+    error = np.nan * np.ones(len(table))
+    while True:
+        idx = np.where(~inconsistent)[0]
+        closure = closure_errors(table.subset(idx),
+                                 quadrilaterals=quadrilaterals)
+        myerror = np.abs(closure_estimate(closure, min_cycles))
+        error[idx] = myerror
+        if not np.nanmax(np.append(myerror, 0.)) > tolerance:
+            break
+        threshold = max(tolerance, np.nanmax(myerror) / 2.)
+        with np.errstate(invalid='ignore'):
+            inconsistent[idx[myerror > threshold]] = True
+    return inconsistent, error
+
+
+def glazebrook_matrix(rows, cols, weights, n):
+    """Returns the sparse matrix "A" of [Glazebrook 1994, Section 3.3].
+
+    Parameters
+    ----------
+    rows : array of int
+        Matrix index of the reference run of each overlap.
+
+    cols : array of int
+        Matrix index of the comparison run of each overlap,
+        or -1 if the comparison run is not part of the matrix (i.e. an anchor).
+
+    weights : array of float
+        Weight of each overlap.
+
+    n : int
+        Size of the matrix.
+
+    Returns
+    -------
+    A : `scipy.sparse.csr_matrix`
+    """
+    # On the diagonal, the matrix holds the negative sum of weights;
+    # runs without overlap data get -1 to keep the matrix non-singular
+    n_overlaps = np.bincount(rows, minlength=n)
+    diagonal = -np.bincount(rows, weights, minlength=n)
+    diagonal[n_overlaps == 0] = -1.0
+
+    # Off the diagonal, the matrix holds the weight where two runs overlap.
+    # Each overlap sets both A[i,j] and A[j,i] (symmetric matrix),
+    # and a later overlap between the same runs overwrites the weight.
+    use = (cols >= 0) & (cols != rows)
+    seq = np.arange(len(rows))[use]
+    i = np.concatenate((rows[use], cols[use]))
+    j = np.concatenate((cols[use], rows[use]))
+    w = np.concatenate((weights[use], weights[use]))
+    cell = i.astype(np.int64) * n + j
+    order = np.lexsort((np.concatenate((seq, seq)), cell))
+    is_last = np.ones(len(order), dtype=bool)
+    is_last[:-1] = cell[order][1:] != cell[order][:-1]
+    keep = order[is_last]
+
+    A = sparse.coo_matrix((np.concatenate((diagonal, w[keep])),
+                           (np.concatenate((np.arange(n), i[keep])),
+                            np.concatenate((np.arange(n), j[keep])))),
+                          shape=(n, n))
+    return A.tocsr()
+
+
+def solve_glazebrook_system(A, b, method=None, x0=None,
+                            preconditioner=None, tol=1e-10,
+                            factorization=None):
+    """Solves the sparse symmetric matrix equation A x = b.
+
+    Parameters
+    ----------
+    A : sparse matrix
+        Symmetric matrix, e.g. the matrix called "A" in [Glazebrook 1994],
+        which is negative (semi-)definite.
+
+    b : array of float
+
+    method : str {'lsqr', 'cg', 'minres', 'gmres', 'direct'}
+        'lsqr' is the robust least-squares solver used originally;
+        'cg' (conjugate gradient) and 'minres' exploit the symmetry of A;
+        'gmres' does not, but accepts a non-symmetric preconditioner;
+        'direct' uses a sparse LU factorization.
+        'cg' and 'direct' require every connected group of runs to overlap
+        with at least one anchor, otherwise the system is singular.
+        Defaults to `SOLVER`.
+
+    x0 : array of float (optional)
+        Initial guess, e.g. the solution of a previous pass.
+
+    preconditioner : str {'jacobi', 'ilu'}, False or `LinearOperator`
+        Preconditioner for 'cg', 'minres' and 'gmres'. 'jacobi' scales by
+        the diagonal; 'ilu' uses an incomplete LU factorization, which is
+        not symmetric and hence only accepted by 'gmres'; False disables
+        the preconditioning. A `LinearOperator` must approximate the
+        inverse of -A. Defaults to `PRECONDITIONER`.
+
+    tol : float
+        Relative tolerance of the iterative solvers.
+
+    factorization : object (optional)
+        A factorization returned in `info` by a previous call for the same
+        matrix, i.e. the LU factorization of A ('direct') or the incomplete
+        LU factorization of -A ('ilu' preconditioner), which is then reused.
+
+    Returns
+    -------
+    x, info : array of float, dict
+        The solution and a dictionary detailing the method, the number of
+        iterations, the relative residual, the wall time and the
+        factorization (if any).
+    """
+    t_start = time.time()
+    if method is None:
+        method = SOLVER
+    if preconditioner is None:
+        preconditioner = PRECONDITIONER
+    A = sparse.csr_matrix(A)
+    b = np.asarray(b, dtype=float)
+    if x0 is None:
+        x0 = np.zeros(len(b))
+    x0 = np.asarray(x0, dtype=float)
+    iterations = [0]
+
+    def count(xk):
+        iterations[0] += 1
+
+    if method == 'lsqr':
+        # lsqr does not accept an initial guess; solve for the correction
+        result = linalg.lsqr(A, b - A.dot(x0),
+                             atol=1e-8, iter_lim=1e6, show=False)
+        x = x0 + result[0]
+        iterations[0] = result[2]
+    elif method in ['cg', 'minres', 'gmres']:
+        # A is negative definite: solve the positive definite system -A x = -b
+        M = None
+        if isinstance(preconditioner, linalg.LinearOperator):
+            M = preconditioner
+        elif preconditioner == 'jacobi':
+            diagonal = -A.diagonal()
+            diagonal[diagonal == 0] = 1.0
+            M = linalg.LinearOperator(A.shape, matvec=lambda v: v / diagonal,
+                                      dtype=float)
+        elif preconditioner == 'ilu':
+            if method != 'gmres':
+                # CG and MINRES require a symmetric preconditioner
+                raise ValueError('The ilu preconditioner cannot be used '
+                                 'with {0}'.format(method))
+            if factorization is None:
+                factorization = linalg.spilu(-A.tocsc())
+            M = linalg.LinearOperator(A.shape, matvec=factorization.solve,
+                                      dtype=float)
+        solver = {'cg': linalg.cg, 'minres': linalg.minres,
+                  'gmres': linalg.gmres}[method]
+        x, status = solver(-A, -b, x0=x0, tol=tol, maxiter=100*len(b)+1000,
+                           M=M, callback=count)
+        if status != 0:
+            log.warning('Glazebrook: {0} did not converge '
+                        '(status {1})'.format(method, status))
+    elif method == 'direct':
+        if factorization is None:
+            factorization = linalg.splu(A.tocsc())
+        x = factorization.solve(b)
+    else:
+        raise ValueError('Unknown solver method: {0}'.format(method))
+
+    norm_b = np.linalg.norm(b)
+    residual = np.linalg.norm(A.dot(x) - b)
+    if norm_b > 0:
+        residual /= norm_b
+    info = {'method': method,
+            'iterations': iterations[0],
+            'residual': residual,
+            'time': time.time() - t_start,
+            'factorization': factorization}
+    log.debug('Glazebrook: {method} took {iterations} iterations and '
+              '{time:.2f}s (relative residual {residual:.2e})'.format(**info))
+    return x, info
+
+
+def _solve_component(arguments):
+    """Solves one connected component (used by `solve_components`)."""
+    A, b, method, x0, preconditioner, factorization = arguments
+    x, info = solve_glazebrook_system(A, b, method=method, x0=x0,
+                                      preconditioner=preconditioner,
+                                      factorization=factorization)
+    if multiprocessing.current_process().daemon:
+        # Factorizations cannot be passed between processes
+        info['factorization'] = None
+    return x, info
+
+
+def solve_components(A, b, anchored, method=None, x0=None,
+                     preconditioner=None, processes=None,
+                     factorizations=None):
+    """Solves A x = b independently for each connected component of A.
+
+    The overlap graph typically falls apart into many components, e.g.
+    isolated runs and islands cut off by gaps in the coverage.
+    The matrix is block-diagonal in these components, hence they can be
+    solved independently (and in parallel), which is faster than solving
+    the monolithic system.
+
+    Parameters
+    ----------
+    A : sparse matrix
+        Symmetric matrix, e.g. the matrix "A" in [Glazebrook 1994].
+
+    b : array of float
+
+    anchored : array of bool
+        True for each row (run) which overlaps with an anchor.
+        Components without any anchored run are reported, and are solved
+        with 'lsqr' because their system is singular.
+
+    method, x0, preconditioner : cf. `solve_glazebrook_system`
+
+    processes : int
+        Number of processes used to solve the components
+        (defaults to `PROCESSES`).
+
+    factorizations : dict (optional)
+        Factorizations returned in `info` by a previous call for the same
+        matrix, which are then reused.
+
+    Returns
+    -------
+    x, info : array of float, dict
+        The solution and a dictionary detailing the solve, including
+        'components' (the component label of each row) and 'unanchored'
+        (the labels of the components which lack an anchor).
+    """
+    t_start = time.time()
+    if method is None:
+        method = SOLVER
+    if processes is None:
+        processes = PROCESSES
+    A = sparse.csr_matrix(A)
+    b = np.asarray(b, dtype=float)
+    n = len(b)
+    if x0 is None:
+        x0 = np.zeros(n)
+    if factorizations is None:
+        factorizations = {}
+    n_components, labels = csgraph.connected_components(A, directed=False)
+    sizes = np.bincount(labels, minlength=n_components)
+    is_anchored = np.bincount(labels, np.asarray(anchored, dtype=float),
+                              minlength=n_components) > 0
+    unanchored = np.where(~is_anchored)[0]
+    log.info('Glazebrook: {0} connected components, the largest has {1} runs; '
+             '{2} components ({3} runs) contain no anchor'.format(
+                                               n_components,
+                                               sizes.max() if n > 0 else 0,
+                                               len(unanchored),
+                                               sizes[unanchored].sum()))
+
+    x = np.zeros(n)
+    # Single-run components are trivial: A[i,i] x[i] = b[i]
+    single = (sizes == 1)[labels]
+    x[single] = b[single] / A.diagonal()[single]
+
+    # Group the rows of the larger components
+    order = np.argsort(labels, kind='mergesort')
+    bounds = np.concatenate(([0], np.cumsum(sizes)))
+    jobs, members = [], []
+    for k in np.where(sizes > 1)[0]:
+        idx = order[bounds[k]:bounds[k+1]]
+        mymethod = method if is_anchored[k] else 'lsqr'
+        jobs.append((A[idx][:, idx], b[idx], mymethod, x0[idx],
+                     preconditioner, factorizations.get(k)))
+        members.append((k, idx))
+
+    # Daemonic processes (e.g. pool workers) are not allowed to have children
+    if multiprocessing.current_process().daemon:
+        processes = 1
+    if processes > 1 and len(jobs) > 1:
+        jobs = [job[:-1] + (None,) for job in jobs]
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_solve_component, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_solve_component(job) for job in jobs]
+
+    iterations = 0
+    newfactorizations = {}
+    for (k, idx), (myx, myinfo) in zip(members, results):
+        x[idx] = myx
+        iterations = max(iterations, myinfo['iterations'])
+        if myinfo['factorization'] is not None:
+            newfactorizations[k] = myinfo['factorization']
+
+    norm_b = np.linalg.norm(b)
+    residual = np.linalg.norm(A.dot(x) - b)
+    if norm_b > 0:
+        residual /= norm_b
+    info = {'method': method,
+            'iterations': iterations,
+            'residual': residual,
+            'time': time.time() - t_start,
+            'factorization': newfactorizations,
+            'components': labels,
+            'unanchored': unanchored}
+    return x, info
+
+
+def solve_hierarchical(A, b, groups, anchored, regularisation=NIGHT_REGULARISATION,
+                       tol=1e-10):
+    """Solves A x = b using a zeropoint per group plus a residual per run.
+
+    Most of the zeropoint variation in IPHAS is shared by all the runs
+    taken during the same night. The system is therefore first solved
+    at the level of the groups (i.e. nights), by restricting the solution to
+    x = P z, where the aggregation matrix P maps each run onto its group:
+
+        (P^T A P) z = P^T b
+
+    which has a few hundred rather than many thousand unknowns.
+    The per-run solution is then refined with a penalty on the deviation of
+    each run from its night zeropoint, regularisation/2 * |x - P z|^2:
+
+        (A - regularisation * I) x = b - regularisation * P z
+
+    using conjugate gradients, with P z as the initial guess and a two-level
+    preconditioner which combines the diagonal of the matrix with an exact
+    solve on the night level.
+
+    Parameters
+    ----------
+    A : sparse matrix
+        The matrix "A" in [Glazebrook 1994].
+
+    b : array of float
+
+    groups : array
+        Group label (e.g. night) of each row.
+
+    anchored : array of bool
+        True for each row (run) which overlaps with an anchor,
+        cf. `solve_components`.
+
+    regularisation : float
+        Strength of the penalty on the per-run residuals, in units of the
+        overlap weights; must be positive, which also keeps the system
+        non-singular for nights which are not tied to an anchor.
+
+    tol : float
+        Relative tolerance of the per-run solve.
+
+    Returns
+    -------
+    x, info : array of float, dict
+        As `solve_glazebrook_system`; info['coarse'] details the night-level
+        solve, and info['matrix'] is the regularised matrix.
+    """
+    if regularisation <= 0:
+        raise ValueError('regularisation must be positive')
+    t_start = time.time()
+    A = sparse.csr_matrix(A)
+    b = np.asarray(b, dtype=float)
+    n = len(b)
+    labels, idx = np.unique(groups, return_inverse=True)
+    P = sparse.csr_matrix((np.ones(n), (np.arange(n), idx)),
+                          shape=(n, len(labels)))
+
+    # Night level
+    coarse_A = (P.T.dot(A).dot(P)).tocsr()
+    coarse_anchored = np.bincount(idx, np.asarray(anchored, dtype=float),
+                                  minlength=len(labels)) > 0
+    z, coarse_info = solve_components(coarse_A, P.T.dot(b), coarse_anchored,
+                                      method='direct')
+    x0 = P.dot(z)
+    log.info('Glazebrook: solved for {0} night zeropoints in {1:.2f}s'.format(
+                                            len(labels), coarse_info['time']))
+
+    # Run level, using the nights as the coarse level of the preconditioner
+    A_reg = (A - regularisation * sparse.identity(n, format='csr')).tocsr()
+    diagonal = -A_reg.diagonal()
+    coarse_lu = linalg.splu(sparse.csc_matrix(-P.T.dot(A_reg).dot(P)))
+
+    def apply_preconditioner(v):
+        return v / diagonal + P.dot(coarse_lu.solve(P.T.dot(v)))
+
+    M = linalg.LinearOperator(A.shape, matvec=apply_preconditioner,
+                              dtype=float)
+    x, info = solve_glazebrook_system(A_reg, b - regularisation * x0,
+                                      method='cg', x0=x0, preconditioner=M,
+                                      tol=tol)
+    info['method'] = 'hierarchical'
+    info['time'] = time.time() - t_start
+    info['coarse'] = coarse_info
+    info['matrix'] = A_reg
+    return x, info
+
+
+def decompose_strips(l, stripwidth=constants.STRIPWIDTH,
+                     overlap=constants.FIELD_MAXDIST):
+    """Partitions runs into overlapping galactic longitude strips.
+
+    Parameters
+    ----------
+    l : array of float
+        Galactic longitude of each run.
+
+    stripwidth : float
+        Width of the strips, which start at multiples of `stripwidth`.
+
+    overlap : float
+        Each strip is extended by this amount on both sides.
+
+    Returns
+    -------
+    blocks : list of (array of int, array of bool)
+        The indices of the runs in each extended strip, and which of these
+        runs are owned by the strip, i.e. lie inside its nominal boundaries.
+        Every run is owned by exactly one strip.
+    """
+    l = np.asarray(l, dtype=float)
+    blocks = []
+    if len(l) == 0:
+        return blocks
+    first = stripwidth * np.floor(l.min() / stripwidth)
+    for lon1 in np.arange(first, l.max() + stripwidth, stripwidth):
+        lon2 = lon1 + stripwidth
+        idx = np.where((l >= lon1 - overlap) & (l < lon2 + overlap))[0]
+        owned = (l[idx] >= lon1) & (l[idx] < lon2)
+        if owned.any():
+            blocks.append((idx, owned))
+    return blocks
+
+
+def _solve_block(arguments):
+    """Solves one block of `solve_schwarz`, e.g. on a cluster engine."""
+    A, b, anchored, method, x0, preconditioner = arguments
+    x, info = solve_components(A, b, anchored, method=method, x0=x0,
+                               preconditioner=preconditioner, processes=1)
+    return x
+
+
+def solve_schwarz(A, b, l, anchored, method=None, x0=None,
+                  preconditioner=None, clusterview=None,
+                  tol=SCHWARZ_TOLERANCE, maxiter=SCHWARZ_MAXITER):
+    """Solves A x = b by domain decomposition in galactic longitude.
+
+    The runs are divided into the overlapping strips of `decompose_strips`.
+    In each iteration, the system of every strip is solved independently
+    (and in parallel), with the shifts of the runs outside the strip fixed
+    at their current values. Each run then takes the shift found by the
+    strip which owns it ("restricted additive Schwarz"). The iterations
+    stop once the shifts agree to within `tol`, i.e. when the runs near the
+    strip boundaries no longer change.
+
+    Parameters
+    ----------
+    A, b, anchored, method, x0, preconditioner : cf. `solve_components`
+
+    l : array of float
+        Galactic longitude of each row (run).
+
+    clusterview : IPython.parallel view (optional)
+        Used to solve the strips in parallel on the cluster;
+        they are solved one after the other if None.
+
+    tol : float
+        Maximum change in the shifts (mag) for convergence.
+
+    maxiter : int
+        Maximum number of iterations.
+
+    Returns
+    -------
+    x, info : array of float, dict
+        As `solve_glazebrook_system`; info['iterations'] refers to the
+        Schwarz iterations and info['blocks'] is the number of strips.
+    """
+    t_start = time.time()
+    if method is None:
+        method = SOLVER
+    A = sparse.csr_matrix(A)
+    b = np.asarray(b, dtype=float)
+    anchored = np.asarray(anchored, dtype=bool)
+    if x0 is None:
+        x0 = np.zeros(len(b))
+    x = np.array(x0, dtype=float)
+
+    blocks = []
+    for idx, owned in decompose_strips(l):
+        A_rows = A[idx]
+        A_block = A_rows[:, idx]
+        # Runs which overlap with runs outside the strip are tied to them
+        n_outside = np.diff(A_rows.indptr) - np.diff(A_block.indptr)
+        blocks.append((idx, owned, A_rows, A_block,
+                       anchored[idx] | (n_outside > 0)))
+    log.info('Glazebrook: solving {0} runs in {1} overlapping strips'.format(
+                                                        len(b), len(blocks)))
+
+    for iteration in range(1, maxiter + 1):
+        jobs = []
+        for idx, owned, A_rows, A_block, block_anchored in blocks:
+            # Move the terms of the runs outside the strip to the right side
+            rhs = b[idx] - (A_rows.dot(x) - A_block.dot(x[idx]))
+            jobs.append((A_block, rhs, block_anchored, method, x[idx],
+                         preconditioner))
+        if clusterview is None:
+            results = [_solve_block(job) for job in jobs]
+        else:
+            results = clusterview.map(_solve_block, jobs, block=True)
+
+        x_new = x.copy()
+        for (idx, owned, A_rows, A_block, block_anchored), myx in zip(blocks,
+                                                                     results):
+            x_new[idx[owned]] = myx[owned]
+        change = np.max(np.abs(x_new - x)) if len(x) > 0 else 0.
+        x = x_new
+        log.debug('Glazebrook: Schwarz iteration {0}: max change {1:.2e}'.format(
+                                                        iteration, change))
+        if change < tol:
+            break
+    else:
+        log.warning('Glazebrook: Schwarz iterations did not converge '
+                    '(max change {0:.2e})'.format(change))
+
+    norm_b = np.linalg.norm(b)
+    residual = np.linalg.norm(A.dot(x) - b)
+    if norm_b > 0:
+        residual /= norm_b
+    info = {'method': 'schwarz-' + method,
+            'iterations': iteration,
+            'residual': residual,
+            'time': time.time() - t_start,
+            'factorization': None,
+            'blocks': len(blocks)}
+    return x, info
+
+
+def log_solver_info(info):
+    """Logs the performance of a solve reported by the functions above."""
+    log.info('Glazebrook: {method} took {iterations} iterations and '
+             '{time:.2f}s (relative residual {residual:.2e})'.format(**info))
+
+
+def log_unanchored_components(runs, info):
+    """Warns about the runs in components of the overlap graph without anchors.
+
+    Parameters
+    ----------
+    runs : array of int
+        The runs corresponding to the rows of the solved system.
+
+    info : dict
+        As returned by `solve_components`.
+    """
+    for k in info['unanchored']:
+        myruns = runs[info['components'] == k]
+        log.warning('Glazebrook: component without anchor: '
+                    'runs {0}'.format(', '.join([str(r) for r in myruns])))
+
+
+def inverse_diagonal(N, method='stochastic', n_samples=UNCERTAINTY_SAMPLES,
+                     blocksize=1000, seed=0):
+    """Returns the diagonal of the inverse of a sparse positive definite matrix.
+
+    The dense inverse is never formed; instead, a single sparse LU
+    factorization is used to solve for a number of right-hand sides.
+
+    Parameters
+    ----------
+    N : sparse matrix
+
+    method : str {'stochastic', 'exact'}
+        'exact' solves for the columns of the identity matrix (in blocks
+        of `blocksize`), which costs one solve per row of N.
+        'stochastic' uses the estimator of [Hutchinson 1990]:
+        diag(N^-1) ~ mean(z * N^-1 z) over random vectors z with entries +/-1,
+        which costs `n_samples` solves. Its error decreases only as
+        1/sqrt(n_samples) and grows with the correlation between the
+        unknowns. For n_samples = 200, the resulting uncertainties of the
+        synthetic surveys of `scripts/benchmark_glazebrook.py --uncertainties`
+        (1000 and 10000 runs) are off by 1.5 per cent (median) and up to
+        15 per cent with 20 per cent anchors, and by 3.5 per cent (median)
+        and up to 30 per cent with 5 per cent anchors. Estimates which are
+        not positive are meaningless and are returned as NaN.
+
+    n_samples : int
+        Number of random vectors used by the 'stochastic' method.
+
+    Returns
+    -------
+    diagonal : array of float
+    """
+    n = N.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    lu = linalg.splu(sparse.csc_matrix(N))
+    if method == 'exact':
+        diagonal = np.empty(n)
+        for start in range(0, n, blocksize):
+            stop = min(n, start + blocksize)
+            rhs = np.zeros((n, stop - start))
+            rhs[np.arange(start, stop), np.arange(stop - start)] = 1.0
+            diagonal[start:stop] = lu.solve(rhs)[np.arange(start, stop),
+                                                 np.arange(stop - start)]
+        return diagonal
+    elif method == 'stochastic':
+        rng = np.random.RandomState(seed)
+        diagonal = np.zeros(n)
+        for start in range(0, n_samples, blocksize):
+            z = rng.randint(0, 2, (n, min(blocksize, n_samples - start)))
+            z = 2.0 * z - 1.0
+            diagonal += (z * lu.solve(z)).sum(axis=1)
+        diagonal /= n_samples
+        diagonal[diagonal <= 0] = np.nan
+        return diagonal
+    raise ValueError('Unknown method: {0}'.format(method))
+
+
+def glazebrook_uncertainties(A, rows, cols, residuals, weights,
+                             method=None, n_samples=UNCERTAINTY_SAMPLES):
+    """Returns the 1-sigma uncertainties of the solution of A x = b.
+
+    -A is the weighted normal matrix of the least-squares problem solved
+    by the Glazebrook algorithm, hence the covariance matrix of the solution
+    is sigma^2 * (-A)^-1, where the residual variance sigma^2 is estimated
+    from the weighted residuals of the overlap offsets.
+
+    Parameters
+    ----------
+    A : sparse matrix
+        The matrix "A" in [Glazebrook 1994].
+
+    rows, cols : arrays of int
+        Matrix indices of the two runs of each overlap, as used to
+        assemble A; `cols` is -1 if the second run is an anchor.
+
+    residuals, weights : arrays of float
+        The remaining offset and the weight of each overlap.
+
+    method, n_samples : cf. `inverse_diagonal`
+        The method defaults to `UNCERTAINTIES`, or 'exact' if that is None.
+        The 'exact' method is applied to each connected component of the
+        overlap graph separately, because its cost grows with the square of
+        the size of the system.
+
+    Returns
+    -------
+    errors : array of float
+        The uncertainties are NaN for the runs in components of the overlap
+        graph which do not contain an anchor, because their shifts are
+        undefined, and for failed 'stochastic' estimates.
+    """
+    if method is None:
+        method = UNCERTAINTIES or 'exact'
+    t_start = time.time()
+    A = sparse.csr_matrix(A)
+    n = A.shape[0]
+    anchored = np.bincount(rows[cols < 0], minlength=n) > 0
+    n_components, labels = csgraph.connected_components(A, directed=False)
+    is_anchored = np.bincount(labels, anchored.astype(float),
+                              minlength=n_components) > 0
+    idx = np.where(is_anchored[labels])[0]
+    # Overlaps between two non-anchors appear twice (as run1-run2 and
+    # as run2-run1), but are only a single measurement
+    multiplicity = np.where(cols < 0, 1.0, 0.5)
+    n_overlaps = multiplicity.sum()
+    chi2 = np.sum(multiplicity * weights * residuals**2)
+    sigma2 = chi2 / max(n_overlaps - len(idx), 1)
+
+    if method == 'exact':
+        order = idx[np.argsort(labels[idx], kind='mergesort')]
+        blocks = np.split(order, np.flatnonzero(np.diff(labels[order])) + 1)
+    else:
+        blocks = [idx]
+    errors = np.nan * np.ones(n)
+    for block in blocks:
+        diagonal = inverse_diagonal(-A[block][:, block], method=method,
+                                    n_samples=n_samples)
+        errors[block] = np.sqrt(sigma2 * diagonal)
+    n_failed = np.isnan(errors[idx]).sum()
+    if n_failed > 0:
+        log.warning('Glazebrook: {0} uncertainties could not be '
+                    'estimated'.format(n_failed))
+    log.info('Glazebrook: estimated the uncertainties of {0} shifts in '
+             '{1:.2f}s (residual sigma {2:.3f}, median error {3:.4f})'.format(
+                        len(idx), time.time() - t_start, np.sqrt(sigma2),
+                        np.nanmedian(errors[idx]) if len(idx) > 0 else np.nan))
+    return errors
+
+
 class Glazebrook(object):
     """Finds zeropoints which minimise the offsets between overlapping fields.
 
@@ -432,7 +1636,10 @@ class Glazebrook(object):
     def __init__(self, cal):
         self.cal = cal  # Calibration object
         self.runs = cal.get_runs()
-        self.overlaps = cal.get_overlaps()
+        if hasattr(cal, 'get_overlap_table'):
+            self.table = cal.get_overlap_table()
+        else:
+            self.table = OverlapTable.from_dict(self.runs, cal.get_overlaps())
         self.anchors = cal.get_anchors()
 
         self.nonanchors = ~self.anchors
@@ -440,60 +1647,119 @@ class Glazebrook(object):
         log.info('Glazebrook: there are {0} runs ({1} are anchors)'.format(
                                                             len(self.runs),
                                                             self.anchors.sum()))
+        self._flatten_overlaps()
+
+    def _flatten_overlaps(self):
+        """Converts the overlap table into flat arrays of matrix indices.
+
+        Sets the attributes `_rows` (the index of the non-anchor run),
+        `_cols` (the index of the overlapping run amongst the non-anchors,
+        or -1 if it is an anchor), `_offsets` and `_weights`,
+        with one entry per overlap, in the order of the non-anchor runs.
+        """
+        # Maps an index into self.runs onto the row of the matrix
+        matrix_index = np.cumsum(self.nonanchors) - 1
+        matrix_index[self.anchors] = -1
+        matrix_index = np.append(matrix_index, -1)  # idx2 = -1: unknown run
+        use = self.nonanchors[self.table.idx1]
+        self._rows = matrix_index[self.table.idx1[use]]
+        self._cols = matrix_index[self.table.idx2[use]]
+        self._offsets = self.table.offsets[use]
+        self._weights = self.table.weights[use]
 
     def _A(self):
         """Returns the matrix called "A" in [Glazebrook 1994, Section 3.3]
         """
-        log.info('Glazebrook: creating a sparse {0}x{0} matrix (might take a while)'.format(self.n_nonanchors))
-        A = sparse.lil_matrix((self.n_nonanchors,
-                               self.n_nonanchors))
-
-        nonanchorruns = self.runs[self.nonanchors]
-        # Loop over all non-anchors that make up the matrix
-        for i, run in enumerate(nonanchorruns):
-            
-            try:
-                # On the diagonal, the matrix holds the negative sum of weights
-                A[i, i] = -float(np.sum(self.overlaps[run]['weights']))
-
-                # Off the diagonal, the matrix holds the weight where two runs overlap
-                for run2, weight in zip(self.overlaps[run]['runs'],
-                                        self.overlaps[run]['weights']):
-                    idx_run2 = np.argwhere(run2 == nonanchorruns)
-                    if len(idx_run2) > 0:
-                        j = idx_run2[0]  # Index of the overlapping run
-                        A[i, j] = weight
-                        A[j, i] = weight  # Symmetric matrix
-            except KeyError:
-                log.warning('Glazebrook: no overlap data for run {0}'.format(run))
-                A[i, i] = -1.0
+        n = self.n_nonanchors
+        log.info('Glazebrook: creating a sparse {0}x{0} matrix'.format(n))
+        A = glazebrook_matrix(self._rows, self._cols, self._weights, n)
+        n_overlaps = np.bincount(self._rows, minlength=n)
+        for run in self.runs[self.nonanchors][n_overlaps == 0]:
+            log.warning('Glazebrook: no overlap data for run {0}'.format(run))
         return A
 
     def _b(self):
         """Returns the vector called "b" in [Glazebrook 1994, Section 3.3]
         """
-        b = np.zeros(self.n_nonanchors)
-        for i, run in enumerate(self.runs[self.nonanchors]):
-            try:
-                b[i] = np.sum(
-                              np.array(self.overlaps[run]['offsets']) *
-                              np.array(self.overlaps[run]['weights'])
-                              )
-            except KeyError:
-                log.warning('Glazebrook: no overlap data for run {0}'.format(run))
-                b[1] = 0.0
-        return b
-
-    def solve(self):
+        return np.bincount(self._rows, self._offsets * self._weights,
+                           minlength=self.n_nonanchors)
+
+    def solve(self, method=None, x0=None, preconditioner=None,
+              components=SPLIT_COMPONENTS, processes=None, nights=None,
+              longitudes=None, clusterview=None):
         """Returns the solution of the matrix equation.
+
+        Parameters
+        ----------
+        method : str {'lsqr', 'cg', 'minres', 'gmres', 'direct'}
+            Solver to use, cf. `solve_glazebrook_system`
+            (defaults to `SOLVER`).
+
+        x0 : array of float (optional)
+            Warm start, e.g. the shifts returned by a previous pass;
+            must have the same length as the runs (anchors are ignored).
+
+        preconditioner : str {'jacobi', 'ilu'} or False
+            Preconditioner for the iterative methods
+            (defaults to `PRECONDITIONER`).
+
+        components : bool
+            If True, solve each connected component of the overlap graph
+            independently, cf. `solve_components`.
+
+        processes : int
+            Number of processes used to solve the components.
+
+        nights : array (optional)
+            Night of each run. If given, the shifts are modelled as a
+            zeropoint per night plus a regularised residual per run,
+            cf. `solve_hierarchical`; `method` and `components` are ignored.
+
+        longitudes : array of float (optional)
+            Galactic longitude of each run. If given, the system is solved
+            in overlapping longitude strips, cf. `solve_schwarz`.
+
+        clusterview : IPython.parallel view (optional)
+            Used to solve the longitude strips in parallel.
+
+        Returns
+        -------
+        shifts : array of float
+            Shifts to be *added* to the runs; zero for the anchors.
         """
         self.A = self._A()
         self.b = self._b()
         log.info('Glazebrook: now solving the matrix equation')
-        # Note: there may be alternative algorithms
-        # which are faster for symmetric matrices.
-        self.solution = linalg.lsqr(self.A, self.b,
-                                    atol=1e-8, iter_lim=1e6, show=False)
+        if x0 is not None:
+            x0 = np.asarray(x0)[self.nonanchors]
+        anchored = np.bincount(self._rows[self._cols < 0],
+                               minlength=self.n_nonanchors) > 0
+        if nights is not None:
+            x, self.info = solve_hierarchical(
+                                    self.A, self.b,
+                                    np.asarray(nights)[self.nonanchors],
+                                    anchored)
+            # The uncertainties follow from the regularised matrix
+            self.A = self.info['matrix']
+        elif longitudes is not None:
+            x, self.info = solve_schwarz(
+                                    self.A, self.b,
+                                    np.asarray(longitudes)[self.nonanchors],
+                                    anchored, method=method, x0=x0,
+                                    preconditioner=preconditioner,
+                                    clusterview=clusterview)
+        elif components:
+            x, self.info = solve_components(self.A, self.b, anchored,
+                                            method=method, x0=x0,
+                                            preconditioner=preconditioner,
+                                            processes=processes)
+            log_unanchored_components(self.runs[self.nonanchors], self.info)
+        else:
+            x, self.info = solve_glazebrook_system(self.A, self.b,
+                                                   method=method, x0=x0,
+                                                   preconditioner=preconditioner)
+        log_solver_info(self.info)
+        self.solution = (x, self.info)
         log.info('Glazebrook: solution found')
         log.info('Glazebrook: mean shift = {0} +/- {1}'.format(
                                             np.mean(self.solution[0]),
@@ -504,6 +1770,744 @@ class Glazebrook(object):
         return shifts
 
 
+    def uncertainties(self, method=None, n_samples=UNCERTAINTY_SAMPLES):
+        """Returns the 1-sigma uncertainties of the shifts found by `solve`.
+
+        The uncertainties of the anchors are zero; those of runs which are not
+        tied to any anchor are NaN (cf. `glazebrook_uncertainties`).
+        """
+        x = self.solution[0]
+        x_other = np.append(x, 0.0)[self._cols]
+        residuals = self._offsets + x[self._rows] - x_other
+        errors = np.zeros(len(self.runs))
+        errors[self.nonanchors] = glazebrook_uncertainties(
+                                            self.A, self._rows, self._cols,
+                                            residuals, self._weights,
+                                            method=method,
+                                            n_samples=n_samples)
+        return errors
+
+
+def restricted_preconditioner(A, solve_base, n_base, position):
+    """Returns a preconditioner for A built from a related, factorized system.
+
+    Anchoring runs removes rows and columns from the Glazebrook matrix and
+    freeing anchors adds a few, hence the factorization of one system is a
+    good preconditioner for conjugate gradients on another.
+
+    Parameters
+    ----------
+    A : sparse matrix
+        The (negative definite) matrix to be preconditioned.
+
+    solve_base : callable
+        Applies the inverse of the *negated* factorized matrix to a vector.
+
+    n_base : int
+        Size of the factorized system.
+
+    position : array of int
+        Index of each row of A in the factorized system (-1 if absent);
+        these rows are preconditioned by their diagonal instead.
+
+    Returns
+    -------
+    M : `linalg.LinearOperator`
+        Approximates inv(-A), cf. `solve_glazebrook_system`.
+    """
+    in_base = position >= 0
+    diagonal = -A.diagonal()
+
+    def apply_preconditioner(v):
+        y = v / diagonal
+        z = np.zeros(n_base)
+        z[position[in_base]] = v[in_base]
+        y[in_base] = solve_base(z)[position[in_base]]
+        return y
+
+    return linalg.LinearOperator(A.shape, matvec=apply_preconditioner,
+                                 dtype=float)
+
+
+class CalibrationSession(object):
+    """Keeps the assembled Glazebrook system of a band between passes.
+
+    `Glazebrook` rebuilds and solves the matrix equation from scratch every
+    time. This class instead assembles the system once for all runs, as if
+    none of them were anchors. Turning runs into anchors then amounts to
+    removing their rows and columns, and a change of the calibration shifts
+    only requires the right-hand side to be updated.
+    Factorizations are cached per set of anchors, such that re-solving with
+    the same anchors (e.g. after changing the shifts) is nearly free.
+    When the anchors change, the most recent factorization (restricted to
+    the new set of free runs) preconditions conjugate gradients instead of
+    factorizing again, as long as every component retains an anchor.
+
+    Usage
+    -----
+    >>> session = CalibrationSession(cal)
+    >>> cal.add_shifts(session.solve())
+    >>> # What if we blacklisted some anchors?
+    >>> anchors = cal.anchors & ~np.in1d(cal.runs, blacklisted_runs)
+    >>> shifts = session.solve(anchors=anchors)
+    """
+
+    def __init__(self, cal, method=None, preconditioner=None,
+                 components=SPLIT_COMPONENTS, processes=None,
+                 nights=None, longitudes=None, clusterview=None):
+        self.cal = cal  # Calibration object
+        self.method = method
+        self.preconditioner = preconditioner
+        self.components = components
+        self.processes = processes
+        # Night of each run, to solve the hierarchical model instead
+        self.nights = nights
+        # Longitude of each run, to solve in strips (on the cluster) instead
+        self.longitudes = longitudes
+        self.clusterview = clusterview
+        self.runs = cal.get_runs()
+        if hasattr(cal, 'get_overlap_table'):
+            table = cal.get_overlap_table()
+        else:
+            table = OverlapTable.from_dict(self.runs, cal.get_overlaps())
+        # The shifts which have been taken into account in the table
+        self.shifts0 = np.array(self._current_shifts(), dtype=float)
+
+        n = len(self.runs)
+        log.info('CalibrationSession: assembling the system for {0} runs'.format(n))
+        self.A_full = glazebrook_matrix(table.idx1, table.idx2,
+                                        table.weights, n)
+        known = table.idx2 >= 0
+        self._idx1, self._idx2 = table.idx1, table.idx2
+        self._offsets, self._weights = table.offsets, table.weights
+        self.W = sparse.coo_matrix((table.weights[known],
+                                    (table.idx1[known], table.idx2[known])),
+                                   shape=(n, n)).tocsr()
+        self.weightsum = np.bincount(table.idx1, table.weights, minlength=n)
+        self.b0 = np.bincount(table.idx1, table.offsets * table.weights,
+                              minlength=n)
+        self._cache = {}
+        self._last = None
+        # The most recent factorization: (position of each run, solve)
+        self._base = None
+        self.info = None
+
+    def _current_shifts(self):
+        """Returns the current shifts of the Calibration object."""
+        if hasattr(self.cal, 'shifts'):
+            return self.cal.shifts
+        return np.zeros(len(self.runs))
+
+    def anchored(self, nonanchors):
+        """Returns which runs overlap with an anchor (or a run outside the system).
+        """
+        fixed = np.append(~nonanchors, True)[self._idx2]
+        return np.bincount(self._idx1[fixed], minlength=len(self.runs)) > 0
+
+    def rhs(self, shifts=None):
+        """Returns the vector "b" for all runs, given the shifts.
+
+        Parameters
+        ----------
+        shifts : array of float (optional)
+            Defaults to the current shifts of the Calibration object.
+        """
+        if shifts is None:
+            shifts = self._current_shifts()
+        # Correcting the offsets (run1 - run2) for the change in shifts
+        # means adding (delta_run1 - delta_run2) to each offset
+        delta = np.asarray(shifts, dtype=float) - self.shifts0
+        return self.b0 + self.weightsum * delta - self.W.dot(delta)
+
+    def system(self, anchors=None, shifts=None):
+        """Returns the matrix equation for a given set of anchors and shifts.
+
+        Parameters
+        ----------
+        anchors : array of bool (optional)
+            Defaults to the current anchors of the Calibration object.
+
+        shifts : array of float (optional)
+            Defaults to the current shifts of the Calibration object.
+
+        Returns
+        -------
+        A, b : sparse matrix, array
+            The matrix and vector of `Glazebrook._A` and `Glazebrook._b`.
+        """
+        if anchors is None:
+            anchors = self.cal.get_anchors()
+        nonanchors = ~np.asarray(anchors, dtype=bool)
+        b_full = self.rhs(shifts)
+        key = nonanchors.tostring()
+        if key not in self._cache:
+            idx = np.where(nonanchors)[0]
+            self._cache[key] = {'A': self.A_full[idx][:, idx],
+                                'factorization': None}
+        return self._cache[key]['A'], b_full[nonanchors]
+
+    def solve(self, anchors=None, shifts=None, method=None, x0=None):
+        """Returns the shifts which minimise the remaining overlap offsets.
+
+        Parameters
+        ----------
+        anchors : array of bool (optional)
+            Defaults to the current anchors of the Calibration object.
+
+        shifts : array of float (optional)
+            Defaults to the current shifts of the Calibration object.
+
+        method : str (optional)
+            Solver to use, cf. `solve_glazebrook_system`.
+
+        x0 : array of float (optional)
+            Warm start; must have the same length as the runs.
+
+        Returns
+        -------
+        shifts : array of float
+            Shifts to be *added* to the runs; zero for the anchors.
+        """
+        if anchors is None:
+            anchors = self.cal.get_anchors()
+        if method is None:
+            method = self.method if self.method is not None else SOLVER
+        preconditioner = self.preconditioner
+        if preconditioner is None:
+            preconditioner = PRECONDITIONER
+        nonanchors = ~np.asarray(anchors, dtype=bool)
+        log.info('CalibrationSession: solving for {0} runs '
+                 '({1} are anchors)'.format(len(self.runs),
+                                            (~nonanchors).sum()))
+        A, b = self.system(anchors, shifts)
+        cache = self._cache[nonanchors.tostring()]
+        if x0 is not None:
+            x0 = np.asarray(x0)[nonanchors]
+        # Factorizations can only be reused with the same method
+        factorization = None
+        if cache['factorization'] is not None:
+            if cache['factorization'][0] == (method, preconditioner,
+                                             self.components):
+                factorization = cache['factorization'][1]
+        # Otherwise precondition with the factorization of other anchors
+        reuse = (factorization is None and self._base is not None
+                 and method in ('direct', 'cg', 'minres')
+                 and not isinstance(preconditioner, linalg.LinearOperator)
+                 and self.nights is None and self.longitudes is None
+                 and self.is_anchored(A, nonanchors))
+        if reuse:
+            position, solve_base = self._base
+            M = restricted_preconditioner(A, solve_base, (position >= 0).sum(),
+                                          position[nonanchors])
+            x, self.info = solve_glazebrook_system(A, b, method='cg', x0=x0,
+                                                   preconditioner=M)
+            log.info('CalibrationSession: reused the factorization of '
+                     '{0} runs'.format((position >= 0).sum()))
+        elif self.nights is not None:
+            x, self.info = solve_hierarchical(
+                                        A, b,
+                                        np.asarray(self.nights)[nonanchors],
+                                        self.anchored(nonanchors)[nonanchors])
+            # The uncertainties follow from the regularised matrix
+            cache['regularised'] = self.info['matrix']
+        elif self.longitudes is not None:
+            x, self.info = solve_schwarz(
+                                        A, b,
+                                        np.asarray(self.longitudes)[nonanchors],
+                                        self.anchored(nonanchors)[nonanchors],
+                                        method=method, x0=x0,
+                                        preconditioner=preconditioner,
+                                        clusterview=self.clusterview)
+        elif self.components:
+            anchored = self.anchored(nonanchors)
+            x, self.info = solve_components(
+                                        A, b, anchored[nonanchors],
+                                        method=method, x0=x0,
+                                        preconditioner=preconditioner,
+                                        processes=self.processes,
+                                        factorizations=factorization)
+            log_unanchored_components(self.runs[nonanchors], self.info)
+        else:
+            x, self.info = solve_glazebrook_system(
+                                        A, b, method=method, x0=x0,
+                                        preconditioner=preconditioner,
+                                        factorization=factorization)
+        log_solver_info(self.info)
+        if self.info['factorization']:
+            cache['factorization'] = ((method, preconditioner,
+                                       self.components),
+                                      self.info['factorization'])
+            if method == 'direct':
+                self._base = self._factorized_base(A, nonanchors)
+
+        result = np.zeros(len(self.runs))
+        result[nonanchors] = x
+        if shifts is None:
+            shifts = self._current_shifts()
+        self._last = (nonanchors, np.asarray(shifts, dtype=float) + result)
+        return result
+
+    def is_anchored(self, A, nonanchors):
+        """Returns whether every component of the system contains an anchor."""
+        n_components, labels = csgraph.connected_components(A, directed=False)
+        anchored = self.anchored(nonanchors)[nonanchors]
+        return np.all(np.bincount(labels, anchored.astype(float),
+                                  minlength=n_components) > 0)
+
+    def _factorized_base(self, A, nonanchors):
+        """Returns the position of each run in A and the solve of inv(-A),
+        given the 'direct' factorization(s) in `self.info`."""
+        position = -np.ones(len(self.runs), dtype=int)
+        position[nonanchors] = np.arange(nonanchors.sum())
+        factorization = self.info['factorization']
+        if isinstance(factorization, dict):
+            # One factorization per component; the other rows are diagonal
+            labels = self.info['components']
+            members = [(np.where(labels == k)[0], lu)
+                       for k, lu in factorization.items()]
+            diagonal = -A.diagonal()
+
+            def solve_base(z):
+                y = z / diagonal
+                for idx, lu in members:
+                    y[idx] = -lu.solve(z[idx])
+                return y
+        else:
+            def solve_base(z):
+                return -factorization.solve(z)
+        return position, solve_base
+
+    def uncertainties(self, method=None, n_samples=UNCERTAINTY_SAMPLES):
+        """Returns the 1-sigma uncertainties of the last solution.
+
+        The uncertainties of the anchors are zero; those of runs which are not
+        tied to any anchor are NaN (cf. `glazebrook_uncertainties`).
+        """
+        nonanchors, solved_shifts = self._last
+        cache = self._cache[nonanchors.tostring()]
+        A = cache.get('regularised', cache['A'])
+        # Remaining offsets after applying the solution
+        delta = np.append(solved_shifts - self.shifts0, 0.0)
+        residuals = self._offsets + delta[self._idx1] - delta[self._idx2]
+        # Matrix indices, cf. `Glazebrook._flatten_overlaps`
+        matrix_index = np.cumsum(nonanchors) - 1
+        matrix_index[~nonanchors] = -1
+        matrix_index = np.append(matrix_index, -1)
+        use = nonanchors[self._idx1]
+        errors = np.zeros(len(self.runs))
+        errors[nonanchors] = glazebrook_uncertainties(
+                                        A,
+                                        matrix_index[self._idx1[use]],
+                                        matrix_index[self._idx2[use]],
+                                        residuals[use], self._weights[use],
+                                        method=method, n_samples=n_samples)
+        return errors
+
+
+class AnchorStability(object):
+    """Quantifies how sensitive the shifts are to the choice of anchors.
+
+    The calibration is re-solved many times with random subsets of the
+    anchors dropped, and the scatter of each shift across these replicates
+    is reported. The replicates are cheap because dropping anchors only
+    adds a few rows to the system which has been solved already: the matrix
+    is taken from a `CalibrationSession`, and the sparse LU factorization of
+    the system with all anchors serves as the preconditioner of conjugate
+    gradients, which then converges in a handful of iterations.
+
+    Usage
+    -----
+    >>> stability = AnchorStability(session)
+    >>> scatter = stability.run(mode='jackknife', n_replicates=100)
+    >>> stability.write('stability-r.csv')
+    """
+
+    def __init__(self, session, anchors=None, shifts=None, tol=1e-4):
+        self.session = session
+        # Relative tolerance of the replicates; the errors are then orders
+        # of magnitude below the scatter being measured
+        self.tol = tol
+        self.runs = session.runs
+        if anchors is None:
+            anchors = session.cal.get_anchors()
+        if shifts is None:
+            shifts = session._current_shifts()
+        self.anchors = np.array(anchors, dtype=bool)
+        self.shifts = np.array(shifts, dtype=float)
+        self.A_full = sparse.csr_matrix(session.A_full)
+        self.b_full = session.rhs(shifts)
+        self.scatter = None
+
+        # Runs in components without an anchor have no defined shift,
+        # and remain so when anchors are dropped
+        nonanchors = ~self.anchors
+        base = np.where(nonanchors)[0]
+        A_base = self.A_full[base][:, base]
+        n_components, labels = csgraph.connected_components(A_base,
+                                                            directed=False)
+        anchored = session.anchored(nonanchors)[base]
+        is_anchored = np.bincount(labels, anchored.astype(float),
+                                  minlength=n_components) > 0
+        self.excluded = np.zeros(len(self.runs), dtype=bool)
+        self.excluded[base[~is_anchored[labels]]] = True
+        base = base[is_anchored[labels]]
+
+        # Position of each run in the factorized system (-1 if absent)
+        self.position = -np.ones(len(self.runs), dtype=int)
+        self.position[base] = np.arange(len(base))
+        self.n_base = len(base)
+        log.info('AnchorStability: factorizing the system of {0} runs'.format(
+                                                                    len(base)))
+        self.lu = linalg.splu(sparse.csc_matrix(-A_base[is_anchored[labels]]
+                                                 [:, is_anchored[labels]]))
+
+    def solve_replicate(self, dropped):
+        """Returns the change in shifts when the given anchors are dropped.
+
+        Parameters
+        ----------
+        dropped : array of int
+            Indices (into `runs`) of the anchors to drop.
+
+        Returns
+        -------
+        delta, iterations : array of float, int
+            Shifts to be added to the current shifts; NaN for the runs
+            which are no longer tied to any anchor.
+        """
+        nonanchors = ~self.anchors
+        nonanchors[dropped] = True
+        idx = np.where(nonanchors & ~self.excluded)[0]
+        A = self.A_full[idx][:, idx]
+        anchored = self.session.anchored(nonanchors)[idx]
+        n_components, labels = csgraph.connected_components(A, directed=False)
+        is_anchored = np.bincount(labels, anchored.astype(float),
+                                  minlength=n_components) > 0
+        delta = np.zeros(len(self.runs))
+        delta[self.excluded] = np.nan
+        delta[idx[~is_anchored[labels]]] = np.nan
+        idx = idx[is_anchored[labels]]
+        A = A[is_anchored[labels]][:, is_anchored[labels]]
+
+        # The factorization covers the runs which were already free;
+        # the dropped anchors are preconditioned by their diagonal
+        M = restricted_preconditioner(A, self.lu.solve, self.n_base,
+                                      self.position[idx])
+        x, info = solve_glazebrook_system(A, self.b_full[idx], method='cg',
+                                          preconditioner=M, tol=self.tol)
+        delta[idx] = x
+        return delta, info['iterations']
+
+    def replicates(self, mode=STABILITY_MODE, n_replicates=100, seed=0):
+        """Returns the anchors to drop in each replicate.
+
+        Parameters
+        ----------
+        mode : str {'bootstrap', 'jackknife'}
+            'bootstrap' draws the anchors with replacement and drops those
+            which are not drawn (about a third); 'jackknife' divides the
+            anchors into `n_replicates` random groups and drops one group
+            at a time.
+
+        Returns
+        -------
+        dropped : list of arrays of int
+            Indices (into `runs`) of the dropped anchors.
+        """
+        rng = np.random.RandomState(seed)
+        anchor_idx = np.where(self.anchors)[0]
+        n = len(anchor_idx)
+        if mode == 'bootstrap':
+            return [np.setdiff1d(anchor_idx, anchor_idx[rng.randint(0, n, n)])
+                    for k in range(n_replicates)]
+        elif mode == 'jackknife':
+            groups = rng.permutation(n) % n_replicates
+            return [anchor_idx[groups == k] for k in range(n_replicates)]
+        raise ValueError('Unknown mode: {0}'.format(mode))
+
+    def run(self, mode=STABILITY_MODE, n_replicates=100, processes=None,
+            seed=0):
+        """Solves the replicates and returns the scatter of each shift.
+
+        Parameters
+        ----------
+        mode : str {'bootstrap', 'jackknife'}
+            cf. `replicates`.
+
+        n_replicates : int
+
+        processes : int (optional)
+            Number of processes used to solve the replicates
+            (defaults to the number of CPUs).
+
+        Returns
+        -------
+        scatter : array of float
+            Standard deviation of each shift across the replicates (with the
+            jackknife correction in 'jackknife' mode); zero for the anchors
+            which were never dropped, NaN for runs which were not tied to
+            any anchor in at least two replicates.
+        """
+        t_start = time.time()
+        dropped = self.replicates(mode, n_replicates, seed)
+        log.info('AnchorStability: solving {0} {1} replicates'.format(
+                                                    n_replicates, mode))
+        # Workers inherit this object, including the factorization,
+        # which cannot be pickled
+        global _STABILITY
+        _STABILITY = self
+        pool = None
+        try:
+            if multiprocessing.current_process().daemon or processes == 1:
+                results = [_solve_stability_replicate(d) for d in dropped]
+            else:
+                pool = multiprocessing.Pool(processes)
+                results = pool.imap_unordered(_solve_stability_replicate,
+                                              dropped)
+            total = np.zeros(len(self.runs))
+            total_sq = np.zeros(len(self.runs))
+            count = np.zeros(len(self.runs))
+            iterations = 0
+            for delta, myiterations in results:
+                valid = np.isfinite(delta)
+                total[valid] += delta[valid]
+                total_sq[valid] += delta[valid]**2
+                count += valid
+                iterations += myiterations
+        finally:
+            _STABILITY = None
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            variance = np.maximum(total_sq / count - mean**2, 0)
+            if mode == 'jackknife':
+                scatter = np.sqrt((count - 1) * variance)
+            else:
+                scatter = np.sqrt(variance * count / (count - 1))
+        scatter[count < 2] = np.nan
+        self.scatter, self.count = scatter, count.astype(int)
+        log.info('AnchorStability: {0} replicates took {1:.1f}s '
+                 '({2:.1f} iterations each); median scatter {3:.4f}, '
+                 'max {4:.4f}'.format(n_replicates, time.time() - t_start,
+                                      iterations / max(n_replicates, 1),
+                                      np.nanmedian(scatter),
+                                      np.nanmax(scatter)))
+        return scatter
+
+    def write(self, filename):
+        """Writes the shifts and their scatter across replicates to a csv file.
+        """
+        log.info('Writing results to {0}'.format(filename))
+        with open(filename, 'w') as out:
+            out.write('run,shift,is_anchor,scatter,n\n')
+            for i in range(len(self.runs)):
+                out.write('{0},{1},{2},{3},{4}\n'.format(self.runs[i],
+                                                       self.shifts[i],
+                                                       self.anchors[i],
+                                                       self.scatter[i],
+                                                       self.count[i]))
+
+
+# The AnchorStability object being analysed, inherited by the pool workers
+_STABILITY = None
+
+
+def _solve_stability_replicate(dropped):
+    """Solves one replicate of `AnchorStability.run` (in a pool worker)."""
+    return _STABILITY.solve_replicate(dropped)
+
+
+class JointGlazebrook(object):
+    """Calibrates the r, i and H-alpha bands in a single matrix equation.
+
+    The serial scheme (`calibrate_band`) copies the r-band shifts to H-alpha
+    and solves each band several times, fixing APASS outliers as anchors
+    in between. Instead, this class stacks the Glazebrook systems of all
+    bands into one block-sparse system, which is solved once:
+
+    * the runs of the same field (i.e. the same night) in r and H-alpha are
+      coupled by a soft constraint shift(r) = shift(ha), with weight
+      `coupling` (or `anchor_coupling` for the H-alpha anchors);
+    * runs in r and i with a trusted APASS comparison are softly tied to
+      the APASS shift with weight `apass_weight`.
+
+    The r - H-alpha colour offset itself is already enforced by the
+    zeropoints (cf. `detections.sanitise_zeropoints`), which is why the
+    coupling acts on the shifts. The soft terms enter the system as extra
+    "overlaps", i.e. they are treated as measurements like the offsets
+    between overlapping fields.
+
+    Usage
+    -----
+    >>> joint = JointGlazebrook([Calibration('r'), Calibration('i'),
+    ...                          Calibration('ha')])
+    >>> shifts = joint.solve()  # dict of shift arrays, keyed by band
+    """
+
+    def __init__(self, cals, coupling=JOINT_COUPLING,
+                 anchor_coupling=JOINT_ANCHOR_COUPLING,
+                 apass_weight=JOINT_APASS_WEIGHT):
+        self.cals = OrderedDict([(cal.band, cal) for cal in cals])
+        self.bands = list(self.cals.keys())
+        self.coupling = coupling
+        self.anchor_coupling = anchor_coupling
+        self.apass_weight = apass_weight
+        # H-alpha has no hard anchors: its anchors are coupled strongly to r
+        self.nonanchors = OrderedDict()
+        for band in self.bands:
+            if band == 'ha':
+                self.nonanchors[band] = np.ones(len(self.cals[band].runs),
+                                                dtype=bool)
+            else:
+                self.nonanchors[band] = ~self.cals[band].get_anchors()
+        # Matrix index of the first non-anchor run of each band
+        self.start = OrderedDict()
+        n = 0
+        for band in self.bands:
+            self.start[band] = n
+            n += self.nonanchors[band].sum()
+        self.n = n
+        self._flatten()
+
+    def _matrix_index(self, band):
+        """Maps the runs of a band onto the matrix, with -1 for the anchors."""
+        nonanchors = self.nonanchors[band]
+        index = np.cumsum(nonanchors) - 1 + self.start[band]
+        index[~nonanchors] = -1
+        return index
+
+    def _flatten(self):
+        """Collects the overlaps and the soft constraints as flat arrays.
+
+        Sets `_rows`, `_cols`, `_offsets`, `_weights` as in
+        `Glazebrook._flatten_overlaps`, together with `_kind`, which labels
+        each entry as an overlap (0), an APASS prior (1) or a coupling (2).
+        """
+        rows, cols, offsets, weights, kind = [], [], [], [], []
+
+        def append(myrows, mycols, myoffsets, myweights, mykind):
+            rows.append(myrows)
+            cols.append(mycols)
+            offsets.append(np.asarray(myoffsets, dtype=float))
+            weights.append(np.asarray(myweights, dtype=float))
+            kind.append(mykind * np.ones(len(myrows), dtype=int))
+
+        for band in self.bands:
+            cal = self.cals[band]
+            if hasattr(cal, 'get_overlap_table'):
+                table = cal.get_overlap_table()
+            else:
+                table = OverlapTable.from_dict(cal.runs, cal.get_overlaps())
+            index = np.append(self._matrix_index(band), -1)
+            use = self.nonanchors[band][table.idx1]
+            append(index[table.idx1[use]], index[table.idx2[use]],
+                   table.offsets[use], table.weights[use], 0)
+
+            # The APASS prior: shift + x = apass_shift
+            if band in ['r', 'i']:
+                prior = (self.nonanchors[band] &
+                         (cal.apass_matches >= MIN_MATCHES) &
+                         np.isfinite(cal.apass_shifts) &
+                         ~np.in1d(cal.runs, MANUALLY_SHIFTED))
+                log.info('JointGlazebrook: {0} APASS priors in {1}'.format(
+                                                        prior.sum(), band))
+                append(index[:-1][prior], -np.ones(prior.sum(), dtype=int),
+                       (cal.shifts - cal.apass_shifts)[prior],
+                       self.apass_weight * np.ones(prior.sum()), 1)
+
+        # The coupling between the r and H-alpha runs of the same field:
+        # both bands are ordered like IPHASQC[IPHASQC_COND_RELEASE]
+        if 'r' in self.cals and 'ha' in self.cals:
+            r, ha = self.cals['r'], self.cals['ha']
+            index_r = self._matrix_index('r')
+            index_ha = self._matrix_index('ha')
+            strength = np.where(ha.get_anchors(), self.anchor_coupling,
+                                self.coupling)
+            delta = r.shifts - ha.shifts
+            # Each coupling is entered from both sides, unless r is an anchor
+            use = index_r >= 0
+            append(index_r[use], index_ha[use], delta[use], strength[use], 2)
+            append(index_ha, index_r, -delta, strength, 2)
+
+        self._rows = np.concatenate(rows)
+        self._cols = np.concatenate(cols)
+        self._offsets = np.concatenate(offsets)
+        self._weights = np.concatenate(weights)
+        self._kind = np.concatenate(kind)
+
+    def _A(self):
+        """Returns the block-sparse matrix of the joint system."""
+        log.info('JointGlazebrook: creating a sparse {0}x{0} matrix'.format(
+                                                                    self.n))
+        return glazebrook_matrix(self._rows, self._cols, self._weights,
+                                 self.n)
+
+    def _b(self):
+        """Returns the right-hand side of the joint system."""
+        return np.bincount(self._rows, self._offsets * self._weights,
+                           minlength=self.n)
+
+    def _split(self, x):
+        """Splits a solution vector into arrays of shifts per band."""
+        result = OrderedDict()
+        for band in self.bands:
+            shifts = np.zeros(len(self.cals[band].runs))
+            start = self.start[band]
+            stop = start + self.nonanchors[band].sum()
+            shifts[self.nonanchors[band]] = x[start:stop]
+            result[band] = shifts
+        return result
+
+    def solve(self, method='cg', preconditioner=None, processes=None):
+        """Returns the shifts which minimise the joint system.
+
+        Parameters
+        ----------
+        method, preconditioner, processes : cf. `solve_components`
+
+        Returns
+        -------
+        shifts : dict
+            Shifts to be *added* to the runs of each band; zero for the
+            anchors.
+        """
+        self.A = self._A()
+        self.b = self._b()
+        log.info('JointGlazebrook: now solving the matrix equation')
+        # Rows tied to an anchor, to an APASS prior or to an r-band anchor
+        anchored = np.bincount(self._rows[self._cols < 0],
+                               minlength=self.n) > 0
+        x, self.info = solve_components(self.A, self.b, anchored,
+                                        method=method,
+                                        preconditioner=preconditioner,
+                                        processes=processes)
+        runs = np.concatenate([self.cals[band].runs[self.nonanchors[band]]
+                               for band in self.bands])
+        log_unanchored_components(runs, self.info)
+        log_solver_info(self.info)
+        self.solution = (x, self.info)
+        return self._split(x)
+
+    def uncertainties(self, method=None, n_samples=UNCERTAINTY_SAMPLES):
+        """Returns the 1-sigma uncertainties of the shifts found by `solve`.
+
+        The residual variance is estimated from the overlaps only, i.e.
+        the soft constraints do not contribute to it.
+        """
+        x = self.solution[0]
+        x_other = np.append(x, 0.0)[self._cols]
+        residuals = self._offsets + x[self._rows] - x_other
+        # The soft constraints remain in the matrix, but not in chi2
+        residuals[self._kind > 0] = 0.0
+        errors = glazebrook_uncertainties(self.A, self._rows, self._cols,
+                                          residuals, self._weights,
+                                          method=method, n_samples=n_samples)
+        return self._split(errors)
+
+
 class CalibrationApplicator(object):
     """Applies the calibration to a bandmerged catalogue.
 
@@ -511,18 +2515,22 @@ class CalibrationApplicator(object):
     directory, apply the appropriate calibration shifts as listed in 
     'calibration/calibration-{r,i,ha}.csv', and then write the updated 
     catalogue to a new directory called 'bandmerged-calibrated'.
+
+    Parameters
+    ----------
+    method : str {'numpy', 'stilts'}
+        Apply the shifts in-process using numpy, or using stilts tpipe.
     """
 
-    def __init__(self):
+    def __init__(self, method=APPLICATOR):
+        assert(method in ['numpy', 'stilts'])
+        self.method = method
         self.datadir = constants.PATH_BANDMERGED
         self.outdir = constants.PATH_BANDMERGED_CALIBRATED
         util.setup_dir(self.outdir)
 
-        # Read the calibration information into a dictionary
-        self.calib = {}
-        for band in constants.BANDS:
-            calib_file = os.path.join(CALIBDIR, 'calibration-{0}.csv'.format(band))
-            self.calib[band] = ascii.read(calib_file)
+        # The calibration shifts are loaded once per process
+        self.store = shiftstore.get_store()
 
     def run(self, filename):
         #for filename in os.listdir(self.datadir):
@@ -549,48 +2557,45 @@ class CalibrationApplicator(object):
         shifts : dictionary {'r':shift_r, 'i': shift_i, 'ha': shift_ha}
             Shifts to add to the magnitudes to calibrate a field.
         """
-        idx_field = np.argwhere(IPHASQC.field('id') == fieldid)[0]
-
-        shifts = {}
-        for band in constants.BANDS:
-            cond_run = (self.calib[band]['run']
-                        == IPHASQC.field('run_' + band)[idx_field])
-            if cond_run.sum() > 0:
-                shifts[band] = self.calib[band]['shift'][cond_run][0]
-            else:
-                log.warning('No shift for %s' % fieldid)
-                shifts[band] = 0.0
-
-        log.debug("Shifts for {0}: {1}".format(fieldid, shifts))
-        return shifts            
+        return self.store.get_field_shifts(fieldid)
 
     def calibrate(self, filename):
         path_in = os.path.join(self.datadir, filename)
         path_out = os.path.join(self.outdir, filename)
         shifts = self.get_shifts(filename)
+        if self.method == 'numpy':
+            return self._calibrate_numpy(path_in, path_out, shifts)
+        return self._calibrate_stilts(path_in, path_out, shifts)
+
+    def _calibrate_numpy(self, path_in, path_out, shifts):
+        """Adds the shifts to the magnitude columns using numpy.
 
+        The catalogue is memory-mapped and modified in place (the input file
+        is not affected) and is written with an unchanged header, hence the
+        schema is preserved. Null magnitudes are NaN and remain so.
+        """
+        with fits.open(path_in, memmap=True) as hdulist:
+            data = hdulist[1].data
+            for band in constants.BANDS:
+                for col in MAGNITUDE_COLUMNS[band]:
+                    mags = data.field(col)
+                    # Single-precision, like toFloat() in stilts
+                    mags[:] = (mags + shifts[band]).astype(np.float32)
+            data.field('rmi')[:] = data.field('r') - data.field('i')
+            data.field('rmha')[:] = data.field('r') - data.field('ha')
+            hdulist.writeto(path_out, overwrite=True)
+        return 0
+
+    def _calibrate_stilts(self, path_in, path_out, shifts):
+        """Adds the shifts to the magnitude columns using stilts tpipe."""
         param = {'stilts': constants.STILTS,
                  'filename_in': path_in,
                  'filename_out': path_out,
-                 'cmd': """'replacecol r "toFloat(r  + {r})"; \
-                            replacecol rPeakMag "toFloat(rPeakMag  + {r})"; \
-                            replacecol rAperMag1 "toFloat(rAperMag1  + {r})"; \
-                            replacecol rAperMag3 "toFloat(rAperMag3  + {r})"; \
-                            replacecol i "toFloat(i  + {i})"; \
-                            replacecol iPeakMag "toFloat(iPeakMag  + {i})"; \
-                            replacecol iAperMag1 "toFloat(iAperMag1  + {i})"; \
-                            replacecol iAperMag3 "toFloat(iAperMag3  + {i})"; \
-                            replacecol ha "toFloat(ha  + {ha})"; \
-                            replacecol haPeakMag "toFloat(haPeakMag  + {ha})"; \
-                            replacecol haAperMag1 "toFloat(haAperMag1  + {ha})"; \
-                            replacecol haAperMag3 "toFloat(haAperMag3  + {ha})"; \
-                            replacecol rmi "toFloat(r-i)"; \
-                            replacecol rmha "toFloat(r-ha)"; \
-                           '""".format(**shifts)}
+                 'cmd': "'{0}'".format(shiftstore.calibration_cmd(shifts))}
 
         cmd = '{stilts} tpipe cmd={cmd} in={filename_in} out={filename_out}'.format(**param)
         log.debug(cmd)
-        status = os.system(cmd)
+        status = stiltsworker.system(cmd)
         log.info('stilts status: '+str(status))
         return status
 
@@ -629,7 +2634,7 @@ def calibrate_one(filename):
 ## Plotting colour-colour diagrams of anchors and fields for quality control
 ##
 
-def plot_anchors():
+def plot_anchors(processes=None, multipage=False):
     """Plots diagrams of the anchors."""
     # Setup output directory
     inputdir = constants.PATH_BANDMERGED
@@ -641,82 +2646,176 @@ def plot_anchors():
     fields = [util.run2field(myrun, 'r') for myrun in anchor_runs]
     # Distribute work
     log.info('Starting to plot {0} anchors'.format(len(fields)))
-    from multiprocessing import Pool
-    mypool = Pool(4)
-    mypool.map(plot_field, zip(fields,
-                               [inputdir]*len(fields),
-                               [outputdir]*len(fields),
-                               [{'r':0.0, 'i':0.0, 'ha':0.0}]*len(fields)))
+    plot_fields(fields, inputdir, outputdir,
+                [{'r':0.0, 'i':0.0, 'ha':0.0}]*len(fields),
+                processes=processes, multipage=multipage)
 
 
-"""
-def plot_calibrated_fields():
-    # Plots diagrams of all fields after calibration.
-    # Setup output directory
-    inputdir = constants.PATH_BANDMERGED_CALIBRATED
+def plot_calibrated_fields(processes=None, multipage=False):
+    """Plots diagrams of all fields after calibration."""
+    inputdir = constants.PATH_BANDMERGED
     outputdir = os.path.join(CALIBDIR, 'diagrams')
     util.setup_dir(outputdir)
-    # Which fields to plot?
     fields = IPHASQC['id'][IPHASQC_COND_RELEASE]
-    # Distribute work
-    from multiprocessing import Pool
-    mypool = Pool(4)
-    mypool.map(plot_field, zip(fields,
-                               [inputdir]*len(fields),
-                               [outputdir]*len(fields)))
-"""
+    fieldshifts = shiftstore.get_store().field_shifts(fields)
+    shifts = [dict((band, np.nan_to_num(row[band])) for band in constants.BANDS)
+              for row in fieldshifts]
+    log.info('Starting to plot {0} fields'.format(len(fields)))
+    plot_fields(fields, inputdir, outputdir, shifts,
+                processes=processes, multipage=multipage)
 
-def plot_calibrated_fields():
-    inputdir = constants.PATH_BANDMERGED
-    outputdir = os.path.join(CALIBDIR, 'diagrams')
-    util.setup_dir(outputdir)
-    ca = CalibrationApplicator()
-    args = []
-    for i, field in enumerate(IPHASQC['id'][IPHASQC_COND_RELEASE]):
-        args.append((field, inputdir, outputdir, ca.get_field_shifts(field)))
-    
-    log.info('Starting to plot {0} anchors'.format(len(args)))
-    from multiprocessing import Pool
-    mypool = Pool(4)
-    mypool.map(plot_field, args)
+
+class ColourColourRenderer(object):
+    """Draws (r-i, r-Ha) diagrams of many fields using a single figure.
+
+    The figure, the static artists (main sequence and reddening line)
+    and the scatter artist are created once; rendering a field merely
+    replaces the points and the title.
+
+    Parameters
+    ----------
+    pdf : `matplotlib.backends.backend_pdf.PdfPages` (optional)
+        If given, each diagram is also appended as a page to this file.
+    """
+
+    def __init__(self, pdf=None):
+        self.pdf = pdf
+        self.fig = Figure(figsize=(6,4))
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.fig.subplots_adjust(0.15, 0.15, 0.95, 0.9)
+        p = self.fig.add_subplot(111)
+        self.title = p.set_title('', fontsize=14)
+        self.scatter = p.scatter([], [],
+                                 alpha=0.4, edgecolor="red", facecolor="red",
+                                 lw=0, s=1, marker='o')
+        # Main sequence
+        p.plot([0.029, 0.212, 0.368, 0.445, 0.903, 1.829],
+               [0.001, 0.114, 0.204, 0.278, 0.499, 0.889],
+               c='black', lw=0.5)
+        # A-type reddening line
+        p.plot([0.029, 0.699, 1.352, 1.991, 2.616],
+               [0.001, 0.199, 0.355, 0.468, 0.544],
+               c='black', lw=0.5)
+        p.set_xlim([-0.2, +2.0])
+        p.set_ylim([-0.1, +1.3])
+        p.set_xlabel('r-i')
+        p.set_ylabel('r-Ha')
+
+    def render(self, field, rmi, rmha, shifts, path=None):
+        """Draws the diagram of a field and writes it to `path`.
+
+        The colours are expected to be calibrated already (cf. `read_colours`);
+        the shifts are only quoted in the title.
+        """
+        self.title.set_text('{0} (r {1:+.2f}, i {2:+.2f}, ha {3:+.2f})'.format(
+                            field, shifts['r'], shifts['i'], shifts['ha']))
+        self.scatter.set_offsets(np.column_stack((rmi, rmha)))
+        if path is not None:
+            self.canvas.print_figure(path, dpi=200)
+        if self.pdf is not None:
+            self.pdf.savefig(self.fig)
+
+
+def read_colours(path, shifts=None):
+    """Returns (r-i, r-Ha) of the reliable stars in a bandmerged catalogue.
+
+    Only the columns needed are read from the memory-mapped file, and the
+    calibration shifts are applied on read (cf. `shiftstore.read_calibrated`).
+    """
+    d = shiftstore.read_calibrated(path, ['r', 'rmi', 'rmha', 'errBits', 'pStar'],
+                                   shifts=shifts)
+    mask_use = ((d['r'] < 19.0)
+                & (d['errBits'] == 0)
+                & (d['pStar'] > 0.2))
+    return np.array(d['rmi'][mask_use]), np.array(d['rmha'][mask_use])
+
+
+def _plot_field_chunk(arguments):
+    """Plots a chunk of fields (used by `plot_fields`)."""
+    fields, inputdir, outputdir, shifts, pdfpath = arguments
+    pdf = None
+    if pdfpath is not None:
+        from matplotlib.backends.backend_pdf import PdfPages
+        pdf = PdfPages(pdfpath)
+    renderer = ColourColourRenderer(pdf=pdf)
+    try:
+        for field, myshifts in zip(fields, shifts):
+            try:
+                rmi, rmha = read_colours(os.path.join(inputdir, field+'.fits'),
+                                         myshifts)
+            except IOError as e:
+                log.warning('{0}: cannot plot: {1}'.format(field, e))
+                continue
+            if pdf is None:
+                path = os.path.join(outputdir, field+'.jpg')
+            else:
+                path = None
+            renderer.render(field, rmi, rmha, myshifts, path)
+            if path is not None:
+                log.debug('Wrote {0}'.format(path))
+    finally:
+        if pdf is not None:
+            pdf.close()
+            log.info('Wrote {0}'.format(pdfpath))
+    return len(fields)
+
+
+def plot_fields(fields, inputdir, outputdir, shifts,
+                processes=None, multipage=False, chunksize=100):
+    """Plots colour-colour diagrams of many fields in parallel.
+
+    Parameters
+    ----------
+    fields : list of str
+        Field identifiers.
+
+    inputdir, outputdir : str
+        Location of the bandmerged catalogues and the diagrams.
+
+    shifts : list of dict
+        Calibration shifts of each field, with keys 'r', 'i' and 'ha'.
+
+    processes : int (optional)
+        Number of processes; defaults to the number of cores.
+
+    multipage : bool
+        If True, write the diagrams to multi-page PDF files (one per chunk
+        of fields) rather than one JPG per field.
+
+    chunksize : int
+        Number of fields plotted by a single task.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    jobs = []
+    for i in range(0, len(fields), chunksize):
+        if multipage:
+            pdfpath = os.path.join(outputdir,
+                                   'diagrams-{0:05d}.pdf'.format(i // chunksize))
+        else:
+            pdfpath = None
+        jobs.append((fields[i:i+chunksize], inputdir, outputdir,
+                     shifts[i:i+chunksize], pdfpath))
+    t_start = time.time()
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(_plot_field_chunk, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            _plot_field_chunk(job)
+    log.info('Plotted {0} fields in {1:.0f}s'.format(len(fields),
+                                                     time.time() - t_start))
 
 
 def plot_field(arguments):
+    """Plots the colour-colour diagram of a single field."""
     field, inputdir, outputdir, shifts = arguments
-    shift_rmi = shifts['r'] - shifts['i']
-    shift_rmha = shifts['r'] - shifts['ha']
-    # Initiate figure
-    fig = plt.figure(figsize=(6,4))
-    fig.subplots_adjust(0.15, 0.15, 0.95, 0.9)
-    p = fig.add_subplot(111)
-    p.set_title('{0} (r {1:+.2f}, i {2:+.2f}, ha {3:+.2f})'.format(
-                field, shifts['r'], shifts['i'], shifts['ha']),
-                fontsize=14)
-    # Load colours from the bandmerged catalogue
-    d = fits.getdata(os.path.join(inputdir, field+'.fits'), 1)
-    mask_use = (d['r'] < 19.0) & (d['errBits'] == 0) & (d['pStar'] > 0.2)
-    p.scatter(d['rmi'][mask_use] + shift_rmi,
-              d['rmha'][mask_use] + shift_rmha,
-              alpha=0.4, edgecolor="red", facecolor="red",
-              lw=0, s=1, marker='o')
-    # Main sequence
-    p.plot([0.029, 0.212, 0.368, 0.445, 0.903, 1.829],
-           [0.001, 0.114, 0.204, 0.278, 0.499, 0.889],
-           c='black', lw=0.5)
-    # A-type reddening line
-    p.plot([0.029, 0.699, 1.352, 1.991, 2.616],
-           [0.001, 0.199, 0.355, 0.468, 0.544],
-           c='black', lw=0.5)
-
-    p.set_xlim([-0.2, +2.0])
-    p.set_ylim([-0.1, +1.3])
-    p.set_xlabel('r-i')
-    p.set_ylabel('r-Ha')
-    # Write to disk
-    path = os.path.join(outputdir, field+'.jpg')
-    fig.savefig(path, dpi=200)
-    plt.close()
-    log.info('Wrote {0}'.format(path))
+    _plot_field_chunk(([field], inputdir, outputdir, [shifts], None))
+    log.info('Wrote {0}'.format(os.path.join(outputdir, field+'.jpg')))
 
 
 
@@ -725,13 +2824,38 @@ def plot_field(arguments):
 ## The functions which drive the zeropoint calibration
 ##
 
-def calibrate_band(band='r'):
+def check_closure(cal):
+    """Runs `Calibration.check_closure` if `CLOSURE_CHECK` is enabled."""
+    if CLOSURE_CHECK:
+        cal.check_closure(os.path.join(CALIBDIR,
+                                       'closure-{0}.csv'.format(cal.band)))
+
+
+def calibration_session(cal, clusterview=None):
+    """Returns a CalibrationSession configured by `NIGHT_MODEL` and
+    `DOMAIN_DECOMPOSITION`."""
+    nights, longitudes = None, None
+    if NIGHT_MODEL:
+        nights = cal.nights
+    elif DOMAIN_DECOMPOSITION:
+        longitudes = cal.longitudes
+    return CalibrationSession(cal, nights=nights, longitudes=longitudes,
+                              clusterview=clusterview)
+
+
+def calibrate_band(band='r', plots=PLOTS, clusterview=None):
     """Calibrate a single band.
 
     Parameters
     ----------
     band : one of 'r', 'i', 'ha'
 
+    plots : str {'none', 'async', 'sync'}
+        How to produce the diagnostic plots of each step, cf. `PlotQueue`.
+
+    clusterview : IPython.parallel view (optional)
+        Used to solve the longitude strips if `DOMAIN_DECOMPOSITION` is set.
+
     Returns
     -------
     cal : Calibration class
@@ -744,63 +2868,35 @@ def calibrate_band(band='r'):
     if band == 'ha':
         # We use the r-band calibration as the baseline for H-alpha
         rcalib = ascii.read(os.path.join(CALIBDIR, 'calibration-r.csv'))
-        cal = Calibration(band)
+        cal = Calibration(band, plots=plots)
+        check_closure(cal)
         cal.shifts = rcalib['shift']
         cal.evaluate('step1', 'H-alpha with r-band shifts')
 
         # We do run one iteration of Glazebrook using special H-alpha anchors
-        overlaps = cal.get_overlaps()
-        solver = Glazebrook(cal)
-        shifts = solver.solve()
+        session = calibration_session(cal, clusterview)
+        shifts = session.solve()
         cal.add_shifts(shifts)
+        if UNCERTAINTIES:
+            cal.errors = session.uncertainties()
         cal.evaluate('step2', 'H-alpha after Glazebrook')
 
         cal.write_anchor_list(os.path.join(CALIBDIR, 'anchors-{0}-initial.csv'.format(band)))
 
     else:
     
-        cal = Calibration(band)
-
-
-        # Hack: take account of exposure time changes
-        MANUALLY_SHIFTED = [364687,
-            368903, 368904, 368923, 368925,
-            369998, 370073, 370076, 370084,
-            370095, 371652, 371695, 372557,
-            372684, 372707, 372751, 372771,
-            372880, 373106, 373111, 373698,
-            374904, 376449, 376461, 376463,
-            376481, 376493, 376530, 401548,
-            401566, 402270, 407505, 407580,
-            407586, 407598, 408287, 408296,
-            413548, 413566, 413596, 413783,
-            413804, 414671, 418169, 418190,
-            418196, 418310, 427588, 427820,
-            457662, 460468, 470277, 470592,
-            470822, 470852, 474652, 476050,
-            476131, 478320, 478434, 478609,
-            478645, 478720, 478795, 537478,
-            537544, 537550, 537565, 537623,
-            538318, 538354, 538366, 538406,
-            538595, 538601, 538759, 540932,
-            541185, 541717, 541948, 568871,
-            568892, 568937, 568970, 568982,
-            569666, 569768, 569816, 
-            570005, 570559, 570601, 570754,
-            571311, 571362, 571377, 571704,
-            597412, 597469, 597778, 598536,
-            598710, 598865, 598880, 647562,
-            649761, 686153, 686264, 687199,
-            687757, 702703, 702724, 702769,
-            703360, 703408, 703741]
-        IS_MANUALLY_SHIFTED = np.array([myrun in MANUALLY_SHIFTED for myrun in cal.runs])
+        cal = Calibration(band, plots=plots)
+        check_closure(cal)
+
+        IS_MANUALLY_SHIFTED = np.in1d(cal.runs, MANUALLY_SHIFTED)
 
         cal.evaluate('step1', '{0} - uncalibrated'.format(band))
         cal.write_anchor_list(os.path.join(CALIBDIR, 'anchors-{0}-initial.csv'.format(band)))
 
         # Glazebrook: first pass (minimizes overlap offsets)
-        solver = Glazebrook(cal)
-        shifts = solver.solve()
+        # The session keeps the assembled system for the later passes
+        session = calibration_session(cal, clusterview)
+        shifts = session.solve()
         cal.add_shifts(shifts)
         cal.evaluate('step2', '{0} - step 2: Glazebrook pass 1'.format(band))    
         # Write the used anchors to a csv file
@@ -821,8 +2917,7 @@ def calibrate_band(band='r'):
                                        band, cond_extra_anchors.sum()))
 
         # Run Glazebrook again with the newly added anchors
-        solver = Glazebrook(cal)    
-        shifts = solver.solve()
+        shifts = session.solve()
         cal.add_shifts(shifts)
         cal.evaluate('step4', '{0} - step 4 - Glazebrook pass 2'.format(band))
 
@@ -840,9 +2935,10 @@ def calibrate_band(band='r'):
         cal.evaluate('step5', '{0} - step 5: anchor all APASS fields'.format(band))
 
         # Run Glazebrook again with the newly added anchors
-        solver = Glazebrook(cal)    
-        shifts = solver.solve()
+        shifts = session.solve()
         cal.add_shifts( shifts )
+        if UNCERTAINTIES:
+            cal.errors = session.uncertainties()
         cal.evaluate('step6', '{0} - step 6 - Glazebrook pass 3'.format(band))
         
 
@@ -850,35 +2946,159 @@ def calibrate_band(band='r'):
     filename = os.path.join(CALIBDIR, 'calibration-{0}.csv'.format(band))
     cal.write(filename)
 
+    if STABILITY_REPLICATES > 0:
+        stability = AnchorStability(session)
+        stability.run(n_replicates=STABILITY_REPLICATES)
+        stability.write(os.path.join(CALIBDIR,
+                                     'stability-{0}.csv'.format(band)))
+
+    # Wait for the diagnostic plots still being rendered in the background
+    cal.plots.join()
     return cal
 
 
-def calibrate():
-    """Calibrates all bands in the survey.
+def _calibrate_band_task(band, plots=PLOTS):
+    """Calibrates a band in a worker process, returning the output filename.
 
-    Produces files called "calibration{r,i,ha}.csv" which tabulate
-    the zeropoint shifts to be *added* to each exposure.
+    The Calibration object itself is not returned, because it is large and
+    only needed inside the worker; the results are communicated via the
+    "calibration-{band}.csv" files instead.
     """
-    # Make sure the output directory exists
-    util.setup_dir(CALIBDIR)
-    # Calibrate each band in the survey
-    for band in constants.BANDS:
-        calibrate_band(band)
+    calibrate_band(band, plots=plots)
+    return os.path.join(CALIBDIR, 'calibration-{0}.csv'.format(band))
+
+
+def calibrate_joint(plots=PLOTS):
+    """Calibrates the r, i and H-alpha bands in a single solve.
+
+    This is the alternative to calling `calibrate_band` for each band,
+    cf. `JointGlazebrook`.
+
+    Returns
+    -------
+    cals : dict
+        Calibration objects keyed by band.
+    """
+    log.info('Starting the joint calibration of the r, i and ha bands')
+    cals = [Calibration(band, plots=plots) for band in constants.BANDS]
+    for cal in cals:
+        cal.evaluate('step1', '{0} - uncalibrated'.format(cal.band))
+        cal.write_anchor_list(os.path.join(CALIBDIR,
+                              'anchors-{0}-initial.csv'.format(cal.band)))
+
+    joint = JointGlazebrook(cals)
+    shifts = joint.solve()
+    if UNCERTAINTIES:
+        errors = joint.uncertainties()
+    for cal in cals:
+        cal.add_shifts(shifts[cal.band])
+        if UNCERTAINTIES:
+            cal.errors = errors[cal.band]
+        cal.evaluate('joint', '{0} - joint Glazebrook'.format(cal.band))
+        cal.write(os.path.join(CALIBDIR,
+                               'calibration-{0}.csv'.format(cal.band)))
+    for cal in cals:
+        cal.plots.join()
+    return dict([(cal.band, cal) for cal in cals])
+
+
+def plot_calibration():
+    """Produces the quality control diagrams of the calibration."""
+    plot_anchors()
+    plot_calibrated_fields()
 
 
-def calibrate_multiprocessing():
+def calibrate(parallel=True, plots=PLOTS, joint=False, clusterview=None,
+              diagrams=False):
     """Calibrates all bands in the survey.
 
     Produces files called "calibration{r,i,ha}.csv" which tabulate
-    the zeropoint shifts to be *added* to each exposure.
+    the zeropoint shifts to be *added* to each exposure, and the binary
+    copy of these shifts used by `dr2.shiftstore`.
+
+    The bands are calibrated as a small dependency graph: r and i are
+    independent and are calibrated concurrently, while H-alpha depends only
+    on the r-band result and starts as soon as "calibration-r.csv" has been
+    written. The wall-clock time is hence roughly that of the slowest band.
+
+    Parameters
+    ----------
+    parallel : bool
+        If False, the bands are calibrated one after the other.
+
+    plots : str {'none', 'async', 'sync'}
+        How to produce the diagnostic plots of each step, cf. `PlotQueue`.
+        For backwards compatibility, True and False are interpreted as
+        'async' and 'none'.
+
+    joint : bool
+        If True, all bands are calibrated in a single block-sparse solve
+        (cf. `calibrate_joint`) rather than band by band.
+
+    clusterview : IPython.parallel view (optional)
+        If `DOMAIN_DECOMPOSITION` is set, the bands are calibrated one after
+        the other, with the longitude strips solved in parallel on the
+        cluster instead.
+
+    diagrams : bool
+        If True, the quality control diagrams of the survey are produced
+        as well (cf. `plot_calibration`), which is a lot of extra work.
+        With `plots` 'async', they are produced by a separate process which
+        is started once the calibration is complete; with 'sync' they are
+        produced before returning; with 'none' they are skipped.
+
+    Returns
+    -------
+    process : `multiprocessing.Process` or None
+        The plotting process if `diagrams` is True and `plots` is 'async',
+        which the caller may `join()`.
     """
+    if plots is True:
+        plots = 'async'
+    elif plots is False:
+        plots = 'none'
+    assert(plots in ['none', 'async', 'sync'])
     # Make sure the output directory exists
     util.setup_dir(CALIBDIR)
-    # Calibrate each band in the survey
-    from multiprocessing import Pool
-    pool = Pool(2)
-    pool.map(calibrate_band, ['r', 'i'])
-    calibrate_band('ha') # H-alpha depends on output of r
+    if joint:
+        calibrate_joint(plots=plots)
+    elif DOMAIN_DECOMPOSITION and clusterview is not None:
+        # The cluster client cannot be shared with worker processes
+        for band in constants.BANDS:
+            calibrate_band(band, plots=plots, clusterview=clusterview)
+    elif parallel:
+        pool = multiprocessing.Pool(2)
+        try:
+            jobs = {}
+            for band in ['r', 'i']:
+                jobs[band] = pool.apply_async(_calibrate_band_task,
+                                             (band, plots))
+            # H-alpha depends on the output of r, but not on i
+            log.info('Calibration: wrote {0}'.format(jobs['r'].get()))
+            jobs['ha'] = pool.apply_async(_calibrate_band_task, ('ha', plots))
+            for band in ['i', 'ha']:
+                log.info('Calibration: wrote {0}'.format(jobs[band].get()))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for band in constants.BANDS:
+            calibrate_band(band, plots=plots)
+    # Binary copy of the shifts used by the later steps of the pipeline
+    shiftstore.write_store(CALIBDIR)
+
+    if not diagrams or plots == 'none':
+        return None
+    if plots == 'sync':
+        plot_calibration()
+        return None
+    # Plotting does not block the pipeline; a non-daemonic process is used
+    # because the plotting functions distribute their work over a Pool
+    process = multiprocessing.Process(target=plot_calibration,
+                                      name='calibration-plots')
+    process.start()
+    log.info('Calibration: plotting in process {0}'.format(process.pid))
+    return process
 
 
 ################################
@@ -887,8 +3107,6 @@ def calibrate_multiprocessing():
 
 if __name__ == '__main__':
     log.setLevel('DEBUG')
-    calibrate()
-    #calibrate_multiprocessing()
+    plotting = calibrate(plots='async', diagrams=True)
     #calibrate_band('ha')
-    plot_anchors()
-    plot_calibrated_fields()
+    plotting.join()
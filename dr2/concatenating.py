@@ -19,6 +19,7 @@ from astropy import log
 import constants
 from constants import IPHASQC
 import util
+import stiltsworker
 
 __author__ = 'Geert Barentsen'
 __copyright__ = 'Copyright, The Authors'
@@ -201,7 +202,7 @@ class Concatenator(object):
         cmd = '{stilts} tcat {in} icmd={icmd} countrows=true lazy=true out={out}'
         mycmd = cmd.format(**param)
         log.info(mycmd)
-        status = os.system(mycmd)
+        status = stiltsworker.system(mycmd)
         log.info('concat: '+str(status))
 
         # zip
@@ -268,7 +269,7 @@ def merge_light_catalogue():
     cmd = '{stilts} tcat {in} countrows=true lazy=true ofmt=colfits-basic out={out}'
     mycmd = cmd.format(**param)
     log.debug(mycmd)
-    status = os.system(mycmd)
+    status = stiltsworker.system(mycmd)
     log.info('concat: '+str(status))
 
     return status
@@ -51,6 +51,8 @@ IPHASQC_COND_RELEASE = (IPHASQC['is_best'] & (IPHASQC['qflag'] != 'D'))
 # How to execute stilts?
 STILTS = 'nice java -Xmx2000M -XX:+UseConcMarkSweepGC -jar {0}'.format(
                                 os.path.join(LIBDIR, 'stilts.jar'))
+# Run the stilts commands in a persistent JVM? (cf. dr2.stiltsworker)
+STILTS_SERVER = False
 
 # How to execute funpack?
 FUNPACK = '/home/gb/bin/cfitsio3310/bin/funpack'
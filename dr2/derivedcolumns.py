@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Computes the columns of the band-merged catalogues using numpy.
+
+This module is a vectorised port of `lib/stilts-band-merging.cmd`, i.e. the
+`ocmd` steps applied by stilts to the band-matched table, such that the
+band-merging can be carried out without a JVM (cf. `bandmerging.BandMerge`).
+
+The formulas follow the stilts expressions, including the Java arithmetic:
+expressions on two single-precision columns are evaluated in single precision,
+comparisons and functions in double precision, and `toFloat`/`toShort`
+round the results. The null semantics of stilts are mirrored as well:
+a value is null if it is NaN (floats), equal to the TNULL value of its
+column (integers, cf. `NULL_VALUES`) or blank (strings).
+
+The functions operate on whole columns and accept any mapping of column
+names onto arrays which uses the band-merged column names (e.g. `rClass`),
+such that derived columns (e.g. `reliable`) can be recomputed on existing
+catalogues without repeating the band-merging.
+"""
+from __future__ import print_function, division
+import os
+import shlex
+import numpy as np
+from collections import OrderedDict
+from astropy.io import fits
+import constants
+
+__author__ = 'Geert Barentsen'
+__copyright__ = 'Copyright, The Authors'
+__credits__ = ['Geert Barentsen', 'Hywel Farnhill', 'Janet Drew']
+
+
+#############################
+# CONSTANTS & CONFIGURATION
+#############################
+
+# The stilts commands which are ported in this module
+CMDFILE = os.path.join(constants.LIBDIR, 'stilts-band-merging.cmd')
+
+# The order of the bands in the matched table (suffixes _1, _2, _3)
+BANDS = ['r', 'i', 'ha']
+
+# Null values of the integer columns, by FITS format (cf. TNULL)
+NULL_VALUES = {'B': 255, 'I': -32768, 'J': -2147483648,
+               'K': -9223372036854775808}
+
+# Columns of the detection tables which are kept for each band,
+# mapped onto the suffix of their band-merged name (e.g. r, rErr, rPeakMag)
+BAND_COLUMNS = OrderedDict([('aperMag2', ''),
+                            ('aperMag2Err', 'Err'),
+                            ('peakMag', 'PeakMag'),
+                            ('peakMagErr', 'PeakMagErr'),
+                            ('aperMag1', 'AperMag1'),
+                            ('aperMag1Err', 'AperMag1Err'),
+                            ('aperMag3', 'AperMag3'),
+                            ('aperMag3Err', 'AperMag3Err'),
+                            ('gauSig', 'GauSig'),
+                            ('ell', 'Ell'),
+                            ('pa', 'PA'),
+                            ('class', 'Class'),
+                            ('classStat', 'ClassStat'),
+                            ('errBits', 'ErrBits'),
+                            ('mjd', 'MJD'),
+                            ('seeing', 'Seeing'),
+                            ('detectionID', 'DetectionID'),
+                            ('x', 'X'),
+                            ('y', 'Y'),
+                            ('planeX', 'PlaneX'),
+                            ('planeY', 'PlaneY')])
+
+# Quality flags which are merged across the bands
+FLAGS = ['brightNeighb', 'deblend', 'saturated',
+         'vignetted', 'truncated', 'badPix']
+
+# Columns which take the value of the first band in which they are not null,
+# mapped onto the name of the merged column
+FIRST_VALID = OrderedDict([('detectionID', 'sourceID'),
+                           ('ra', 'ra'),
+                           ('dec', 'dec'),
+                           ('posErr', 'posErr'),
+                           ('night', 'night'),
+                           ('ccd', 'ccd')])
+
+# Probability of each image class (cf. the `class` column) being a star,
+# galaxy, noise or saturated, and the probability assigned to other values
+P_STAR = ({-9: 0.00, -3: 0.25, -2: 0.70, -1: 0.90, 0: 0.05, 1: 0.05}, np.nan)
+P_GALAXY = ({-9: 0.00, -3: 0.70, -2: 0.25, -1: 0.05, 0: 0.05, 1: 0.90}, np.nan)
+P_NOISE = ({0: 0.90}, 0.05)
+P_SATURATED = ({-9: 0.95}, 0.00)
+
+# Orientation of the Hipparcos frame (i.e. ICRS) with respect to FK5 J2000,
+# as an axial vector (arcsec), cf. SLALIB's sla_FK5HZ and sla_HFK5Z, which are
+# used by stilts' addskycoords to convert between ICRS and FK5. The spin of
+# the frames is neglected, i.e. the conversion is that of epoch 2000.
+FK5_TO_HIPPARCOS = np.array([-19.9e-3, -9.1e-3, +22.9e-3])
+# Rotation matrix from FK5 J2000 to Galactic coordinates (cf. SLALIB's
+# sla_EQGAL, which is used by stilts' addskycoords)
+EQUATORIAL_TO_GALACTIC = np.array(
+                [[-0.054875539726, -0.873437108010, -0.483834985808],
+                 [+0.494109453312, -0.444829589425, +0.746982251810],
+                 [-0.867666135858, -0.198076386122, +0.455983795705]])
+
+
+###########
+# FUNCTIONS
+###########
+
+def output_columns():
+    """Returns the names of the band-merged columns, in order."""
+    columns = ['ra', 'dec', 'sourceID', 'posErr', 'l', 'b',
+               'mergedClass', 'mergedClassStat',
+               'pStar', 'pGalaxy', 'pNoise', 'pSaturated', 'rmi', 'rmha']
+    for band in BANDS:
+        columns += [band + suffix for suffix in BAND_COLUMNS.values()]
+        if band != 'r':
+            columns += [band + 'Xi', band + 'Eta']
+    columns += FLAGS + ['errBits', 'nBands', 'reliable', 'fieldID',
+                        'fieldGrade', 'night', 'seeing', 'rAxis', 'ccd']
+    return columns
+
+
+def null_value(array):
+    """Returns the TNULL value used for an integer array."""
+    return NULL_VALUES[{1: 'B', 2: 'I', 4: 'J', 8: 'K'}[array.dtype.itemsize]]
+
+
+def is_null(array):
+    """Returns True where the values are null, following stilts."""
+    array = np.asarray(array)
+    if array.dtype.kind == 'f':
+        return np.isnan(array)
+    elif array.dtype.kind in 'iu':
+        return array == null_value(array)
+    elif array.dtype.kind in 'SU':
+        return np.char.str_len(np.char.strip(array)) == 0
+    return np.zeros(array.shape, dtype=bool)
+
+
+def first_valid(arrays):
+    """Returns the first non-null value of several arrays, element-wise.
+
+    This is the equivalent of the chain of expressions
+    "NULL_x?y:x", "NULL_x?z:x" used by stilts.
+    """
+    result = np.array(arrays[0])
+    for array in arrays[1:]:
+        null = is_null(result)
+        result[null] = np.asarray(array)[null]
+    return result
+
+
+def _double(array):
+    return np.asarray(array, dtype=np.float64)
+
+
+def _maximum(arrays):
+    """maximum(array(NULL_x?0:x, ...)) in stilts."""
+    return np.max([np.where(is_null(array), 0, _double(array))
+                   for array in arrays], axis=0)
+
+
+def merge_bands(matched):
+    """Renames and merges the columns of a band-matched table.
+
+    Parameters
+    ----------
+    matched : mapping
+        Columns of the band-matched table, i.e. every column of the
+        detection tables with suffix _1 (r), _2 (i) and _3 (H-alpha),
+        cf. `bandmerging.BandMerge.get_matched_columns`.
+
+    Returns
+    -------
+    cat : `OrderedDict`
+        The band columns renamed (e.g. class_1 becomes rClass),
+        the columns of `FIRST_VALID` and the per-band positions
+        (iRA, iDec, haRA, haDec).
+    """
+    cat = OrderedDict()
+    for name, merged in FIRST_VALID.items():
+        cat[merged] = first_valid([matched['{0}_{1}'.format(name, k + 1)]
+                                   for k in range(len(BANDS))])
+    # The CCD number is an unsigned byte, which stilts reads as a short
+    ccd = is_null(cat['ccd'])
+    cat['ccd'] = cat['ccd'].astype(np.int16)
+    cat['ccd'][ccd] = NULL_VALUES['I']
+    for k, band in enumerate(BANDS):
+        suffix = '_{0}'.format(k + 1)
+        for name, newname in BAND_COLUMNS.items():
+            cat[band + newname] = np.asarray(matched[name + suffix])
+        for name in FLAGS:
+            cat[band + name[0].upper() + name[1:]] = np.asarray(
+                                                        matched[name + suffix])
+        if band != 'r':
+            cat[band + 'RA'] = np.asarray(matched['ra' + suffix])
+            cat[band + 'Dec'] = np.asarray(matched['dec' + suffix])
+    return cat
+
+
+def rotation_matrix(axial_vector):
+    """Returns the rotation matrix of an axial vector (radians).
+
+    This is SLALIB's sla_DAV2M, i.e. the matrix rotates the frame
+    about the direction of the vector by its magnitude.
+    """
+    phi = np.sqrt(np.sum(np.square(axial_vector)))
+    if phi == 0:
+        return np.identity(3)
+    x, y, z = np.asarray(axial_vector) / phi
+    s, c = np.sin(phi), np.cos(phi)
+    w = 1 - c
+    return np.array([[x * x * w + c, x * y * w + z * s, x * z * w - y * s],
+                     [x * y * w - z * s, y * y * w + c, y * z * w + x * s],
+                     [x * z * w + y * s, y * z * w - x * s, z * z * w + c]])
+
+
+def galactic(ra, dec):
+    """Converts ICRS into Galactic coordinates (degrees).
+
+    Like `addskycoords icrs galactic` in stilts, the coordinates are first
+    converted into FK5 J2000 (cf. `FK5_TO_HIPPARCOS`) and then rotated into
+    the Galactic frame.
+    """
+    ra, dec = np.radians(_double(ra)), np.radians(_double(dec))
+    xyz = np.array([np.cos(dec) * np.cos(ra),
+                    np.cos(dec) * np.sin(ra),
+                    np.sin(dec)])
+    hipparcos_to_fk5 = rotation_matrix(np.radians(FK5_TO_HIPPARCOS
+                                                  / 3600.)).T
+    x, y, z = np.dot(np.dot(EQUATORIAL_TO_GALACTIC, hipparcos_to_fk5), xyz)
+    l = np.degrees(np.arctan2(y, x)) % 360.
+    b = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    return l, b
+
+
+def offsets(cat, band):
+    """Returns the position offset of a band in RA and Dec (arcsec)."""
+    xi = (3600.0 * (_double(cat[band + 'RA']) - _double(cat['ra'])))
+    eta = (3600.0 * (_double(cat[band + 'Dec']) - _double(cat['dec'])))
+    return xi.astype(np.float32), eta.astype(np.float32)
+
+
+def class_probability(cls, probabilities):
+    """Returns the single-band probability of an image class.
+
+    Parameters
+    ----------
+    cls : array of int
+        Image classification flag (e.g. rClass).
+
+    probabilities : tuple
+        One of `P_STAR`, `P_GALAXY`, `P_NOISE` or `P_SATURATED`.
+    """
+    values, default = probabilities
+    result = np.empty(len(cls), dtype=np.float32)
+    result[:] = default
+    for value, probability in values.items():
+        result[cls == value] = probability
+    # Bands without a detection are uninformative
+    result[is_null(cls)] = 1
+    return result
+
+
+def merged_probabilities(cat):
+    """Returns pStar, pGalaxy, pNoise and pSaturated."""
+    products = OrderedDict()
+    for name, probabilities in [('pStar', P_STAR),
+                                ('pGalaxy', P_GALAXY),
+                                ('pNoise', P_NOISE),
+                                ('pSaturated', P_SATURATED)]:
+        product = None
+        for band in BANDS:
+            p = class_probability(cat[band + 'Class'], probabilities)
+            product = p if product is None else product * p
+        products[name] = product
+    total = None
+    for product in products.values():
+        total = product if total is None else total + product
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return OrderedDict([(name, product / total)
+                            for name, product in products.items()])
+
+
+def merged_class(pstar, pgalaxy, pnoise, psaturated):
+    """Returns mergedClass, following the UKIDSS procedure.
+
+    See http://surveys.roe.ac.uk/wsa/www/gloss_m.html#gpssource_mergedclass
+    """
+    pstar, pgalaxy = _double(pstar), _double(pgalaxy)
+    pnoise, psaturated = _double(pnoise), _double(psaturated)
+    with np.errstate(invalid='ignore'):
+        conditions = [pstar > 0.899, pstar >= 0.699,
+                      pgalaxy >= 0.899, pgalaxy >= 0.699,
+                      pnoise >= 0.899, psaturated >= 0.899]
+    return np.select(conditions, [-1, -2, 1, -3, 0, -9],
+                     default=NULL_VALUES['I']).astype(np.int16)
+
+
+def merged_class_stat(cat):
+    """Returns mergedClassStat, i.e. mean(classStat) * sqrt(n)."""
+    stats = np.array([_double(cat[band + 'ClassStat']) for band in BANDS])
+    valid = ~np.isnan(stats)
+    count = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, stats, 0).sum(axis=0) / count
+    return (mean * np.sqrt(count)).astype(np.float32)
+
+
+def merged_flag(cat, name):
+    """Returns True where a quality flag is set in any band."""
+    result = np.zeros(len(cat['ra']), dtype=bool)
+    for band in BANDS:
+        values = cat[band + name[0].upper() + name[1:]]
+        if name == 'badPix':
+            with np.errstate(invalid='ignore'):
+                values = _double(values) >= 1
+        result |= np.asarray(values, dtype=bool) & ~is_null(values)
+    if name == 'saturated':
+        with np.errstate(invalid='ignore'):
+            result |= ((_double(cat['r']) < 13) | (_double(cat['i']) < 12)
+                       | (_double(cat['ha']) < 12.5))
+    return result
+
+
+def err_bits(cat):
+    """Returns errBits, the highest error bitmask amongst the bands."""
+    return _maximum([cat[band + 'ErrBits'] for band in BANDS]).astype(np.int32)
+
+
+def n_bands(cat):
+    """Returns nBands, the number of bands with a detection."""
+    return np.sum([~is_null(cat[band]) for band in BANDS],
+                  axis=0).astype(np.int16)
+
+
+def reliable(cat):
+    """Returns the `reliable` flag.
+
+    True if the source is detected in all three bands with SNR better than
+    10-sigma, errBits <= 2, and the AperMag1 magnitudes are consistent with
+    the default magnitudes. Requires the merged `errBits` and `nBands`.
+    """
+    result = (cat['errBits'] <= 2) & (cat['nBands'] == 3)
+    with np.errstate(invalid='ignore'):
+        for band, limit in [('r', 13), ('i', 12), ('ha', 12.5)]:
+            mag, err = cat[band], cat[band + 'Err']
+            mag1, err1 = cat[band + 'AperMag1'], cat[band + 'AperMag1Err']
+            # The difference of two floats is a float in Java
+            difference = np.abs(_double(np.subtract(mag, mag1,
+                                                    dtype=np.float32)))
+            result &= ((_double(mag) > limit) & (_double(err) < 0.1)
+                       & (difference < 3 * np.hypot(_double(err),
+                                                    _double(err1)) + 0.03))
+    return result
+
+
+def seeing(cat):
+    """Returns the worst seeing amongst the three bands."""
+    return _maximum([cat[band + 'Seeing'] for band in BANDS]).astype(np.float32)
+
+
+def axis_distance(cat):
+    """Returns rAxis, the largest distance from the optical axis."""
+    distances = [np.sqrt(_double(cat[band + 'PlaneX'])**2
+                         + _double(cat[band + 'PlaneY'])**2)
+                 for band in BANDS]
+    return _maximum(distances).astype(np.float32)
+
+
+def derive(cat, fieldid, fieldgrade):
+    """Adds the derived columns to a band-merged catalogue.
+
+    Parameters
+    ----------
+    cat : `OrderedDict`
+        Band-merged columns, cf. `merge_bands`. The derived columns
+        are added in place.
+
+    fieldid, fieldgrade : str
+        Field identifier and quality control grade of the field.
+    """
+    n = len(cat['ra'])
+    cat['l'], cat['b'] = galactic(cat['ra'], cat['dec'])
+    for band in BANDS[1:]:
+        cat[band + 'Xi'], cat[band + 'Eta'] = offsets(cat, band)
+    cat.update(merged_probabilities(cat))
+    cat['mergedClass'] = merged_class(cat['pStar'], cat['pGalaxy'],
+                                      cat['pNoise'], cat['pSaturated'])
+    cat['mergedClassStat'] = merged_class_stat(cat)
+    for name in FLAGS:
+        cat[name] = merged_flag(cat, name)
+    cat['errBits'] = err_bits(cat)
+    cat['nBands'] = n_bands(cat)
+    cat['reliable'] = reliable(cat)
+    cat['seeing'] = seeing(cat)
+    cat['fieldID'] = np.array([fieldid] * n, dtype='S{0}'.format(
+                                                        max(len(fieldid), 1)))
+    cat['fieldGrade'] = np.array([fieldgrade] * n, dtype='S{0}'.format(
+                                                    max(len(fieldgrade), 1)))
+    cat['rmi'] = np.subtract(cat['r'], cat['i'], dtype=np.float32)
+    cat['rmha'] = np.subtract(cat['r'], cat['ha'], dtype=np.float32)
+    cat['rAxis'] = axis_distance(cat)
+    return cat
+
+
+def read_metadata(path=CMDFILE):
+    """Returns the units and descriptions assigned by the stilts commands.
+
+    Returns
+    -------
+    units, descriptions : dict, dict
+        Mapping of the band-merged column names onto their -units and
+        -desc arguments in `path`.
+    """
+    units, descriptions = {}, {}
+    with open(path) as cmdfile:
+        for line in cmdfile:
+            words = shlex.split(line, comments=True)
+            if len(words) == 0 or words[0] not in ['addcol', 'replacecol',
+                                                   'colmeta']:
+                continue
+            options, positional = {}, []
+            k = 1
+            while k < len(words):
+                if words[k] in ['-name', '-desc', '-units', '-ucd', '-utype',
+                                '-before', '-after']:
+                    options[words[k]] = words[k + 1]
+                    k += 2
+                else:
+                    positional.append(words[k])
+                    k += 1
+            name = options.get('-name', positional[0])
+            if '-units' in options:
+                units[name] = options['-units']
+            if '-desc' in options:
+                descriptions[name] = options['-desc']
+    return units, descriptions
+
+
+def fits_format(array):
+    """Returns the FITS binary table format of an array."""
+    if array.dtype.kind in 'SU':
+        return '{0}A'.format(max(array.dtype.itemsize
+                                 // np.dtype(array.dtype.kind + '1').itemsize,
+                                 1))
+    return {'f4': 'E', 'f8': 'D', 'i2': 'I', 'i4': 'J', 'i8': 'K',
+            'u1': 'B', 'b1': 'L'}[array.dtype.kind + str(array.dtype.itemsize)]
+
+
+def bandmerged_columns(matched, fieldid, fieldgrade):
+    """Returns the columns of a band-merged catalogue.
+
+    This is the equivalent of applying `stilts-band-merging.cmd` to the
+    output of `stilts tmatchn`.
+
+    Parameters
+    ----------
+    matched : list of `astropy.io.fits.Column`
+        Columns of the band-matched table, cf.
+        `bandmerging.BandMerge.get_matched_columns`.
+
+    fieldid, fieldgrade : str
+        Field identifier and quality control grade of the field.
+
+    Returns
+    -------
+    columns, descriptions : list of `astropy.io.fits.Column`, list of str
+        The columns in the order of the `keepcols` step, and their
+        descriptions (None if the column does not have one).
+    """
+    cat = derive(merge_bands(OrderedDict([(col.name, col.array)
+                                          for col in matched])),
+                 fieldid, fieldgrade)
+    # Renamed columns keep their original units
+    input_units = {col.name: col.unit for col in matched}
+    units, descriptions = read_metadata()
+    for name, merged in FIRST_VALID.items():
+        units.setdefault(merged, input_units.get(name + '_1'))
+    for k, band in enumerate(BANDS):
+        for name, suffix in BAND_COLUMNS.items():
+            units.setdefault(band + suffix,
+                             input_units.get('{0}_{1}'.format(name, k + 1)))
+    units.setdefault('l', 'deg')
+    units.setdefault('b', 'deg')
+
+    columns = []
+    for name in output_columns():
+        array = cat[name]
+        fmt = fits_format(array)
+        null = None
+        if fmt in NULL_VALUES:
+            null = NULL_VALUES[fmt]
+        columns.append(fits.Column(name=name, format=fmt,
+                                   unit=units.get(name), null=null,
+                                   array=array))
+    return columns, [descriptions.get(name) for name in output_columns()]
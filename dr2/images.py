@@ -25,6 +25,7 @@ import os
 
 import util
 import constants
+import shiftstore
 
 __author__ = 'Geert Barentsen'
 __copyright__ = 'Copyright, The Authors'
@@ -35,6 +36,10 @@ __credits__ = ['Geert Barentsen']
 # CONSTANTS & CONFIG
 ####################
 
+# Default 1-sigma uncertainty of PHOTZP; the uncertainty of the calibration
+# shift of the run is added in quadrature if it is known
+PHOTZPER = 0.03
+
 # Table containing slight updates to WCS astrometric parameters
 WCSFIXES_PATH = os.path.join(constants.PACKAGEDIR, 'wcs-tuning', 'wcs-fixes.csv')
 WCSFIXES = ascii.read(WCSFIXES_PATH)
@@ -47,21 +52,6 @@ METADATA = dict(zip(MD['run'], MD))
 # CLASSES
 ###########
 
-class CalibrationDatabase(object):
-    """Class to hold the calibration shifts."""
-    def __init__(self):
-        r = ascii.read(os.path.join(constants.DESTINATION, 'calibration',
-                                    'calibration-r.csv'))
-        i = ascii.read(os.path.join(constants.DESTINATION, 'calibration',
-                                    'calibration-i.csv'))
-        ha = ascii.read(os.path.join(constants.DESTINATION, 'calibration',
-                                     'calibration-ha.csv'))
-        self.shifts = dict(zip(
-                           np.concatenate((r['run'], i['run'], ha['run'])),
-                           np.concatenate((r['shift'], i['shift'], ha['shift']))
-                           ))
-
-
 class SurveyImage(object):
     """Class used to write a single IPHAS CCD image with up-to-date keywords."""
 
@@ -73,11 +63,7 @@ class SurveyImage(object):
         self.fits_orig = fits.open(self.path_orig, do_not_scale_image_data=True)
 
         # Is the run a DR2-recalibrated run?
-        mycaldb = get_caldb()
-        if self.run in mycaldb.shifts:
-            self.calibrated = True
-        else:
-            self.calibrated = False
+        self.calibrated = shiftstore.get_store().has_run(self.run)
 
         # Sort out the new FITS image and header
         self.hdu = fits.PrimaryHDU(self.fits_orig[self.ccd].data)
@@ -109,6 +95,16 @@ class SurveyImage(object):
         """
         return METADATA[self.run]['exptime_precalib']
 
+    @property
+    def photzper(self):
+        """Returns the 1-sigma uncertainty of PHOTZP.
+
+        Combines the default uncertainty with the uncertainty of the
+        calibration shift of the run, if the latter is known.
+        """
+        err = shiftstore.get_store().get_run_error(self.run, default=0.0)
+        return float(np.hypot(PHOTZPER, err))
+
     @property
     def photzp(self):
         """Returns the zeropoint such that MAG=-2.5*log(pixel value)+PHOTZP
@@ -117,11 +113,7 @@ class SurveyImage(object):
         "ESO External Data Products Standard"
         """
         # What is the calibration shift applied in DR2?
-        mycaldb = get_caldb()
-        try:
-            shift = mycaldb.shifts[self.run]
-        except KeyError:
-            shift = 0.0
+        shift = shiftstore.get_store().get_run_shift(self.run, default=0.0)
         # The zeropoint in the metadata file is corrected for extinction
         # but not re-calibrated and not corrected for PERCORR.
         # In accordance with the ESO standard, photzp absorbs the scaling
@@ -220,8 +212,8 @@ class SurveyImage(object):
         self.hdu.header.comments['PHOTZP'] = 'mag(Vega) = -2.5*log(pixel value) + PHOTZP'
 
         # Add keywords according to the "ESO External Data Products standard"
-        self.hdu.header['PHOTZPER'] = 0.03
-        self.hdu.header.comments['PHOTZPER'] = 'Default 1-sigma PHOTZP uncertainty in IPHAS DR2'
+        self.hdu.header['PHOTZPER'] = self.photzper
+        self.hdu.header.comments['PHOTZPER'] = '1-sigma PHOTZP uncertainty in IPHAS DR2'
         self.hdu.header['PHOTSYS'] = 'Vega'
         self.hdu.header.comments['PHOTSYS'] = 'Photometric system'
 
@@ -337,17 +329,6 @@ class SurveyImage(object):
 # FUNCTIONS
 ###########
 
-def get_caldb():
-    """Returns the calibration information."""
-    # Keep the CALDB stored as a global variable (= optimisation)
-    global CALDB
-    try:
-        return CALDB
-    except NameError:
-        CALDB = CalibrationDatabase()
-        return CALDB
-
-
 def prepare_one(run):
     with log.log_to_file(os.path.join(constants.LOGDIR, 'images.log')):
         result = []
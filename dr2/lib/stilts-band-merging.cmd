@@ -4,6 +4,9 @@
 #
 # It is assumed that the order of the bands given to stilts is:
 # in1=r, in2=i, in3=H-alpha
+#
+# These commands are ported to numpy in dr2/derivedcolumns.py,
+# which must be kept in sync.
 ######
 
 # sourceID (use the first non-NULL value of detectionID_1/2/3)
@@ -11,6 +11,8 @@ Output
 ------
 The output is a CSV file written to 
 "{constants.DESTINATION}/calibration/offsets-{band}.csv"
+and a binary copy of the same table, "offsets-{band}.npy", which is
+the file actually loaded by the calibration (cf. `BINARY_DTYPE`).
 
 The columns in the CSV file are:
 run1   -- reference run number
@@ -18,11 +20,21 @@ run2   -- comparison run number
 offset -- median(run1_magnitudes - run2_magnitudes)
 std    -- std(run1_magnitudes - run2_magnitudes)
 n      -- len(run1_magnitudes - run2_magnitudes)
+mad    -- median absolute deviation of (run1_magnitudes - run2_magnitudes)
+mean   -- sigma-clipped mean(run1_magnitudes - run2_magnitudes)
+err    -- bootstrap uncertainty of the median offset (NaN unless
+          `BOOTSTRAP_SAMPLES` is set)
+
+Alternatively, `compute_offsets(clusterview, bandmerged=True)` derives the
+offsets for all three bands from a single crossmatch between the bandmerged
+catalogues of each pair of overlapping fields, which avoids matching the same
+pair of pointings three times and guarantees that the bands use identical
+star samples.
 
 Dependencies
 ------------
 * IPHASQC table containing all metadata.
-* single-band detection catalogues.
+* single-band detection catalogues (or bandmerged catalogues).
 """
 from __future__ import division, print_function, unicode_literals
 import os
@@ -30,6 +42,7 @@ import sys
 from multiprocessing import Pool
 import numpy as np
 from astropy import log
+from astropy.io import ascii
 from astropy.io import fits
 
 import constants
@@ -51,6 +64,25 @@ MAGLIMITS = {'r': [15, 17.5], 'i': [14, 16.5], 'ha': [15, 17.5]}
 # Maximum matching distance
 MATCHING_DISTANCE = 0.5  # arcsec
 
+# Minimum number of crossmatched stars required to report an offset
+MIN_STARS = 5
+
+# Sigma-clipping and bootstrap settings used by `grouped_statistics`
+CLIP_SIGMA = 3.0
+CLIP_ITERATIONS = 5
+# The bootstrap uncertainties ('err') are not used by the calibration,
+# and are the most expensive statistic, hence they are off by default
+BOOTSTRAP_SAMPLES = 0
+BOOTSTRAP_SEED = 0
+
+# Columns of the offsets-{band}.csv files
+COLUMNS = ['run1', 'run2', 'offset', 'std', 'n', 'mad', 'mean', 'err']
+ROW_FORMAT = ','.join(['{'+col+'}' for col in COLUMNS]) + '\n'
+# Data types of the columns in the binary offsets-{band}.npy files
+BINARY_DTYPE = [('run1', 'i4'), ('run2', 'i4'), ('offset', 'f4'),
+                ('std', 'f4'), ('n', 'i4'), ('mad', 'f4'), ('mean', 'f4'),
+                ('err', 'f4')]
+
 
 ###########
 # CLASSES
@@ -128,16 +160,12 @@ class OffsetMachine(object):
             exposure.
         """
         log.debug('Computing offsets for run {0}'.format(self.run))
-        offsets = []
-        for run2 in self.overlap_runs():
-            log.debug(str(run2))
-            result = self._compute_relative_offsets(run2)
-            if result is not None:
-                offsets.append(result)
-        return offsets
+        runs2 = self.overlap_runs()
+        differences = [self._matched_differences(run2) for run2 in runs2]
+        return offset_rows(self.run, runs2, differences)
 
-    def _compute_relative_offsets(self, run2):
-        """Computes the offset against a specified run.
+    def _matched_differences(self, run2):
+        """Returns the magnitude differences of the stars matched with run2.
 
         Parameters
         ----------
@@ -146,14 +174,12 @@ class OffsetMachine(object):
 
         Returns
         -------
-        offsets : dictionary
-            Containing the fields run1, run2, offset, std, n.
+        differences : array of float
+            (self.run magnitude - run2 magnitude) for each reliable match.
         """
         limit_bright = MAGLIMITS[self.band][0]
         limit_faint = MAGLIMITS[self.band][1]
 
-        offsets = []
-
         offset_data = self.get_data(run2)
 
         cond_reliable1 = ((self.data['aperMag2'] > limit_bright)
@@ -163,31 +189,303 @@ class OffsetMachine(object):
                           & (offset_data['aperMag2'] < (limit_faint+0.2))
                           & (offset_data['errBits'] == 0))
 
-        for idx1 in np.argwhere(cond_reliable1):
-            idx2 = util.crossmatch(self.data['ra'][idx1],
-                                   self.data['dec'][idx1],
-                                   offset_data['ra'][cond_reliable2],
-                                   offset_data['dec'][cond_reliable2],
-                                   matchdist=MATCHING_DISTANCE)
-            if idx2 is not None:
-                offsets.append(self.data['aperMag2'][idx1]
-                               - offset_data['aperMag2'][cond_reliable2][idx2])
-
-        if len(offsets) < 5:
-            return None
-        else:
-            offsets = np.array(offsets)
-            return {'run1': self.run,
-                    'run2': run2,
-                    'offset': np.median(offsets),
-                    'std': np.std(offsets),
-                    'n': len(offsets)}
+        idx1 = np.where(cond_reliable1)[0]
+        idx2 = np.where(cond_reliable2)[0]
+        m1, m2 = util.crossmatch_arrays(self.data['ra'][idx1],
+                                        self.data['dec'][idx1],
+                                        offset_data['ra'][idx2],
+                                        offset_data['dec'][idx2],
+                                        matchdist=MATCHING_DISTANCE)
+        return (self.data['aperMag2'][idx1[m1]]
+                - offset_data['aperMag2'][idx2[m2]])
+
+
+class BandmergedOffsetMachine(object):
+    """Computes r/i/Halpha offsets between fields using one crossmatch.
+
+    Rather than crossmatching the single-band detection tables of a pair of
+    overlapping pointings once for every band, this class crossmatches the
+    bandmerged catalogues of the two fields once and derives the offsets for
+    all bands from that single match.
+    """
+
+    def __init__(self, fieldid):
+        """
+        Parameters
+        ----------
+        fieldid : str
+            Field identifier, e.g. '0001_aug2003'.
+        """
+        self.fieldid = fieldid
+        self.idx = np.argwhere(IPHASQC['id'] == fieldid)[0][0]
+        self.data = self.get_data(fieldid)
+
+    def get_data(self, fieldid):
+        """Returns a dictionary with the data for a given field.
+
+        Parameters
+        ----------
+        fieldid : str
+            Field identifier.
+
+        Returns
+        -------
+        data : dictionary of arrays
+        """
+        f = fits.open(self.filename(fieldid))
+        data = {'ra': f[1].data['ra'],
+                'dec': f[1].data['dec']}
+        for band in constants.BANDS:
+            data[band] = f[1].data[band]
+            data[band+'ErrBits'] = f[1].data[band+'ErrBits']
+        f.close()
+        return data
+
+    def filename(self, fieldid):
+        """Returns the full path of the bandmerged catalogue of the field."""
+        return os.path.join(constants.PATH_BANDMERGED,
+                            '{0}.fits'.format(fieldid))
+
+    def overlap_fields(self):
+        """Returns the list of overlapping fields.
+
+        Returns
+        -------
+        fields : array of str
+            List of field identifiers within `constants.FIELD_MAXDIST`.
+        """
+        dist = util.sphere_dist(IPHASQC['ra'][self.idx],
+                                IPHASQC['dec'][self.idx],
+                                IPHASQC['ra'], IPHASQC['dec'])
+        idx2 = (constants.IPHASQC_COND_RELEASE
+                & (dist < constants.FIELD_MAXDIST)
+                & (IPHASQC['id'] != self.fieldid))
+        return IPHASQC['id'][idx2]
+
+    def relative_offsets(self):
+        """Returns the offsets for all fields that overlap with self.fieldid.
+
+        Returns
+        -------
+        offsets : dictionary of lists of dictionaries
+            For each band, a list with the offset information for each
+            overlapping exposure in that band.
+        """
+        log.debug('Computing offsets for field {0}'.format(self.fieldid))
+        fields2 = self.overlap_fields()
+        differences = [self._matched_differences(field2) for field2 in fields2]
+        idx_fields2 = [np.argwhere(IPHASQC['id'] == field2)[0][0]
+                       for field2 in fields2]
+        offsets = {}
+        for band in constants.BANDS:
+            runs2 = IPHASQC['run_'+band][idx_fields2]
+            offsets[band] = offset_rows(IPHASQC['run_'+band][self.idx],
+                                        runs2,
+                                        [diff[band] for diff in differences])
+        return offsets
+
+    def _reliable(self, data, band, margin=0.):
+        """Returns a mask of the reliable detections in a given band."""
+        limit_bright = MAGLIMITS[band][0] - margin
+        limit_faint = MAGLIMITS[band][1] + margin
+        return ((data[band] > limit_bright)
+                & (data[band] < limit_faint)
+                & (data[band+'ErrBits'] == 0))
+
+    def _matched_differences(self, field2):
+        """Returns the magnitude differences in each band against field2.
+
+        Parameters
+        ----------
+        field2 : str
+            The field to compare against.
+
+        Returns
+        -------
+        differences : dictionary of arrays
+            For each band, (self.fieldid magnitude - field2 magnitude)
+            for each star that is reliable in that band in both fields.
+        """
+        offset_data = self.get_data(field2)
+
+        # The same reliability criteria as in OffsetMachine are applied,
+        # but only after the single crossmatch, independently for each band
+        reliable1 = dict([(band, self._reliable(self.data, band))
+                          for band in constants.BANDS])
+        reliable2 = dict([(band, self._reliable(offset_data, band, 0.2))
+                          for band in constants.BANDS])
+        # Only crossmatch sources which are reliable in at least one band
+        use1 = np.where(reliable1['r'] | reliable1['i'] | reliable1['ha'])[0]
+        use2 = np.where(reliable2['r'] | reliable2['i'] | reliable2['ha'])[0]
+        m1, m2 = util.crossmatch_arrays(self.data['ra'][use1],
+                                        self.data['dec'][use1],
+                                        offset_data['ra'][use2],
+                                        offset_data['dec'][use2],
+                                        matchdist=MATCHING_DISTANCE)
+        idx1, idx2 = use1[m1], use2[m2]
+
+        differences = {}
+        for band in constants.BANDS:
+            mask = reliable1[band][idx1] & reliable2[band][idx2]
+            differences[band] = (self.data[band][idx1[mask]]
+                                 - offset_data[band][idx2[mask]])
+        return differences
 
 
 ###########
 # FUNCTIONS
 ###########
 
+def _grouped_median(values, group, segments):
+    """Returns the median of each contiguous segment of `values`.
+
+    `group` holds the segment number of each value; empty segments yield NaN.
+    """
+    counts = np.diff(segments)
+    ordered = values[np.lexsort((values, group))]
+    median = np.empty(len(counts))
+    median.fill(np.nan)
+    nonempty = counts > 0
+    lo = segments[:-1][nonempty] + (counts[nonempty] - 1) // 2
+    hi = segments[:-1][nonempty] + counts[nonempty] // 2
+    median[nonempty] = 0.5 * (ordered[lo] + ordered[hi])
+    return median
+
+
+def grouped_statistics(values, segments,
+                       nsigma=CLIP_SIGMA, iterations=CLIP_ITERATIONS,
+                       n_bootstrap=BOOTSTRAP_SAMPLES, seed=BOOTSTRAP_SEED):
+    """Computes robust statistics for many groups of values at once.
+
+    The statistics of all groups are computed using vectorised group-by
+    operations, i.e. there is no Python loop over the groups.
+
+    Parameters
+    ----------
+    values : array of float
+        Concatenated values of all groups, e.g. the magnitude differences
+        between the matched stars of many pairs of exposures.
+
+    segments : array of int
+        Segment offsets of length n_groups+1, such that the values of
+        group k are values[segments[k]:segments[k+1]].
+
+    nsigma : float
+        Clipping threshold (in standard deviations around the median)
+        used to compute the sigma-clipped mean.
+
+    iterations : int
+        Maximum number of sigma-clipping iterations.
+
+    n_bootstrap : int
+        Number of bootstrap resamples used to estimate the uncertainty
+        of the median (set to 0 to skip).
+
+    seed : int
+        Seed of the bootstrap resampling, such that the results are
+        reproducible.
+
+    Returns
+    -------
+    stats : dictionary of arrays
+        The keys are n, median, mad, mean (sigma-clipped), std and err
+        (bootstrap uncertainty of the median); NaN for empty groups.
+    """
+    values = np.asarray(values, dtype=float)
+    segments = np.asarray(segments, dtype=int)
+    counts = np.diff(segments)
+    n_groups = len(counts)
+    group = np.repeat(np.arange(n_groups), counts)
+
+    median = _grouped_median(values, group, segments)
+    mad = _grouped_median(np.abs(values - median[group]), group, segments)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n = np.bincount(group, minlength=n_groups).astype(float)
+        mean = np.bincount(group, values, minlength=n_groups) / n
+        std = np.sqrt(np.bincount(group, (values - mean[group])**2,
+                                  minlength=n_groups) / n)
+
+        # Sigma-clipped mean: clip around the median, using the std
+        # of the values which survived the previous iteration
+        keep = np.ones(len(values), dtype=bool)
+        clipped_std = std
+        for i in range(iterations):
+            newkeep = (np.abs(values - median[group])
+                       <= nsigma * clipped_std[group])
+            if (newkeep == keep).all():
+                break
+            keep = newkeep
+            n_keep = np.bincount(group[keep], minlength=n_groups)
+            clipped_mean = (np.bincount(group[keep], values[keep],
+                                        minlength=n_groups) / n_keep)
+            clipped_std = np.sqrt(np.bincount(group[keep],
+                                     (values[keep] - clipped_mean[group[keep]])**2,
+                                     minlength=n_groups) / n_keep)
+        mean_clipped = (np.bincount(group[keep], values[keep],
+                                    minlength=n_groups)
+                        / np.bincount(group[keep], minlength=n_groups))
+
+    # Bootstrap: resample each group with replacement, all groups at once
+    err = np.empty(n_groups)
+    err.fill(np.nan)
+    if n_bootstrap > 0 and len(values) > 0:
+        rng = np.random.RandomState(seed)
+        start = segments[:-1][group]
+        medians = np.empty((n_bootstrap, n_groups))
+        for i in range(n_bootstrap):
+            idx = start + (rng.random_sample(len(values))
+                           * counts[group]).astype(int)
+            medians[i] = _grouped_median(values[idx], group, segments)
+        err = np.std(medians, axis=0)
+
+    return {'n': counts,
+            'median': median,
+            'mad': mad,
+            'mean': mean_clipped,
+            'std': std,
+            'err': err}
+
+
+def offset_rows(run1, runs2, differences):
+    """Returns the offset summary of a run against each overlapping run.
+
+    Parameters
+    ----------
+    run1 : int
+        Reference run number.
+
+    runs2 : sequence of int
+        Comparison run numbers.
+
+    differences : sequence of arrays
+        For each comparison run, the magnitude differences (run1 - run2)
+        of the crossmatched stars.
+
+    Returns
+    -------
+    offsets : list of dictionaries
+        Containing the fields run1, run2, offset, std, n, mad, mean, err
+        for each comparison run with at least `MIN_STARS` matched stars.
+    """
+    if len(differences) == 0:
+        return []
+    counts = np.array([len(diff) for diff in differences])
+    segments = np.concatenate(([0], np.cumsum(counts)))
+    stats = grouped_statistics(np.concatenate(differences), segments)
+    rows = []
+    for k in np.where(counts >= MIN_STARS)[0]:
+        rows.append({'run1': run1,
+                     'run2': runs2[k],
+                     'offset': stats['median'][k],
+                     'std': stats['std'][k],
+                     'n': counts[k],
+                     'mad': stats['mad'][k],
+                     'mean': stats['mean'][k],
+                     'err': stats['err'][k]})
+    return rows
+
+
 def offsets_one(run):
     """Returns all offsets for a given reference exposure.
 
@@ -200,7 +498,7 @@ def offsets_one(run):
     -------
     offsets : list of dictionaries
         A sequence of dictionaries for each overlapping run. 
-        Each dictionary contains the fields run1/run2/offset/std/n.
+        Each dictionary contains the fields run1/run2/offset/std/n/mad/mean/err.
     """
     with log.log_to_file(os.path.join(constants.LOGDIR, 'offsets.log')):
         try:
@@ -214,6 +512,120 @@ def offsets_one(run):
             return [None]
 
 
+def offsets_one_bandmerged(fieldid):
+    """Returns all offsets in all bands for a given reference field.
+
+    Parameters
+    ----------
+    fieldid : str
+        Field identifier, e.g. '0001_aug2003'.
+
+    Returns
+    -------
+    offsets : dictionary of lists of dictionaries
+        For each band, a sequence of dictionaries for each overlapping run.
+        Each dictionary contains the fields run1/run2/offset/std/n/mad/mean/err.
+    """
+    with log.log_to_file(os.path.join(constants.LOGDIR, 'offsets.log')):
+        try:
+            log.info('{0}: Computing offsets for {1}'.format(util.get_pid(),
+                                                             fieldid))
+            om = BandmergedOffsetMachine(fieldid)
+            return om.relative_offsets()
+        except Exception, e:
+            log.error('{0}: UNEXPECTED EXCEPTION FOR FIELD {1}: {2}'.format(
+                                                                util.get_pid(),
+                                                                fieldid,
+                                                                e))
+            return dict([(band, [None]) for band in constants.BANDS])
+
+
+def rows_to_array(rows):
+    """Converts a list of offset rows (dictionaries) into a structured array.
+
+    Rows which are None (i.e. too few stars) are skipped.
+    """
+    return np.array([tuple(row[col] for col in COLUMNS)
+                     for row in rows if row is not None],
+                    dtype=BINARY_DTYPE)
+
+
+def write_binary(chunks, filename):
+    """Writes the binary offsets table, given a list of structured arrays."""
+    if len(chunks) > 0:
+        table = np.concatenate(chunks)
+    else:
+        table = np.zeros(0, dtype=BINARY_DTYPE)
+    np.save(filename, table)
+    log.info('Wrote {0} ({1} offsets)'.format(filename, len(table)))
+
+
+def convert_offsets(band, destination=os.path.join(constants.DESTINATION,
+                                                   'calibration')):
+    """Writes offsets-{band}.npy from an existing offsets-{band}.csv file."""
+    csv = ascii.read(os.path.join(destination, 'offsets-{0}.csv'.format(band)))
+    table = np.zeros(len(csv), dtype=BINARY_DTYPE)
+    for col, dtype in BINARY_DTYPE:
+        table[col] = csv[col]
+    write_binary([table], os.path.join(destination,
+                                       'offsets-{0}.npy'.format(band)))
+
+
+def compute_offsets_bandmerged(clusterview,
+                               destination=os.path.join(constants.DESTINATION,
+                                                        'calibration')):
+    """Computes the offsets in all bands using one crossmatch per field pair.
+
+    The output consists of the same offsets-{band}.csv and offsets-{band}.npy
+    files as produced by `compute_offsets_band`, but all the files are
+    written in a single pass over the bandmerged catalogues.
+
+    Parameters
+    ----------
+    clusterview : cluster view derived used e.g. IPython.parallel.Client()[:]
+        Work will be spread across the nodes in this cluster view.
+
+    destination : string
+        Directory where the output csv files will be written.
+    """
+    log.info('Starting to compute offsets from the bandmerged catalogues')
+
+    # Write the results
+    util.setup_dir(destination)
+    out = {}
+    chunks = {}
+    for band in constants.BANDS:
+        filename = os.path.join(destination, 'offsets-{0}.csv'.format(band))
+        out[band] = open(filename, 'w')
+        out[band].write(','.join(COLUMNS)+'\n')
+        chunks[band] = []
+
+    # Distribute the work across the cluster
+    fields = IPHASQC['id'][constants.IPHASQC_COND_RELEASE]
+    np.random.shuffle(fields)  # Avoid one node getting all the crowded fields
+    results = clusterview.imap(offsets_one_bandmerged, fields)
+
+    # Write offsets to the CSV files as the results are returned
+    i = 0
+    for offsets in results:
+        i += 1
+        for band in constants.BANDS:
+            for row in offsets[band]:
+                if row is not None:
+                    out[band].write(ROW_FORMAT.format(**row))
+            chunks[band].append(rows_to_array(offsets[band]))
+        # Print a friendly status message once in a while
+        if (i % 100) == 0:
+            log.info('Completed field {0}/{1}'.format(i, len(fields)))
+            for band in constants.BANDS:
+                out[band].flush()
+
+    for band in constants.BANDS:
+        out[band].close()
+        write_binary(chunks[band],
+                     os.path.join(destination, 'offsets-{0}.npy'.format(band)))
+
+
 def compute_offsets_band(clusterview, band, 
                          destination=os.path.join(constants.DESTINATION,
                                                   'calibration')):
@@ -225,6 +637,10 @@ def compute_offsets_band(clusterview, band,
         offset -- median(run1_magnitudes - run2_magnitudes)
         std    -- stdev(run1_magnitudes - run2_magnitudes)
         n      -- number of crossmatched stars used in computing offset/std.
+        mad    -- median absolute deviation of the magnitude differences.
+        mean   -- sigma-clipped mean of the magnitude differences.
+        err    -- bootstrap uncertainty of the offset.
+    The same table is written in binary form to offsets-{band}.npy.
 
     Parameters
     ----------
@@ -244,7 +660,8 @@ def compute_offsets_band(clusterview, band,
     util.setup_dir(destination)
     filename = os.path.join(destination, 'offsets-{0}.csv'.format(band))
     out = open(filename, 'w')
-    out.write('run1,run2,offset,std,n\n')
+    out.write(','.join(COLUMNS)+'\n')
+    chunks = []
 
     # Distribute the work across the cluster
     runs = IPHASQC['run_'+str(band)][constants.IPHASQC_COND_RELEASE]
@@ -258,23 +675,34 @@ def compute_offsets_band(clusterview, band,
         i += 1
         for row in offsets:
             if row is not None:
-                out.write('{run1},{run2},{offset},{std},{n}\n'.format(**row))
+                out.write(ROW_FORMAT.format(**row))
+        chunks.append(rows_to_array(offsets))
         # Print a friendly status message once in a while
         if (i % 100) == 0:
             log.info('Completed run {0}/{1}'.format(i, len(runs)))
             out.flush()
 
     out.close()
+    write_binary(chunks,
+                 os.path.join(destination, 'offsets-{0}.npy'.format(band)))
 
 
-def compute_offsets(clusterview):
+def compute_offsets(clusterview, bandmerged=False):
     """Computes magnitude offsets for all overlapping runs and all bands.
 
     Parameters
     ----------
     clusterview : cluster view derived used e.g. IPython.parallel.Client()[:]
         Work will be spread across the nodes in this cluster view.
+
+    bandmerged : bool
+        If True, derive the offsets in all bands from a single crossmatch
+        between the bandmerged catalogues of each pair of overlapping fields,
+        rather than crossmatching the single-band catalogues once per band.
     """   
-    for band in constants.BANDS:
-        compute_offsets_band(clusterview, band)
+    if bandmerged:
+        compute_offsets_bandmerged(clusterview)
+    else:
+        for band in constants.BANDS:
+            compute_offsets_band(clusterview, band)
 
@@ -23,6 +23,8 @@ from astropy.io import fits
 from astropy import log
 import util
 import constants
+import shiftstore
+import stiltsworker
 from constants import IPHASQC
 
 __author__ = 'Geert Barentsen'
@@ -37,6 +39,11 @@ __credits__ = ['Geert Barentsen', 'Hywel Farnhill', 'Janet Drew']
 # Where to store temporary files
 TMPDIR = '/tmp'
 
+# Read the uncalibrated 'bandmerged' catalogues and apply the calibration
+# shifts on read? If False, the 'bandmerged-calibrated' copies are used,
+# which requires `calibration.apply_calibration` to have been run.
+CALIBRATE_ON_READ = True
+
 # CACHE registers sourceID's for wich a primaryID has already been assigned
 CACHE = {}  # (Beats any key-value db)
 
@@ -170,13 +177,15 @@ class SeamMachine(object):
                   'OUT': self.output_file}
 
         cmd = "{STILTS} tmatch2 progress=none find=best1 in1={IN1} in2={IN2} "
+        if CALIBRATE_ON_READ:
+            cmd += "icmd1='{0}' ".format(self.calibration_cmd(self.fieldid))
         cmd += "matcher=exact join=all1 suffix1='' "
         cmd += "values1='sourceID' values2='sourceID' "
         cmd += "ocmd='delcols sourceID_2' out='{OUT}' "
 
         stilts_cmd = cmd.format(**config)
         log.debug(stilts_cmd)
-        status = os.system(stilts_cmd)
+        status = stiltsworker.system(stilts_cmd)
         if status == 0:
             self.log_info('adding primaryID column: stilts returned '+str(status))
         else:
@@ -205,22 +214,39 @@ class SeamMachine(object):
         fieldid : str
             e.g. '0001_aug2003'
         """
-        return os.path.join(constants.DESTINATION,
-                            'bandmerged-calibrated',
+        if CALIBRATE_ON_READ:
+            return os.path.join(constants.PATH_BANDMERGED,
+                                '{0}.fits'.format(fieldid))
+        return os.path.join(constants.PATH_BANDMERGED_CALIBRATED,
                             '{0}.fits'.format(fieldid))
 
+    def calibration_cmd(self, fieldid):
+        """Returns the stilts steps which calibrate the catalogue of a field.
+
+        The shifts are looked up in the store written by
+        `calibration.calibrate` (cf. `dr2.shiftstore`).
+        """
+        return shiftstore.calibration_cmd(
+                            shiftstore.get_store().get_field_shifts(fieldid))
+
     def crossmatch_command(self):
         """Return the stilts command to crossmatch overlapping fields.
         """
         # Operations to perform on all tables
         icmd = """keepcols "sourceID fieldID ra dec nBands errBits seeing \
                              rAxis rMJD r rErr i iErr ha haErr" """
+        if CALIBRATE_ON_READ:
+            # The calibration is applied before selecting the columns
+            icmds = ['{0}; {1}'.format(self.calibration_cmd(field), icmd)
+                     for field in [self.fieldid] + list(self.overlaps)]
+        else:
+            icmds = [icmd] * (len(self.overlaps) + 1)
         # Keywords in stilts command
         config = {'STILTS': constants.STILTS,
                   'MATCHING_DISTANCE': constants.MATCHING_DISTANCE,
                   'NIN': len(self.overlaps) + 1,
                   'IN1': self.filename(self.fieldid),
-                  'ICMD': icmd,
+                  'ICMD': icmds[0],
                   'OUT': self.crossmatch_file}
         # Create stilts command
         # FIXME: add progress=none
@@ -233,7 +259,7 @@ class SeamMachine(object):
             cmd += "in{0}={1} ".format(i+2,
                                        self.filename(self.overlaps[i]))
             cmd += "values{0}='ra dec' ".format(i+2)
-            cmd += "icmd{0}='{ICMD}' ".format(i+2, **config)
+            cmd += "icmd{0}='{1}' ".format(i+2, icmds[i+1])
         cmd += "out='{OUT}' "
 
         stilts_cmd = cmd.format(**config)
@@ -245,7 +271,7 @@ class SeamMachine(object):
         cmd = self.crossmatch_command()
         self.log_debug('Overlaps: {0}'.format(self.overlaps))
         self.log_debug(cmd)
-        status = os.system(cmd)
+        status = stiltsworker.system(cmd)
         self.log_info('crossmatch: stilts returned '+str(status))
         if status == 256:
             self.log_info('Failed command: '+str(cmd))
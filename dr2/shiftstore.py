@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Provides fast access to the calibration shifts.
+
+The shifts derived by `dr2.calibration` are stored in the "calibration-{band}.csv"
+files. Several steps in the pipeline need to look up the shift of a run or
+of a field many thousands of times, so this module converts the csv files
+into two compact binary tables which are sorted for binary search:
+
+* "shifts-runs.npy" maps run => (shift, uncertainty of the shift);
+* "shifts-fields.npy" maps field => (shift_r, shift_i, shift_ha).
+
+The tables are memory-mapped and are loaded only once per process.
+
+This module also provides `calibration_cmd` and `read_calibrated`, which
+apply the shifts to a bandmerged catalogue on read (using stilts and Python
+respectively), such that the later steps of the pipeline do not require a
+calibrated copy of each catalogue.
+"""
+from __future__ import division, print_function, unicode_literals
+from astropy.io import ascii
+from astropy.io import fits
+from astropy.table import Table
+from astropy import log
+import numpy as np
+import os
+
+from dr2 import constants
+
+__author__ = 'Geert Barentsen'
+__copyright__ = 'Copyright, The Authors'
+__credits__ = ['Geert Barentsen', 'Hywel Farnhill', 'Janet Drew']
+
+
+####################
+# CONSTANTS & CONFIG
+####################
+
+RUNS_FILENAME = 'shifts-runs.npy'
+FIELDS_FILENAME = 'shifts-fields.npy'
+
+# Magnitude columns in the bandmerged catalogues which require calibration
+MAGNITUDE_COLUMNS = {'r': ['r', 'rPeakMag', 'rAperMag1', 'rAperMag3'],
+                     'i': ['i', 'iPeakMag', 'iAperMag1', 'iAperMag3'],
+                     'ha': ['ha', 'haPeakMag', 'haAperMag1', 'haAperMag3']}
+# Colour columns, which are the difference between two magnitude columns
+COLOUR_COLUMNS = {'rmi': ('r', 'i'),
+                  'rmha': ('r', 'ha')}
+
+
+###########
+# CLASSES
+###########
+
+class ShiftStore(object):
+    """Looks up calibration shifts by run or by field.
+
+    Parameters
+    ----------
+    runs : structured array
+        Columns 'run', 'shift' and 'err', sorted by run;
+        'err' is NaN if the uncertainty is unknown.
+
+    fields : structured array
+        Columns 'field', 'r', 'i' and 'ha', sorted by field.
+        Shifts which are unknown are NaN.
+    """
+
+    def __init__(self, runs, fields):
+        self.runs = runs
+        self.fields = fields
+
+    @classmethod
+    def load(cls, directory=constants.CALIBDIR):
+        """Returns the store written by `write_store` (memory-mapped).
+
+        Falls back to reading the csv files if the store does not exist,
+        or if any of the csv files is more recent than the store (e.g.
+        because a band was re-calibrated using `calibrate_band`).
+        """
+        path_runs = os.path.join(directory, RUNS_FILENAME)
+        path_fields = os.path.join(directory, FIELDS_FILENAME)
+        if not (os.path.exists(path_runs) and os.path.exists(path_fields)):
+            log.warning('{0} not found, reading the csv files'.format(path_runs))
+            return cls.from_csv(directory)
+        mtime = min(os.path.getmtime(path_runs), os.path.getmtime(path_fields))
+        for band in constants.BANDS:
+            path_csv = os.path.join(directory,
+                                    'calibration-{0}.csv'.format(band))
+            if os.path.exists(path_csv) and os.path.getmtime(path_csv) > mtime:
+                log.warning('{0} is outdated, reading the csv files'.format(
+                                                                path_runs))
+                return cls.from_csv(directory)
+        return cls(np.load(path_runs, mmap_mode='r'),
+                   np.load(path_fields, mmap_mode='r'))
+
+    @classmethod
+    def from_csv(cls, directory=constants.CALIBDIR):
+        """Builds the store from the "calibration-{band}.csv" files."""
+        runs, shifts, errors = [], [], []
+        for band in constants.BANDS:
+            calib = ascii.read(os.path.join(directory,
+                                            'calibration-{0}.csv'.format(band)))
+            runs.append(np.asarray(calib['run']))
+            shifts.append(np.asarray(calib['shift']))
+            if 'err' in calib.colnames:
+                errors.append(np.asarray(calib['err'], dtype=float))
+            else:
+                errors.append(np.nan * np.ones(len(calib)))
+        runtable = np.zeros(sum(len(r) for r in runs),
+                            dtype=[('run', 'i4'), ('shift', 'f8'),
+                                   ('err', 'f8')])
+        runtable['run'] = np.concatenate(runs)
+        runtable['shift'] = np.concatenate(shifts)
+        runtable['err'] = np.concatenate(errors)
+        runtable.sort(order='run')
+
+        qc = constants.IPHASQC
+        fieldtable = np.zeros(len(qc), dtype=[('field', qc['id'].dtype),
+                                              ('r', 'f8'),
+                                              ('i', 'f8'),
+                                              ('ha', 'f8')])
+        fieldtable['field'] = qc['id']
+        store = cls(runtable, None)
+        for band in constants.BANDS:
+            fieldtable[band] = store.run_shifts(qc['run_' + band])
+        fieldtable.sort(order='field')
+        store.fields = fieldtable
+        return store
+
+    def save(self, directory=constants.CALIBDIR):
+        """Writes the store to disk."""
+        for filename, table in [(RUNS_FILENAME, self.runs),
+                                (FIELDS_FILENAME, self.fields)]:
+            path = os.path.join(directory, filename)
+            np.save(path, table)
+            log.info('Wrote {0}'.format(path))
+
+    def run_shifts(self, runs, column='shift'):
+        """Returns the shifts of an array of runs (NaN if unknown).
+
+        Use column='err' to obtain the uncertainties of the shifts instead.
+        """
+        runs = np.asarray(runs)
+        if len(self.runs) == 0 or column not in self.runs.dtype.names:
+            return np.nan * np.ones(runs.shape)
+        idx = np.searchsorted(self.runs['run'], runs)
+        idx[idx == len(self.runs)] = 0
+        found = (self.runs['run'][idx] == runs)
+        return np.where(found, self.runs[column][idx], np.nan)
+
+    def has_run(self, run):
+        """Returns True if the run is part of the calibration."""
+        return not np.isnan(self.run_shifts([run])[0])
+
+    def get_run_shift(self, run, default=0.0):
+        """Returns the shift to be added to the magnitudes of a run."""
+        shift = self.run_shifts([run])[0]
+        if np.isnan(shift):
+            return default
+        return shift
+
+    def get_run_error(self, run, default=np.nan):
+        """Returns the 1-sigma uncertainty of the shift of a run."""
+        err = self.run_shifts([run], column='err')[0]
+        if np.isnan(err):
+            return default
+        return err
+
+    def field_shifts(self, fieldids):
+        """Returns the shifts of an array of fields.
+
+        Returns
+        -------
+        shifts : structured array
+            Columns 'r', 'i' and 'ha'; NaN where the shift is unknown.
+        """
+        fieldids = np.asarray(fieldids)
+        idx = np.searchsorted(self.fields['field'], fieldids)
+        idx[idx == len(self.fields)] = 0
+        result = np.array(self.fields[idx])
+        unknown = self.fields['field'][idx] != fieldids
+        for band in constants.BANDS:
+            result[band][unknown] = np.nan
+        return result
+
+    def get_field_shifts(self, fieldid):
+        """Returns the calibration shifts for a given field.
+
+        Parameters
+        ----------
+        fieldid : str
+            Field identifier, e.g. "0001_aug2003"
+
+        Returns
+        -------
+        shifts : dictionary {'r':shift_r, 'i': shift_i, 'ha': shift_ha}
+            Shifts to add to the magnitudes to calibrate a field.
+        """
+        row = self.field_shifts([fieldid])[0]
+        shifts = {}
+        for band in constants.BANDS:
+            if np.isnan(row[band]):
+                log.warning('No shift for %s' % fieldid)
+                shifts[band] = 0.0
+            else:
+                shifts[band] = float(row[band])
+        log.debug("Shifts for {0}: {1}".format(fieldid, shifts))
+        return shifts
+
+
+###########
+# FUNCTIONS
+###########
+
+def calibration_cmd(shifts):
+    """Returns stilts processing steps which add the shifts to a catalogue.
+
+    Parameters
+    ----------
+    shifts : dictionary {'r':shift_r, 'i': shift_i, 'ha': shift_ha}
+
+    Returns
+    -------
+    cmd : str
+        Semicolon-separated 'replacecol' steps (which contain double quotes).
+    """
+    steps = []
+    for band in constants.BANDS:
+        for col in MAGNITUDE_COLUMNS[band]:
+            steps.append('replacecol {0} "toFloat({0}  + {1})"'.format(
+                                                            col, shifts[band]))
+    for col in ['rmi', 'rmha']:
+        band1, band2 = COLOUR_COLUMNS[col]
+        steps.append('replacecol {0} "toFloat({1}-{2})"'.format(col,
+                                                                band1, band2))
+    return '; '.join(steps)
+
+
+def read_calibrated(path, columns=None, shifts=None, store=None):
+    """Reads a bandmerged catalogue and applies the calibration shifts.
+
+    This is the Python counterpart of `calibration_cmd`: the shifts are
+    added to the magnitude columns, and the colour columns are corrected
+    for the difference of the shifts.
+
+    Parameters
+    ----------
+    path : str
+        Location of the bandmerged catalogue, e.g. ".../0001_aug2003.fits".
+
+    columns : list of str (optional)
+        Columns to read; defaults to all columns.
+
+    shifts : dictionary {'r':shift_r, 'i': shift_i, 'ha': shift_ha} (optional)
+        Defaults to the shifts of the field, which is identified by the
+        filename, in the shift store.
+
+    store : `ShiftStore` (optional)
+        Defaults to `get_store()`.
+
+    Returns
+    -------
+    table : `astropy.table.Table`
+    """
+    if shifts is None:
+        if store is None:
+            store = get_store()
+        fieldid = os.path.basename(path).split('.')[0]
+        shifts = store.get_field_shifts(fieldid)
+    with fits.open(path, memmap=True) as hdulist:
+        data = hdulist[1].data
+        if columns is None:
+            columns = data.columns.names
+        table = Table([np.array(data.field(col)) for col in columns],
+                      names=columns)
+    for band in constants.BANDS:
+        for col in MAGNITUDE_COLUMNS[band]:
+            if col in table.colnames:
+                table[col] = (table[col] + shifts[band]).astype(np.float32)
+    for col, (band1, band2) in COLOUR_COLUMNS.items():
+        if col in table.colnames:
+            table[col] = (table[col]
+                          + (shifts[band1] - shifts[band2])).astype(np.float32)
+    return table
+
+
+def write_store(directory=constants.CALIBDIR):
+    """Converts the "calibration-{band}.csv" files into the binary store."""
+    store = ShiftStore.from_csv(directory)
+    store.save(directory)
+    # Make sure this process does not keep using an outdated store
+    global STORE
+    STORE = store
+    return store
+
+
+def get_store():
+    """Returns the shift store, which is loaded once per process."""
+    global STORE
+    try:
+        return STORE
+    except NameError:
+        STORE = ShiftStore.load()
+        return STORE
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Executes stilts commands in a persistent Java virtual machine.
+
+Every stilts command executed through `os.system` pays for the start-up and
+warm-up of a new JVM, which dominates the run time of the many small commands
+issued by the band-merging, calibration, seaming and concatenation steps.
+
+This module starts a single long-lived `stilts server` per process and
+submits the commands to it over HTTP, such that the JVM is shared by all the
+fields processed by a cluster engine. The exit status and error message are
+reported per command; if the server is unavailable (or the command cannot be
+submitted to it, e.g. because it is not a plain stilts invocation), the
+command is executed through `os.system` as before.
+
+Usage
+-----
+The drop-in replacement for `os.system` is:
+
+    status = stiltsworker.system(cmd)
+
+where `status` follows the `os.system` convention (0 on success).
+The server is only used if `constants.STILTS_SERVER` is True.
+"""
+from __future__ import division, print_function
+import os
+import atexit
+import shlex
+import socket
+import subprocess
+import tempfile
+import time
+from astropy import log
+import constants
+
+try:
+    from urllib import urlencode
+    from urllib2 import urlopen, HTTPError, URLError
+except ImportError:  # Python 3
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+    from urllib.error import HTTPError, URLError
+
+__author__ = 'Geert Barentsen'
+__copyright__ = 'Copyright, The Authors'
+__credits__ = ['Geert Barentsen', 'Hywel Farnhill', 'Janet Drew']
+
+
+#############################
+# CONSTANTS & CONFIGURATION
+#############################
+
+# Context path of the stilts server
+BASEPATH = '/stilts'
+# How long to wait for the JVM to start accepting requests? (seconds)
+STARTUP_TIMEOUT = 60.
+# How long to wait for a command to complete? (seconds)
+# The command is executed using os.system if the server does not respond.
+REQUEST_TIMEOUT = 3600.
+# Status returned for a failed command, i.e. what os.system returns
+# for a command which exited with status 1
+FAILED_STATUS = 256
+
+
+###########
+# CLASSES
+###########
+
+class StiltsWorker(object):
+    """Runs stilts commands in a long-lived `stilts server` process.
+
+    Parameters
+    ----------
+    stilts : str
+        How to execute stilts, cf. `constants.STILTS`.
+        Commands which do not start with this string are executed
+        using `os.system`.
+
+    selftest : bool
+        Check that the server is able to write a table after start-up;
+        the server is not used if it fails to do so.
+    """
+
+    def __init__(self, stilts=constants.STILTS, selftest=True):
+        self.stilts = stilts
+        self.selftest = selftest
+        self.process = None
+        self.port = None
+        self.cwd = None
+        # Set to False once the server failed to start
+        self.available = True
+
+    def __del__(self):
+        self.stop()
+
+    def start(self):
+        """Starts the server, returns True if it accepts commands."""
+        if self.is_running():
+            return True
+        if not self.available:
+            return False
+        self.port = free_port()
+        self.cwd = os.getcwd()
+        args = shlex.split(self.stilts) + ['server',
+                                           'port={0}'.format(self.port),
+                                           'basepath={0}'.format(BASEPATH)]
+        log.debug('Starting stilts server: {0}'.format(' '.join(args)))
+        try:
+            with open(os.devnull, 'w') as devnull:
+                self.process = subprocess.Popen(args, cwd=self.cwd,
+                                                stdout=devnull,
+                                                stderr=subprocess.STDOUT)
+        except OSError as e:
+            return self._unavailable('cannot start the server: {0}'.format(e))
+        if not self._wait():
+            self.stop()
+            return self._unavailable('the server did not start')
+        if self.selftest and not self._selftest():
+            self.stop()
+            return self._unavailable('the server failed its self-test')
+        log.debug('stilts server running on port {0} (pid {1})'.format(
+                                                self.port, self.process.pid))
+        return True
+
+    def stop(self):
+        """Stops the server."""
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.process = None
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def execute(self, cmd):
+        """Executes a stilts command.
+
+        Parameters
+        ----------
+        cmd : str
+            Shell command, i.e. `constants.STILTS` followed by the task name
+            and its (shell-quoted) parameters.
+
+        Returns
+        -------
+        status, message : int, str
+            Exit status (following the `os.system` convention) and the
+            output or error message of the command.
+        """
+        arguments = self.arguments(cmd)
+        if arguments is None or (self.is_running() and os.getcwd() != self.cwd):
+            # Relative paths would be resolved against the wrong directory
+            return os.system(cmd), ''
+        if not self.start():
+            return os.system(cmd), ''
+        task, params = arguments
+        url = 'http://localhost:{0}{1}/task/{2}'.format(self.port, BASEPATH,
+                                                        task)
+        data = urlencode([(key.encode('utf-8'), value.encode('utf-8'))
+                          for key, value in params])
+        try:
+            response = urlopen(url, data.encode('ascii'), REQUEST_TIMEOUT)
+            return 0, response.read().decode('utf-8', 'replace')
+        except HTTPError as e:
+            # The task was run, but failed
+            return FAILED_STATUS, e.read().decode('utf-8', 'replace')
+        except (URLError, socket.error) as e:
+            # The server died (e.g. out of memory) or hangs, run it the old way
+            log.warning('stilts server lost ({0}), '
+                        'falling back to os.system'.format(e))
+            self.stop()
+            # Do not leave a partially written output in place
+            remove_outputs(params)
+            return os.system(cmd), ''
+
+    def execute_many(self, commands):
+        """Executes a sequence of stilts commands in the same JVM.
+
+        Returns
+        -------
+        results : list of (int, str)
+            Exit status and message of each command, cf. `execute`.
+        """
+        return [self.execute(cmd) for cmd in commands]
+
+    def arguments(self, cmd):
+        """Returns the task and parameters of a stilts command line.
+
+        The command is split into words by the shell itself, such that
+        the parameters are identical to those received by stilts when
+        the command is executed using `os.system`.
+
+        Returns
+        -------
+        task, params : str, list of (str, str)
+            Or None if the command is not a plain stilts invocation.
+        """
+        cmd = cmd.strip()
+        if not cmd.startswith(self.stilts):
+            return None
+        words = shell_words(cmd[len(self.stilts):])
+        if words is None or len(words) == 0 or words[0].startswith('-'):
+            # Stilts flags (e.g. -verbose) apply to the JVM, not the task
+            return None
+        params = []
+        for word in words[1:]:
+            if '=' not in word:
+                return None
+            key, value = word.split('=', 1)
+            params.append((key, value))
+        return words[0], params
+
+    def _wait(self):
+        """Waits for the server to accept connections."""
+        t_start = time.time()
+        while time.time() - t_start < STARTUP_TIMEOUT:
+            if self.process.poll() is not None:
+                return False
+            try:
+                socket.create_connection(('localhost', self.port), 1).close()
+                return True
+            except socket.error:
+                time.sleep(0.2)
+        return False
+
+    def _selftest(self):
+        """Checks that a table can be written through the server."""
+        handle, path = tempfile.mkstemp(suffix='.fits')
+        os.close(handle)
+        os.remove(path)
+        try:
+            status, message = self.execute(
+                '{0} tpipe in=:loop:1 out={1}'.format(self.stilts, path))
+            return status == 0 and os.path.exists(path)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _unavailable(self, reason):
+        log.warning('stilts server unavailable ({0}), '
+                    'falling back to os.system'.format(reason))
+        self.available = False
+        return False
+
+
+###########
+# FUNCTIONS
+###########
+
+def free_port():
+    """Returns a TCP port which is not in use."""
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def remove_outputs(params):
+    """Removes the files named by the `out` parameters of a stilts task."""
+    for key, value in params:
+        if key == 'out' and value not in ['', '-'] and os.path.isfile(value):
+            log.debug('Removing {0}'.format(value))
+            os.remove(value)
+
+
+def shell_words(args):
+    """Splits a string of command line arguments into words using the shell.
+
+    Returns None if the arguments contain shell constructs
+    (e.g. redirection) which cannot be passed on to the server.
+    """
+    if has_shell_operators(args):
+        return None
+    try:
+        output = subprocess.check_output("printf '%s\\0' " + args, shell=True)
+    except subprocess.CalledProcessError:
+        return None
+    return [word.decode('utf-8') for word in output.split(b'\0')[:-1]]
+
+
+def has_shell_operators(args):
+    """Returns True if the arguments use redirection, pipes, command lists
+    or command substitution outside quotes."""
+    quote = None
+    escaped = False
+    for i, char in enumerate(args):
+        if escaped:
+            escaped = False
+        elif quote == "'":
+            if char == "'":
+                quote = None
+        elif char == '\\':
+            escaped = True
+        elif char == '`' or args[i:i+2] == '$(':
+            return True
+        elif quote == '"':
+            if char == '"':
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char in '<>|&;':
+            return True
+    return False
+
+
+# One worker per process, i.e. per cluster engine
+_WORKER = None
+
+
+def get_worker():
+    """Returns the stilts worker of this process."""
+    global _WORKER
+    if _WORKER is None:
+        _WORKER = StiltsWorker()
+        atexit.register(_WORKER.stop)
+    return _WORKER
+
+
+def system(cmd):
+    """Executes a stilts command, like `os.system` but in a persistent JVM.
+
+    Falls back to `os.system` if `constants.STILTS_SERVER` is False or the
+    server is unavailable. Errors reported by the server are logged.
+
+    Returns
+    -------
+    status : int
+        Exit status, following the `os.system` convention.
+    """
+    if not constants.STILTS_SERVER:
+        return os.system(cmd)
+    status, message = get_worker().execute(cmd)
+    if status != 0 and message:
+        log.error('stilts returned {0}: {1}'.format(status, message.strip()))
+    return status
@@ -0,0 +1,194 @@
+import os
+import glob
+import json
+import shutil
+import tempfile
+import numpy as np
+import pytest
+from astropy.io import fits
+from .. import bandmerging
+
+# Output of stilts for sample fields, cf. scripts/make_bandmerge_fixture.py
+FIXTURE = os.path.join(os.path.dirname(__file__), 'data', 'bandmerge')
+
+
+def test_group_match():
+    """Sources within the radius should be grouped, one per catalogue."""
+    arcsec = 1 / 3600.
+    ra_r = np.array([10.0, 10.0 + 10 * arcsec, 10.0 + 20 * arcsec])
+    dec_r = np.array([0.0, 0.0, 0.0])
+    # i: matches r[0] and r[2]; ha: matches r[0], plus a second nearby
+    # source which cannot be matched uniquely
+    ra_i = np.array([10.0 + 20.3 * arcsec, 10.0 + 0.2 * arcsec])
+    dec_i = np.array([0.0, 0.0])
+    ra_ha = np.array([10.0 - 0.1 * arcsec, 10.0 + 0.6 * arcsec, 11.0])
+    dec_ha = np.array([0.0, 0.0, 0.0])
+    idx = bandmerging.group_match([ra_r, ra_i, ra_ha], [dec_r, dec_i, dec_ha],
+                                  radius=1.0)
+    rows = set([tuple(row) for row in idx])
+    assert(len(idx) == 5)
+    # The closest H-alpha source joins the group, the other forms a new row
+    assert((0, 1, 0) in rows)
+    assert((-1, -1, 1) in rows)
+    assert((1, -1, -1) in rows)
+    assert((2, 0, -1) in rows)
+    assert((-1, -1, 2) in rows)
+    # A chain of r and i sources at 0.9" intervals must be split into rows
+    # of sources within the radius, with every source appearing once
+    ra_r = 10.0 + np.array([0.0, 1.8]) * arcsec
+    ra_i = 10.0 + np.array([0.9, 2.7]) * arcsec
+    idx = bandmerging.group_match([ra_r, ra_i], [np.zeros(2), np.zeros(2)],
+                                  radius=1.0)
+    for k in range(2):
+        assert(sorted(idx[:, k][idx[:, k] >= 0]) == [0, 1])
+    for row in idx[(idx >= 0).all(axis=1)]:
+        assert(abs(ra_r[row[0]] - ra_i[row[1]]) < arcsec)
+    # The nearest pairs are matched first: r0-i0 (0.8") and r1-i1 (0.9")
+    # rather than i0-r1 (0.95")
+    ra_r = 10.0 + np.array([0.0, 1.75]) * arcsec
+    ra_i = 10.0 + np.array([0.8, 2.65]) * arcsec
+    idx = bandmerging.group_match([ra_r, ra_i], [np.zeros(2), np.zeros(2)],
+                                  radius=1.0)
+    assert(idx.tolist() == [[0, 0], [1, 1]])
+
+
+def test_matched_columns():
+    """The matched table should hold nulls where a band is missing."""
+    directory = tempfile.mkdtemp()
+
+    class MyBandMerge(bandmerging.BandMerge):
+        def get_catalogue_path(self, run):
+            return os.path.join(directory, '{0}_det.fits'.format(run))
+
+    for run, ra, err in [(1, [10.0, 10.1], [0.1, 0.1]),
+                         (2, [10.0, 10.2], [0.1, 0.1]),
+                         (3, [10.0, 10.3], [0.1, 2.0])]:
+        cols = fits.ColDefs([
+            fits.Column(name='detectionID', format='15A',
+                        array=np.array(['{0}-{1}'.format(run, k)
+                                        for k in range(2)])),
+            fits.Column(name='ccd', format='B', array=np.array([1, 2])),
+            fits.Column(name='class', format='I', array=np.array([-1, 1])),
+            fits.Column(name='ra', format='D', array=np.array(ra)),
+            fits.Column(name='dec', format='D', array=np.array([0.0, 0.0])),
+            fits.Column(name='aperMag2Err', format='E', array=np.array(err)),
+            fits.Column(name='saturated', format='L',
+                        array=np.array([True, True]))])
+        fits.BinTableHDU.from_columns(cols).writeto(
+                os.path.join(directory, '{0}_det.fits'.format(run)))
+
+    bm = MyBandMerge('0001_aug2003', 'A', 3, 1, 2)
+    columns = fits.BinTableHDU.from_columns(bm.get_matched_columns()).data
+    # One source in all bands, one in r, one in i; the faint one is dropped
+    assert(len(columns['ra_1']) == 3)
+    assert(list(np.isnan(columns['ra_1'])) == [False, False, True])
+    assert(list(columns['class_3']) == [-1, -32768, -32768])
+    assert(list(columns['ccd_2']) == [1, 255, 2])
+    assert(list(columns['saturated_3']) == [True, False, False])
+    assert(columns['detectionID_3'][1].strip() == '')
+
+
+def test_run_numpy():
+    """The numpy band-merger should write a readable catalogue."""
+    from .. import derivedcolumns
+    directory = tempfile.mkdtemp()
+
+    class MyBandMerge(bandmerging.BandMerge):
+        def get_catalogue_path(self, run):
+            return os.path.join(directory, '{0}_det.fits'.format(run))
+
+    # Two sources detected in r and i, of which one is detected in H-alpha
+    for run, n in [(1, 2), (2, 2), (3, 1)]:
+        cols = [fits.Column(name='ra', format='D',
+                            array=np.array([10.0, 10.1])[:n]),
+                fits.Column(name='dec', format='D', array=np.zeros(n)),
+                fits.Column(name='posErr', format='E',
+                            array=np.repeat(0.1, n)),
+                fits.Column(name='night', format='J',
+                            array=np.repeat(20030901, n)),
+                fits.Column(name='ccd', format='B', array=np.arange(1, n + 1))]
+        for name in derivedcolumns.BAND_COLUMNS:
+            if name == 'detectionID':
+                cols.append(fits.Column(name=name, format='15A',
+                            array=np.array(['#{0}-{1}'.format(run, k)
+                                            for k in range(n)])))
+            elif name == 'class':
+                cols.append(fits.Column(name=name, format='I',
+                                        array=np.repeat(-1, n)))
+            elif name == 'errBits':
+                cols.append(fits.Column(name=name, format='J',
+                                        array=np.zeros(n)))
+            elif name == 'mjd':
+                cols.append(fits.Column(name=name, format='D',
+                                        array=np.repeat(52900.5, n)))
+            else:
+                value = 0.05 if name.endswith('Err') else 15.0 + run
+                cols.append(fits.Column(name=name, format='E',
+                                        array=np.repeat(value, n)))
+        for name in derivedcolumns.FLAGS:
+            cols.append(fits.Column(name=name, format='L',
+                                    array=np.zeros(n, dtype=bool)))
+        fits.BinTableHDU.from_columns(cols).writeto(
+                os.path.join(directory, '{0}_det.fits'.format(run)))
+
+    bm = MyBandMerge('0001_aug2003', 'A', 3, 1, 2)
+    bm.output = os.path.join(directory, 'merged.fits')
+    for k in range(2):  # An existing output is overwritten
+        assert(bm.run('numpy') == 0)
+    with fits.open(bm.output) as hdulist:
+        data = hdulist[1].data
+        assert(data.columns.names == derivedcolumns.output_columns())
+        assert(hdulist[1].header['TTYPE1'] == 'ra')
+        assert(len(data) == 2)
+        assert(list(data['nBands']) == [3, 2])
+        assert(list(data['sourceID']) == ['#1-0', '#1-1'])
+        assert(list(data['ccd']) == [1, 2])
+        assert(np.allclose(data['rmi'], -1.0))
+        assert(data['rmha'][0] == np.float32(16.0) - np.float32(18.0))
+        assert(np.isnan(data['ha'][1]) and np.isnan(data['rmha'][1]))
+        assert(list(data['fieldID']) == ['0001_aug2003'] * 2)
+        assert(abs(data['l'][0] - 116.6806) < 1e-3)
+
+
+def test_stilts_fixture():
+    """The numpy band-merger should reproduce the output of stilts."""
+    fields = sorted(glob.glob(os.path.join(FIXTURE, '*', 'fixture.json')))
+    if len(fields) == 0:
+        pytest.skip('run scripts/make_bandmerge_fixture.py to create {0}'
+                    .format(FIXTURE))
+    for path in fields:
+        check_stilts_fixture(os.path.dirname(path))
+
+
+def check_stilts_fixture(fixture):
+    """Compares the numpy band-merge of a sample field against stilts."""
+    with open(os.path.join(fixture, 'fixture.json')) as fh:
+        config = json.load(fh)
+
+    class FixtureBandMerge(bandmerging.BandMerge):
+        def get_catalogue_path(self, run):
+            return os.path.join(fixture, '{0}_det.fits'.format(run))
+
+    bm = FixtureBandMerge(config['fieldid'], config['fieldgrade'],
+                          config['run_ha'], config['run_r'], config['run_i'])
+    directory = tempfile.mkdtemp()
+    try:
+        bm.output = os.path.join(directory, 'numpy.fits')
+        assert(bm.run('numpy') == 0)
+        reference = os.path.join(fixture, 'stilts.fits')
+        differences = bandmerging.compare_catalogues(bm.output, reference)
+        assert(differences.pop('columns') == [])
+        assert(dict((k, v) for k, v in differences.items() if v) == {})
+        # The tolerance of compare_catalogues is too coarse to tell ICRS
+        # from FK5 (~20 mas), hence the Galactic coordinates are checked
+        # to within 1 mas
+        numpy_cat, stilts_cat = fits.getdata(bm.output), fits.getdata(reference)
+        assert(len(numpy_cat) > 0)
+        order1 = np.argsort(numpy_cat['sourceID'])
+        order2 = np.argsort(stilts_cat['sourceID'])
+        dl = ((numpy_cat['l'][order1] - stilts_cat['l'][order2] + 180) % 360
+              - 180) * np.cos(np.radians(stilts_cat['b'][order2]))
+        db = numpy_cat['b'][order1] - stilts_cat['b'][order2]
+        assert(np.max(np.hypot(dl, db)) * 3.6e6 < 1.0)
+    finally:
+        shutil.rmtree(directory)
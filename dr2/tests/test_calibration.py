@@ -1,6 +1,12 @@
+import os
+import shutil
+import tempfile
 import numpy as np
 from numpy import all, abs
+from scipy import sparse
+from astropy.io import fits
 from .. import calibration
+from .. import offsets
 
 
 def test_glazebrook_equation():
@@ -48,3 +54,361 @@ def test_glazebrook_equation():
 
     solution_expected = [-1.25, -0.75, 0.0, -1.0]
     assert(all(abs(g.solution[0] - solution_expected) < 1e-7))
+
+
+class ExampleCalibration(object):
+    """The six-run example from the Glazebrook paper."""
+    def __init__(self):
+        self.runs = np.array([1, 2, 3, 4, 5, 6])
+        self.anchors = np.array([False, False, False, False, True, True])
+        self.overlaps = {1: {'runs': [2, 6], 'offsets': [0.5, 1.25],    'weights': [1, 1]},
+                         2: {'runs': [1, 6], 'offsets': [-0.5, 0.75],   'weights': [1, 1]},
+                         3: {'runs': [4],    'offsets': [-1.0],         'weights': [1]},
+                         4: {'runs': [3, 5], 'offsets': [+1.0, 1.0],    'weights': [1, 1]},
+                         5: {'runs': [4],    'offsets': [-1.0],         'weights': [1]},
+                         6: {'runs': [1, 2], 'offsets': [-1.25, -0.75], 'weights': [1, 1]}}
+    def get_runs(self):
+        return self.runs
+    def get_overlaps(self):
+        return self.overlaps
+    def get_anchors(self):
+        return self.anchors
+
+
+def test_glazebrook_solvers():
+    """All solver methods should agree on the Glazebrook paper example."""
+    expected = np.array([-1.25, -0.75, 0.0, -1.0, 0.0, 0.0])
+    for method in ['lsqr', 'cg', 'minres', 'direct']:
+        g = calibration.Glazebrook(ExampleCalibration())
+        shifts = g.solve(method=method)
+        assert(all(abs(shifts - expected) < 1e-7))
+        assert(g.info['method'] == method)
+        assert(g.info['residual'] < 1e-7)
+    # A perfect warm start requires no further iterations
+    g = calibration.Glazebrook(ExampleCalibration())
+    shifts = g.solve(method='cg', x0=expected)
+    assert(g.info['iterations'] == 0)
+    assert(all(abs(shifts - expected) < 1e-7))
+    # The incomplete LU preconditioner is not symmetric: gmres only
+    g = calibration.Glazebrook(ExampleCalibration())
+    shifts = g.solve(method='gmres', preconditioner='ilu')
+    assert(all(abs(shifts - expected) < 1e-7))
+    try:
+        g.solve(method='cg', preconditioner='ilu')
+        assert(False)
+    except ValueError:
+        pass
+    # The module defaults are read when solving
+    solver = calibration.SOLVER
+    try:
+        calibration.SOLVER = 'direct'
+        g = calibration.Glazebrook(ExampleCalibration())
+        g.solve()
+        assert(g.info['method'] == 'direct')
+    finally:
+        calibration.SOLVER = solver
+
+
+def test_calibration_session():
+    """The session should reproduce Glazebrook when anchors/shifts change."""
+    cal = ExampleCalibration()
+    session = calibration.CalibrationSession(cal, method='direct')
+    shifts = session.solve()
+    g = calibration.Glazebrook(cal)
+    assert(all(abs(shifts - g.solve(method='direct')) < 1e-10))
+
+    # Promote run 4 to an anchor with a shift; the offsets then change too
+    cal.shifts = np.array([0, 0, 0, 0.3, 0, 0])
+    cal.anchors = np.array([False, False, False, True, True, True])
+    for run, overlap in cal.overlaps.items():
+        overlap['offsets'] = [offset + cal.shifts[run-1] - cal.shifts[run2-1]
+                              for run2, offset in zip(overlap['runs'],
+                                                      overlap['offsets'])]
+    g = calibration.Glazebrook(cal)
+    assert(all(abs(session.solve() - g.solve(method='direct')) < 1e-8))
+    # The first factorization preconditions the solve with the new anchors
+    assert(session.info['method'] == 'cg')
+    assert(session.info['iterations'] <= 2)
+
+
+def test_glazebrook_components():
+    """Disconnected parts of the overlap graph should be solved separately."""
+    cal = ExampleCalibration()
+    # Add an island of two runs (7, 8) which does not contain an anchor
+    cal.runs = np.append(cal.runs, [7, 8])
+    cal.anchors = np.append(cal.anchors, [False, False])
+    cal.overlaps[7] = {'runs': [8], 'offsets': [0.2], 'weights': [1]}
+    cal.overlaps[8] = {'runs': [7], 'offsets': [-0.2], 'weights': [1]}
+    g = calibration.Glazebrook(cal)
+    shifts = g.solve(method='direct', components=True)
+    expected = np.array([-1.25, -0.75, 0.0, -1.0, 0.0, 0.0])
+    assert(all(abs(shifts[:6] - expected) < 1e-7))
+    # Runs 1+2 and 3+4 and the island are separate components
+    assert(len(np.unique(g.info['components'])) == 3)
+    assert(len(g.info['unanchored']) == 1)
+    # The island is solved in the least-squares sense
+    assert(abs((shifts[6] - shifts[7]) - (-0.2)) < 1e-7)
+
+
+def test_glazebrook_nights():
+    """The night model should be exact if the night zeropoints are."""
+    expected = np.array([-1.25, -0.75, 0.0, -1.0, 0.0, 0.0])
+    # One run per night: the night-level solve is already the solution
+    g = calibration.Glazebrook(ExampleCalibration())
+    shifts = g.solve(nights=np.arange(6))
+    assert(all(abs(shifts - expected) < 1e-7))
+    assert(g.info['method'] == 'hierarchical')
+    assert(g.info['iterations'] == 0)
+    # Runs 3 and 4 share a night, but their offset is real: the
+    # regularisation pulls them towards their common night zeropoint
+    nights = np.array([0, 1, 2, 2, 3, 4])
+    shifts = g.solve(nights=nights)
+    assert(abs(shifts[0] - expected[0]) < 1e-7)
+    assert(-1.0 < shifts[3] - shifts[2] < 0.0)
+
+
+def test_glazebrook_schwarz():
+    """Solving in overlapping longitude strips should reproduce the solution."""
+    expected = np.array([-1.25, -0.75, 0.0, -1.0, 0.0, 0.0])
+    # Runs 1 and 2 lie in different strips, as do runs 3 and 4
+    longitudes = np.array([29.5, 30.5, 34.5, 35.5, 36.0, 30.0])
+    blocks = calibration.decompose_strips(longitudes, stripwidth=5,
+                                          overlap=0.8)
+    assert(len(blocks) == 3)
+    assert(sum([owned.sum() for idx, owned in blocks]) == 6)
+    g = calibration.Glazebrook(ExampleCalibration())
+    shifts = g.solve(method='direct', longitudes=longitudes)
+    assert(all(abs(shifts - expected) < 1e-4))
+    assert(g.info['blocks'] == 3)
+
+
+def test_anchor_stability():
+    """Replicates should match a fresh solve with the anchors dropped."""
+    cal = ExampleCalibration()
+    cal.shifts = np.zeros(6)
+    cal.anchors = np.array([True, False, False, False, True, True])
+    session = calibration.CalibrationSession(cal, method='direct')
+    stability = calibration.AnchorStability(session, tol=1e-10)
+    # Dropping run 6 leaves runs 1 and 2 tied to run 1
+    delta, iterations = stability.solve_replicate(np.array([5]))
+    anchors = np.array([True, False, False, False, True, False])
+    assert(all(abs(delta - session.solve(anchors=anchors)) < 1e-7))
+    # Dropping run 5 leaves runs 3, 4 and 5 without an anchor
+    delta, iterations = stability.solve_replicate(np.array([4]))
+    assert(all(np.isnan(delta[2:5])))
+    # Each of the three anchors is dropped in one replicate
+    scatter = stability.run(mode='jackknife', n_replicates=3, processes=1)
+    assert(all(np.isfinite(scatter)))
+    assert(list(stability.count) == [3, 3, 2, 2, 2, 3])
+
+
+def test_joint_glazebrook():
+    """H-alpha without anchors should follow r through the coupling."""
+    cals = []
+    for band in ['r', 'i', 'ha']:
+        cal = ExampleCalibration()
+        cal.band = band
+        cal.shifts = np.zeros(6)
+        cal.apass_shifts = np.nan * np.ones(6)
+        cal.apass_matches = np.zeros(6)
+        cals.append(cal)
+    # H-alpha has no hard anchors, but its anchor-like runs couple strongly
+    cals[2].anchors = np.array([False, False, False, False, True, True])
+    joint = calibration.JointGlazebrook(cals, coupling=1e3,
+                                        anchor_coupling=1e6)
+    shifts = joint.solve(method='cg')
+    expected = np.array([-1.25, -0.75, 0.0, -1.0, 0.0, 0.0])
+    for band in ['r', 'i', 'ha']:
+        assert(all(abs(shifts[band] - expected) < 1e-4))
+    assert(len(joint.info['unanchored']) == 0)
+
+
+def test_closure_errors():
+    """A single bad offset should be isolated by its cycles."""
+    # 4x4 grid of runs, each overlapping with its 8 neighbours
+    runs = np.arange(16)
+    zeropoints = np.linspace(-0.1, 0.1, 16)
+    idx1, idx2 = [], []
+    for i in runs:
+        for j in runs:
+            if i != j and abs(i % 4 - j % 4) <= 1 and abs(i // 4 - j // 4) <= 1:
+                idx1.append(i)
+                idx2.append(j)
+    idx1, idx2 = np.array(idx1), np.array(idx2)
+    offsets = zeropoints[idx1] - zeropoints[idx2]
+    bad = ((idx1 == 5) & (idx2 == 6)) | ((idx1 == 6) & (idx2 == 5))
+    offsets[bad] += np.where(idx1[bad] == 5, 0.2, -0.2)
+    table = calibration.OverlapTable(runs, idx1, idx2, idx2, offsets,
+                                     np.ones(len(idx1)))
+    closure = calibration.closure_errors(table)
+    # Every cycle through the bad overlap is off by 0.2
+    assert(all(abs(np.abs(closure['triangles'][bad]) - 0.2) < 1e-10))
+    assert(all(abs(np.abs(closure['quadrilaterals'][bad]) - 0.2) < 1e-10))
+    inconsistent, error = calibration.inconsistent_overlaps(table)
+    assert(all(inconsistent == bad))
+
+
+def test_evaluate_anchor_rules():
+    """Anchors should pass all required rules, any optional, no exclusions."""
+    table = np.array([('a', 0.01, 1), ('b', 0.05, 1), ('c', 0.01, 0),
+                      ('d', -0.02, 0), ('e', 0.0, 1)],
+                     dtype=[('id', 'S1'), ('shift', 'f8'), ('anchor', 'i2')])
+    rules = {'rules': {'OK': {'all': [{'column': 'shift', 'abs': True,
+                                       'op': 'le', 'value': 0.03}]},
+                       'OLD': {'all': [{'column': 'anchor',
+                                        'op': 'eq', 'value': 1}]},
+                       'EXTRA': {'all': [{'column': 'id',
+                                          'op': 'in', 'value': ['d']}]},
+                       'BLACKLIST': {'all': [{'column': 'id',
+                                              'op': 'in', 'value': ['e']}]}},
+             'bands': {'r': {'require': ['OK'],
+                             'any': ['OLD', 'EXTRA'],
+                             'exclude': ['BLACKLIST']}}}
+    anchors, counts = calibration.evaluate_anchor_rules(table, 'r', rules)
+    assert(list(anchors) == [True, False, False, True, False])
+    assert(counts['OK'] == 4)
+    assert(counts['BLACKLIST'] == 1)
+
+
+def test_inverse_diagonal():
+    """The diagonal of the inverse should match the dense inverse."""
+    g = calibration.Glazebrook(ExampleCalibration())
+    g.solve(method='direct')
+    N = -g.A
+    expected = np.diag(np.linalg.inv(N.toarray()))
+    exact = calibration.inverse_diagonal(N, method='exact')
+    assert(all(abs(exact - expected) < 1e-10))
+    stochastic = calibration.inverse_diagonal(N, method='stochastic',
+                                              n_samples=2000)
+    assert(all(abs(stochastic / expected - 1) < 0.1))
+    # The example fits the offsets perfectly, hence the errors are zero
+    errors = g.uncertainties(method='exact')
+    assert(all(abs(errors) < 1e-7))
+
+
+def test_stochastic_uncertainties():
+    """Stochastic estimates should approximate the exact ones, or be NaN."""
+    # Chain of 30 runs with an anchor at one end
+    n = 30
+    N = sparse.diags([-np.ones(n - 1), 2 * np.ones(n), -np.ones(n - 1)],
+                     [-1, 0, 1]).tolil()
+    N[n - 1, n - 1] = 1
+    inverse = np.linalg.inv(N.toarray())
+    exact = calibration.inverse_diagonal(N, method='exact')
+    assert(all(abs(exact - np.diag(inverse)) < 1e-8))
+    n_samples = calibration.UNCERTAINTY_SAMPLES
+    stochastic = calibration.inverse_diagonal(N, method='stochastic',
+                                              n_samples=n_samples)
+    # The variance of the estimator is the sum of the squared
+    # off-diagonal elements of the inverse, divided by n_samples
+    sigma = np.sqrt(((inverse**2).sum(axis=1) - exact**2) / n_samples)
+    assert(all(abs(stochastic - exact) < 5 * sigma))
+    # ... which is not small for such a strongly correlated system
+    assert(np.median(abs(stochastic / exact - 1)) > 0.05)
+    # Strongly correlated unknowns yield negative estimates for few samples
+    M = np.array([[1., .6, .6], [.6, 1., .6], [.6, .6, 1.]])
+    N = sparse.csr_matrix(np.linalg.inv(M))
+    n_nan = 0
+    for seed in range(10):
+        diagonal = calibration.inverse_diagonal(N, method='stochastic',
+                                                n_samples=1, seed=seed)
+        valid = ~np.isnan(diagonal)
+        assert(all(diagonal[valid] > 0))
+        n_nan += (~valid).sum()
+    assert(n_nan > 0)
+
+
+def test_calibrate_numpy():
+    """Applying shifts should update the magnitudes and colours only."""
+    mags = np.array([15.0, np.nan, 18.25], dtype=np.float32)
+    columns = [fits.Column(name='sourceID', format='5A',
+                           array=np.array(['a', 'b', 'c']))]
+    for band, offset in [('r', 0.), ('i', -1.), ('ha', -0.5)]:
+        for name in calibration.MAGNITUDE_COLUMNS[band]:
+            columns.append(fits.Column(name=name, format='E',
+                                       array=mags + offset))
+    for name in ['rmi', 'rmha']:
+        columns.append(fits.Column(name=name, format='E',
+                                   array=np.zeros(3, dtype=np.float32)))
+    shifts = {'r': 0.1, 'i': -0.2, 'ha': 0.3}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path_in = os.path.join(tmpdir, 'in.fits')
+        path_out = os.path.join(tmpdir, 'out.fits')
+        fits.BinTableHDU.from_columns(columns).writeto(path_in)
+        # Bypass __init__, which loads the shifts of the survey
+        applicator = calibration.CalibrationApplicator.__new__(
+                                    calibration.CalibrationApplicator)
+        for k in range(2):  # An existing output is overwritten
+            assert(applicator._calibrate_numpy(path_in, path_out, shifts) == 0)
+        data_in = fits.getdata(path_in)
+        data_out = fits.getdata(path_out)
+        assert(data_out.columns.names == data_in.columns.names)
+        assert(list(data_out['sourceID']) == ['a', 'b', 'c'])
+        for band, offset in [('r', 0.), ('i', -1.), ('ha', -0.5)]:
+            expected = (mags + offset + shifts[band]).astype(np.float32)
+            for name in calibration.MAGNITUDE_COLUMNS[band]:
+                assert(data_out[name].dtype.kind == 'f')
+                assert(np.array_equal(data_out[name][[0, 2]], expected[[0, 2]]))
+                assert(np.isnan(data_out[name][1]))
+                # The input catalogue is left untouched
+                assert(np.array_equal(data_in[name][[0, 2]],
+                                      (mags + offset)[[0, 2]]))
+        assert(np.allclose(data_out['rmi'][[0, 2]], 1. + 0.1 + 0.2))
+        assert(np.allclose(data_out['rmha'][[0, 2]], 0.5 + 0.1 - 0.3))
+        assert(np.isnan(data_out['rmi'][1]) and np.isnan(data_out['rmha'][1]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_offsets_binary():
+    """The csv and binary offsets files should yield the same overlaps."""
+    values = [(1, 2, 0.25, 9), (2, 1, -0.25, 9), (2, 3, 0.5, 4),
+              (3, 2, -0.5, 4), (3, 99, 1.0, 16)]
+    rows = [dict(zip(offsets.COLUMNS, (run1, run2, offset, 0.125, n,
+                                       0.0625, offset, 0.03125)))
+            for run1, run2, offset, n in values]
+    array = offsets.rows_to_array(rows[:2] + [None] + rows[2:])
+    assert(array.dtype == np.dtype(offsets.BINARY_DTYPE))
+    assert(list(array['run1']) == [1, 2, 2, 3, 3])
+    # Calibration object which only knows about the runs and the offsets
+    cal = calibration.Calibration.__new__(calibration.Calibration)
+    cal.band = 'r'
+    cal.runs = np.array([1, 2, 3])
+    cal.shifts = np.array([0.0, 0.1, -0.2])
+    tmpdir = tempfile.mkdtemp()
+    calibdir = calibration.CALIBDIR
+    try:
+        calibration.CALIBDIR = tmpdir
+        path_csv = os.path.join(tmpdir, 'offsets-r.csv')
+        path_npy = os.path.join(tmpdir, 'offsets-r.npy')
+        with open(path_csv, 'w') as out:
+            out.write(','.join(offsets.COLUMNS) + '\n')
+            for row in rows:
+                out.write(offsets.ROW_FORMAT.format(**row))
+        tables = {}
+        for binary in [False, True]:
+            if binary:
+                offsets.write_binary([array], path_npy)
+                # The most recent file is used
+                os.utime(path_csv, (1e9, 1e9))
+            cal._load_offsetdata()
+            assert(isinstance(cal.offsetdata, np.ndarray) == binary)
+            tables[binary] = cal.get_overlap_table()
+        # A csv file which is more recent than the binary file takes precedence
+        os.utime(path_npy, (1e9 - 1, 1e9 - 1))
+        cal._load_offsetdata()
+        assert(not isinstance(cal.offsetdata, np.ndarray))
+        for attr in ['idx1', 'idx2', 'run1', 'run2', 'offsets', 'weights',
+                     'indptr']:
+            assert(np.array_equal(getattr(tables[False], attr),
+                                  getattr(tables[True], attr)))
+        assert(list(tables[True].run2) == [2, 1, 3, 2])
+        assert(np.allclose(tables[True].offsets, [0.15, -0.15, 0.8, -0.8]))
+        # Converting the csv file yields the same binary file
+        os.remove(path_npy)
+        offsets.convert_offsets('r', destination=tmpdir)
+        assert(np.array_equal(np.load(path_npy), array))
+    finally:
+        calibration.CALIBDIR = calibdir
+        shutil.rmtree(tmpdir)
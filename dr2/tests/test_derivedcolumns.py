@@ -0,0 +1,83 @@
+import shlex
+import numpy as np
+from collections import OrderedDict
+from astropy.coordinates import SkyCoord
+from astropy import units as u
+from .. import derivedcolumns
+
+
+def test_output_columns():
+    """The columns should be those kept by stilts-band-merging.cmd."""
+    with open(derivedcolumns.CMDFILE) as cmdfile:
+        for line in cmdfile:
+            if line.startswith('keepcols'):
+                keepcols = shlex.split(line)[1].split()
+    assert(derivedcolumns.output_columns() == keepcols)
+
+
+def test_galactic():
+    """Galactic coordinates should be derived from ICRS, not FK5."""
+    rng = np.random.RandomState(0)
+    ra = rng.uniform(0, 360, 100)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, 100)))
+    l, b = derivedcolumns.galactic(ra, dec)
+    result = SkyCoord(l * u.deg, b * u.deg, frame='galactic')
+    # SLALIB's Hipparcos-FK5 rotation and the IAU frame bias used by
+    # astropy differ by a few mas; FK5 and ICRS differ by up to ~30 mas
+    icrs = SkyCoord(ra * u.deg, dec * u.deg, frame='icrs').galactic
+    assert(result.separation(icrs).max().to(u.mas).value < 3)
+    fk5 = SkyCoord(ra * u.deg, dec * u.deg, frame='fk5').galactic
+    assert(result.separation(fk5).max().to(u.mas).value > 10)
+
+
+def test_merged_class():
+    """Class probabilities should follow the stilts expressions."""
+    null = derivedcolumns.NULL_VALUES['I']
+    cat = {'rClass': np.array([-1, -9, 5, 0], dtype=np.int16),
+           'iClass': np.array([-1, -9, -1, null], dtype=np.int16),
+           'haClass': np.array([null, null, -1, null], dtype=np.int16)}
+    p = derivedcolumns.merged_probabilities(cat)
+    pstar = np.float32(0.9) * np.float32(0.9)
+    pother = np.float32(0.05) * np.float32(0.05)
+    assert(p['pStar'].dtype == np.float32)
+    assert(p['pStar'][0] == pstar / (pstar + pother + pother + np.float32(0)))
+    # An unknown class yields a null probability
+    assert(np.isnan(p['pStar'][2]))
+    cls = derivedcolumns.merged_class(p['pStar'], p['pGalaxy'],
+                                      p['pNoise'], p['pSaturated'])
+    assert(list(cls) == [-1, -9, null, 0])
+
+
+def test_bandmerged_columns():
+    """Columns should fall back on the first band with a detection."""
+    matched = OrderedDict()
+    # The first source is detected in r and i, the second in H-alpha only
+    for k, detected in enumerate([[True, False], [True, False],
+                                  [False, True]]):
+        detected = np.array(detected)
+        suffix = '_{0}'.format(k + 1)
+        for name in list(derivedcolumns.BAND_COLUMNS) + ['ra', 'dec',
+                                                         'posErr', 'badPix']:
+            matched[name + suffix] = np.where(detected, 15.0 + k, np.nan)
+        for name, fmt, dtype in [('class', 'I', np.int16),
+                                 ('errBits', 'J', np.int32),
+                                 ('night', 'J', np.int32),
+                                 ('ccd', 'B', np.uint8)]:
+            matched[name + suffix] = np.where(
+                        detected, k + 1,
+                        derivedcolumns.NULL_VALUES[fmt]).astype(dtype)
+        for name in derivedcolumns.FLAGS[:-1]:
+            matched[name + suffix] = np.array([k == 1, False])
+        matched['detectionID' + suffix] = np.where(
+                        detected, 'id{0}'.format(k + 1), '').astype('S15')
+    cat = derivedcolumns.derive(derivedcolumns.merge_bands(matched),
+                                '0001_aug2003', 'A')
+    assert(list(cat['sourceID']) == [b'id1', b'id3'])
+    assert(list(cat['ra']) == [15.0, 17.0])
+    assert(list(cat['ccd']) == [1, 3])
+    assert(list(cat['nBands']) == [2, 1])
+    assert(list(cat['errBits']) == [2, 3])
+    assert(list(cat['deblend']) == [True, False])
+    assert(cat['iXi'][0] == 3600.)
+    assert(np.isnan(cat['haXi'][0]) and cat['haXi'][1] == 0)
+    assert(list(cat['fieldID']) == [b'0001_aug2003'] * 2)
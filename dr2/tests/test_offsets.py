@@ -0,0 +1,72 @@
+import numpy as np
+from .. import offsets
+
+
+def test_grouped_statistics():
+    """Compares the vectorised group-by statistics against plain numpy."""
+    groups = [np.array([1., 2., 3., 4., 5., 100.]),
+              np.array([0.5]),
+              np.array([]),
+              np.array([-1., 1., 0., 2.])]
+    segments = np.concatenate(([0], np.cumsum([len(g) for g in groups])))
+    stats = offsets.grouped_statistics(np.concatenate(groups), segments,
+                                       nsigma=2, n_bootstrap=20)
+    for k, values in enumerate(groups):
+        assert(stats['n'][k] == len(values))
+        if len(values) == 0:
+            assert(np.isnan(stats['median'][k]))
+            continue
+        assert(stats['median'][k] == np.median(values))
+        assert(stats['mad'][k] == np.median(np.abs(values - np.median(values))))
+        assert(np.abs(stats['std'][k] - np.std(values)) < 1e-10)
+        assert(stats['err'][k] >= 0)
+    # The outlier in the first group is clipped
+    assert(stats['mean'][0] == 3.0)
+    # A single value has no bootstrap scatter
+    assert(stats['err'][1] == 0)
+    # The bootstrap is reproducible, and skipped by default
+    again = offsets.grouped_statistics(np.concatenate(groups), segments,
+                                       nsigma=2, n_bootstrap=20)
+    assert(np.array_equal(stats['err'][[0, 1, 3]], again['err'][[0, 1, 3]]))
+    default = offsets.grouped_statistics(np.concatenate(groups), segments)
+    assert(np.isnan(default['err']).all())
+
+
+class SyntheticBandmergedOffsetMachine(offsets.BandmergedOffsetMachine):
+    """Offset machine for in-memory catalogues (bypasses IPHASQC)."""
+
+    def __init__(self, fieldid, catalogues):
+        self.fieldid = fieldid
+        self.catalogues = catalogues
+        self.data = self.get_data(fieldid)
+
+    def get_data(self, fieldid):
+        return self.catalogues[fieldid]
+
+
+def test_bandmerged_offsets():
+    """One crossmatch should yield the differences of all three bands."""
+    arcsec = 1 / 3600.
+    field1 = {'ra': np.array([10., 10.01, 10.02, 10.03]),
+              'dec': np.zeros(4),
+              'r': np.array([16., 16.5, 17., 16.]),
+              'i': np.array([15., 15.5, 17., 15.]),
+              'ha': np.array([16., 16.5, 17., 16.])}
+    # The last source lies beyond the matching distance
+    field2 = {'ra': field1['ra'] + np.array([0.1, 0.2, 0.3, 0.6]) * arcsec,
+              'dec': np.zeros(4),
+              'r': field1['r'] - 0.1,
+              'i': field1['i'] + 0.2,
+              'ha': field1['ha'] - 0.3}
+    for data in [field1, field2]:
+        for band in ['r', 'i', 'ha']:
+            data[band + 'ErrBits'] = np.zeros(4, dtype=int)
+    # The second source is not reliable in H-alpha
+    field1['haErrBits'][1] = 2
+    machine = SyntheticBandmergedOffsetMachine('f1', {'f1': field1,
+                                                      'f2': field2})
+    differences = machine._matched_differences('f2')
+    # The third source is reliable in r and ha but too faint in i
+    assert(np.allclose(differences['r'], [0.1, 0.1, 0.1]))
+    assert(np.allclose(differences['i'], [-0.2, -0.2]))
+    assert(np.allclose(differences['ha'], [0.3, 0.3]))
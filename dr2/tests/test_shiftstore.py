@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from astropy.io import fits
+from .. import constants
+from .. import shiftstore
+
+
+def test_shift_store():
+    """Lookups by run and by field should be exact and handle unknowns."""
+    runs = np.array([(100, 0.1, 0.01), (200, -0.2, np.nan), (300, 0.3, 0.02)],
+                    dtype=[('run', 'i4'), ('shift', 'f8'), ('err', 'f8')])
+    fields = np.array([(b'0001_aug2003', 0.1, 0.2, np.nan),
+                       (b'0002_aug2003', -0.1, 0.0, 0.3)],
+                      dtype=[('field', 'S20'), ('r', 'f8'),
+                             ('i', 'f8'), ('ha', 'f8')])
+    store = shiftstore.ShiftStore(runs, fields)
+    result = store.run_shifts([300, 100, 150, 400])
+    assert(np.allclose(result[:2], [0.3, 0.1]))
+    assert(np.isnan(result[2:]).all())
+    assert(store.has_run(200))
+    assert(not store.has_run(999))
+    assert(store.get_run_shift(999) == 0.0)
+    assert(store.get_run_error(300) == 0.02)
+    assert(store.get_run_error(200, default=0.0) == 0.0)
+    assert(store.get_field_shifts('0002_aug2003') == {'r': -0.1, 'i': 0.0, 'ha': 0.3})
+    # Unknown shifts are returned as zero
+    assert(store.get_field_shifts('0001_aug2003')['ha'] == 0.0)
+    assert(np.isnan(store.field_shifts(['9999_aug2003'])['r'][0]))
+
+
+def test_outdated_store():
+    """The csv files should be used if they are more recent than the store."""
+    run = constants.IPHASQC['run_r'][0]
+    tmpdir = tempfile.mkdtemp()
+
+    def write_csv(shift):
+        for band in constants.BANDS:
+            with open(os.path.join(tmpdir, 'calibration-{0}.csv'.format(band)),
+                      'w') as out:
+                out.write('run,shift\n')
+                if band == 'r':
+                    out.write('{0},{1}\n'.format(run, shift))
+
+    try:
+        write_csv(0.1)
+        shiftstore.ShiftStore.from_csv(tmpdir).save(tmpdir)
+        assert(shiftstore.ShiftStore.load(tmpdir).get_run_shift(run) == 0.1)
+        # Re-calibrating a band updates the csv file only
+        for filename in [shiftstore.RUNS_FILENAME, shiftstore.FIELDS_FILENAME]:
+            os.utime(os.path.join(tmpdir, filename), (1e9, 1e9))
+        write_csv(0.2)
+        store = shiftstore.ShiftStore.load(tmpdir)
+        assert(store.get_run_shift(run) == 0.2)
+        assert(store.get_field_shifts(constants.IPHASQC['id'][0])['r'] == 0.2)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_read_calibrated():
+    """Magnitudes and colours should be shifted on read, like in stilts."""
+    fields = np.array([(b'0001_aug2003', 0.1, 0.2, -0.1)],
+                      dtype=[('field', 'S20'), ('r', 'f8'),
+                             ('i', 'f8'), ('ha', 'f8')])
+    store = shiftstore.ShiftStore(np.zeros(0, dtype=[('run', 'i4')]), fields)
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, '0001_aug2003.fits')
+    columns = [fits.Column(name='r', format='E', array=[15.0, 18.0]),
+               fits.Column(name='rAperMag1', format='E', array=[15.1, 18.1]),
+               fits.Column(name='i', format='E', array=[14.0, 16.5]),
+               fits.Column(name='ha', format='E', array=[14.5, 17.0]),
+               fits.Column(name='rmi', format='E', array=[1.0, 1.5]),
+               fits.Column(name='rmha', format='E', array=[0.5, 1.0]),
+               fits.Column(name='errBits', format='J', array=[0, 2])]
+    fits.BinTableHDU.from_columns(columns).writeto(path)
+    try:
+        d = shiftstore.read_calibrated(path, store=store)
+        assert(np.allclose(d['r'], [15.1, 18.1]))
+        assert(np.allclose(d['rAperMag1'], [15.2, 18.2]))
+        assert(np.allclose(d['rmi'], d['r'] - d['i']))
+        assert(np.allclose(d['rmha'], d['r'] - d['ha']))
+        assert(list(d['errBits']) == [0, 2])
+        d = shiftstore.read_calibrated(path, ['rmi'],
+                                       shifts={'r': 0.0, 'i': 0.5, 'ha': 0.0})
+        assert(d.colnames == ['rmi'])
+        assert(np.allclose(d['rmi'], [0.5, 1.0]))
+    finally:
+        shutil.rmtree(tmpdir)
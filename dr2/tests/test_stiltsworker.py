@@ -0,0 +1,51 @@
+import os
+import subprocess
+import tempfile
+from .. import stiltsworker
+
+
+def test_arguments():
+    """Stilts commands should be split into parameters like the shell does."""
+    worker = stiltsworker.StiltsWorker(stilts='java -jar stilts.jar')
+    cmd = """java -jar stilts.jar tpipe in=/tmp/in.fits \
+              cmd='setparam fieldID "0001_aug2003";
+                   select "r < 12 & i > 0";' \
+              cmd=@/tmp/ocmd out='/tmp/out.fits'"""
+    task, params = worker.arguments(cmd)
+    assert(task == 'tpipe')
+    assert([key for key, value in params] == ['in', 'cmd', 'cmd', 'out'])
+    assert(params[1][1].startswith('setparam fieldID "0001_aug2003";\n'))
+    assert(params[3][1] == '/tmp/out.fits')
+    # Shell constructs and other programs cannot be sent to the server
+    assert(worker.arguments(cmd + ' > /tmp/log') is None)
+    assert(worker.arguments('gzip /tmp/out.fits') is None)
+    assert(not stiltsworker.has_shell_operators("icmd='a; b' x=\"c & d\""))
+
+
+def test_fallback():
+    """Commands should still run and report their status without a server."""
+    for program, status in [('true', 0), ('false', 256)]:
+        worker = stiltsworker.StiltsWorker(stilts=program)
+        results = worker.execute_many(['{0} tpipe in=x'.format(program)] * 2)
+        assert(not worker.available)
+        assert([result[0] for result in results] == [status, status])
+
+
+def test_lost_server():
+    """A partial output should be removed before re-running a command."""
+    worker = stiltsworker.StiltsWorker(stilts='true', selftest=False)
+    # A running process without a server listening on its port
+    worker.process = subprocess.Popen(['sleep', '60'])
+    worker.port = stiltsworker.free_port()
+    worker.cwd = os.getcwd()
+    handle, path = tempfile.mkstemp(suffix='.fits')
+    os.close(handle)
+    try:
+        status, message = worker.execute('true tpipe in=x out={0}'.format(path))
+        assert(status == 0)
+        assert(not os.path.exists(path))
+        assert(not worker.is_running())
+    finally:
+        worker.stop()
+        if os.path.exists(path):
+            os.remove(path)
@@ -30,3 +30,21 @@ def test_sphere_dist_fast_arrays():
     lat = np.array([0, 0])
     assert((util.sphere_dist_fast(lon1, lat, lon2, lat) == expected).all())
     assert((util.sphere_dist_fast(lon2, lat, lon1, lat) == expected).all())
+
+
+def test_crossmatch_arrays():
+    """Closest candidates within the matching distance should be returned."""
+    arcsec = 1 / 3600.
+    dec = 40.
+    scale = arcsec / np.cos(np.radians(dec))
+    ra1 = np.array([10., 20., 30., 40.])
+    ra2 = np.array([30. + 0.51 * scale, 10. + 0.3 * scale,
+                    10. + 0.1 * scale, 20. + 0.49 * scale])
+    idx1, idx2 = util.crossmatch_arrays(ra1, np.repeat(dec, 4),
+                                        ra2, np.repeat(dec, 4),
+                                        matchdist=0.5)
+    # The third source is just beyond the cutoff, the fourth has no candidate
+    assert(list(idx1) == [0, 1])
+    assert(list(idx2) == [2, 3])
+    idx1, idx2 = util.crossmatch_arrays(ra1, np.repeat(dec, 4), [], [])
+    assert(len(idx1) == 0 and len(idx2) == 0)
@@ -7,6 +7,7 @@ IPHAS/VPHAS data release products.
 """
 from __future__ import division, print_function, unicode_literals
 import numpy as np
+from scipy.spatial import cKDTree
 import socket
 import os
 
@@ -92,6 +93,55 @@ def crossmatch(ra, dec, ra_array, dec_array, matchdist=0.5):
         return None
 
 
+def radec2xyz(ra, dec):
+    """Converts celestial coordinates into cartesian unit vectors.
+
+    Inputs must be in DEGREES.
+    Result is an array of shape (N, 3).
+    """
+    ra_rad = np.radians(np.asarray(ra, dtype=float))
+    dec_rad = np.radians(np.asarray(dec, dtype=float))
+    cosdec = np.cos(dec_rad)
+    return np.column_stack((cosdec * np.cos(ra_rad),
+                            cosdec * np.sin(ra_rad),
+                            np.sin(dec_rad)))
+
+
+def crossmatch_arrays(ra1, dec1, ra2, dec2, matchdist=0.5):
+    """Returns the indices of the closest matches between two position arrays.
+
+    This is the vectorised equivalent of calling `crossmatch` for every
+    position in (ra1, dec1); a k-d tree is used to avoid a linear scan.
+
+    Parameters
+    ----------
+    ra1, dec1 : arrays of floats [degrees]
+        Positions to match.
+
+    ra2, dec2 : arrays of floats [degrees]
+        Candidate positions.
+
+    matchdist : float [arcsec]
+        Maximum matching distance.
+
+    Returns
+    -------
+    idx1, idx2 : arrays of int
+        Index pairs such that (ra1[idx1], dec1[idx1]) is matched to the
+        closest candidate (ra2[idx2], dec2[idx2]). Positions without a
+        candidate within the maximum matching distance are omitted.
+    """
+    if len(ra1) == 0 or len(ra2) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    # Chord length corresponding to the angular matching distance
+    maxchord = 2. * np.sin(np.radians(matchdist / 3600.) / 2.)
+    tree = cKDTree(radec2xyz(ra2, dec2))
+    dist, idx = tree.query(radec2xyz(ra1, dec1), k=1,
+                           distance_upper_bound=maxchord)
+    mask_matched = np.isfinite(dist)
+    return np.where(mask_matched)[0], idx[mask_matched]
+
+
 def get_pid():
     """Returns the hostname and process identifier.
 
@@ -127,3 +177,19 @@ def run2field(run, band):
         return constants.IPHASQC['id'][idx[0]][0]
     else:
         return None
+
+
+def run_index(runs, myruns):
+    """Returns the index of each of `myruns` in the array `runs`.
+
+    Runs which do not appear in `runs` obtain the index -1.
+    """
+    myruns = np.asarray(myruns)
+    if len(runs) == 0 or len(myruns) == 0:
+        return -np.ones(len(myruns), dtype=int)
+    sorter = np.argsort(runs)
+    pos = np.searchsorted(runs, myruns, sorter=sorter)
+    pos[pos >= len(runs)] = 0
+    idx = sorter[pos]
+    idx[np.asarray(runs)[idx] != myruns] = -1
+    return idx
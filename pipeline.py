@@ -98,11 +98,14 @@ bandmerging.bandmerge(cluster)  # produces 'bandmerged/nnnn.fits'
 # so we run it on cluster_highmem defined earlier.
 offsets.compute_offsets(cluster_highmem)  # produces 'offsets-{r|i|ha}.csv'
 
-# Find the set of zeropoint shifts which minimize the offsets obtained above
-calibration.calibrate()  # produces 'calibration/calibration-{r|i|ha}.csv'
+# Find the set of zeropoint shifts which minimize the offsets obtained above;
+# pass diagrams=True to plot the quality control diagrams in the background.
+calibration_plots = calibration.calibrate(clusterview=cluster)  # produces 'calibration/calibration-{r|i|ha}.csv'
 
-# Apply the zeropoint shifts found above to the bandmerged catalogues
-calibration.apply_calibration(cluster) # produces 'bandmerged-calibrated/nnnn.fits'
+# The zeropoint shifts found above are applied to the bandmerged catalogues
+# on read by the seaming step (cf. seaming.CALIBRATE_ON_READ), hence a
+# calibrated copy of the catalogues is no longer required:
+#calibration.apply_calibration(cluster) # produces 'bandmerged-calibrated/nnnn.fits'
 
 # Identify duplicate detections where multiple pointings overlap ('seams');
 seaming.seam(cluster_highmem)  # produces 'seamed/nnnn.fits'
@@ -112,3 +115,7 @@ concatenating.concatenate(cluster_highmem)
 
 # Prepare images for release
 images.prepare_images(cluster)
+
+# Wait for the calibration diagrams to be finished
+if calibration_plots is not None:
+    calibration_plots.join()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks the Glazebrook calibration on synthetic surveys.
+
+A synthetic survey with IPHAS-like geometry is generated for each size:
+fields are laid out on a grid in a 10 degree-wide strip of the Galactic
+plane, each accompanied by an offset partner field ("field pair"),
+such that every run overlaps with about ten others. Each run is given
+a random zeropoint error, except for a random subset of anchors, and the
+overlap offsets are simulated with noise.
+
+The script times `Calibration.get_overlaps`, `Glazebrook._A`, `Glazebrook._b`
+and `Glazebrook.solve` separately, checks the recovered shifts against the
+injected zeropoint errors, and appends the results to a csv file such that
+performance regressions can be tracked over time.
+
+With --uncertainties, the script instead measures how far the 'stochastic'
+uncertainties of the shifts deviate from the 'exact' ones
+(cf. `calibration.inverse_diagonal`).
+
+Usage
+-----
+    python benchmark_glazebrook.py --sizes 1000 10000 100000 --method lsqr cg
+    python benchmark_glazebrook.py --sizes 1000 10000 --uncertainties
+"""
+from __future__ import division, print_function
+import argparse
+import datetime
+import os
+import subprocess
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+from astropy.table import Table
+from astropy import log
+
+from dr2 import calibration
+
+# Field pairs are offset by 5 arcmin in l and b
+PAIR_OFFSET = 5. / 60
+# Distance between the centres of adjacent fields (degrees)
+FIELD_SPACING = 0.55
+# Fields closer than this distance overlap (degrees)
+OVERLAP_DISTANCE = 0.7
+# Latitude range of the survey
+B_RANGE = (-5., 5.)
+
+COLUMNS = ['date', 'revision', 'n_runs', 'n_overlaps', 'anchor_fraction',
+           'zp_sigma', 'noise', 'method', 't_overlaps', 't_A', 't_b',
+           't_solve', 'iterations', 'rms_error', 'max_error']
+
+
+class SyntheticCalibration(calibration.Calibration):
+    """Calibration object for a synthetic survey (bypasses IPHASQC)."""
+
+    def __init__(self, runs, offsetdata, anchors):
+        self.band = 'r'
+        self.runs = runs
+        self.shifts = np.zeros(len(runs))
+        self.errors = None
+        self.offsetdata = offsetdata
+        self.anchors = anchors
+
+
+def synthetic_survey(n_runs, anchor_fraction=0.2, zp_sigma=0.05, noise=0.02,
+                     seed=0):
+    """Returns a synthetic Calibration object and the injected zeropoints.
+
+    Parameters
+    ----------
+    n_runs : int
+        Number of runs (i.e. fields) in the band.
+
+    anchor_fraction : float
+        Fraction of runs which are anchors (zeropoint error of zero).
+
+    zp_sigma : float
+        Standard deviation of the zeropoint errors of the other runs.
+
+    noise : float
+        Standard deviation of the offset between two runs measured using
+        a single star; the noise of an offset is noise / sqrt(n_stars).
+
+    Returns
+    -------
+    cal, zeropoints : `SyntheticCalibration`, array of float
+        The shifts which calibrate the survey are equal to -zeropoints.
+    """
+    rng = np.random.RandomState(seed)
+    # Grid of field pairs
+    n_b = int((B_RANGE[1] - B_RANGE[0]) / FIELD_SPACING)
+    n_pairs = int(np.ceil(n_runs / 2.))
+    idx = np.arange(n_pairs)
+    l = 30 + FIELD_SPACING * (idx // n_b)
+    b = B_RANGE[0] + FIELD_SPACING * (idx % n_b)
+    l = np.concatenate((l, l + PAIR_OFFSET))[:n_runs]
+    b = np.concatenate((b, b + PAIR_OFFSET))[:n_runs]
+    runs = 100000 + np.arange(n_runs)
+
+    anchors = rng.rand(n_runs) < anchor_fraction
+    zeropoints = rng.normal(0, zp_sigma, n_runs)
+    zeropoints[anchors] = 0.
+
+    pairs = cKDTree(np.column_stack((l, b))).query_pairs(OVERLAP_DISTANCE,
+                                                         output_type='ndarray')
+    i, j = pairs[:, 0], pairs[:, 1]
+    n_stars = rng.randint(calibration.MIN_MATCHES, 500, len(pairs))
+    # offset = (run1 - run2), hence it measures zp1 - zp2
+    offsets = (zeropoints[i] - zeropoints[j]
+               + rng.normal(0, 1, len(pairs)) * noise / np.sqrt(n_stars))
+    # Both directions are present in the offsets files
+    offsetdata = Table({'run1': np.concatenate((runs[i], runs[j])),
+                        'run2': np.concatenate((runs[j], runs[i])),
+                        'offset': np.concatenate((offsets, -offsets)),
+                        'n': np.concatenate((n_stars, n_stars))})
+    return SyntheticCalibration(runs, offsetdata, anchors), zeropoints
+
+
+def benchmark(n_runs, method, anchor_fraction=0.2, zp_sigma=0.05,
+              noise=0.02, seed=0):
+    """Runs the benchmark for one survey size and solver.
+
+    Returns
+    -------
+    result : dict
+        Timings (seconds) and accuracy (magnitudes), cf. `COLUMNS`.
+    """
+    cal, zeropoints = synthetic_survey(n_runs, anchor_fraction=anchor_fraction,
+                                       zp_sigma=zp_sigma, noise=noise,
+                                       seed=seed)
+    t_start = time.time()
+    cal.get_overlaps()
+    t_overlaps = time.time() - t_start
+
+    g = calibration.Glazebrook(cal)
+    t_start = time.time()
+    g._A()
+    t_A = time.time() - t_start
+    t_start = time.time()
+    g._b()
+    t_b = time.time() - t_start
+
+    t_start = time.time()
+    shifts = g.solve(method=method)
+    t_solve = time.time() - t_start
+
+    # Runs in components without an anchor cannot be calibrated
+    ok = ~cal.anchors
+    if 'unanchored' in g.info:
+        unanchored = np.in1d(g.info['components'], g.info['unanchored'])
+        ok[g.nonanchors] &= ~unanchored
+    error = (shifts + zeropoints)[ok]
+    return {'n_runs': n_runs,
+            'n_overlaps': len(cal.offsetdata) // 2,
+            'anchor_fraction': anchor_fraction,
+            'zp_sigma': zp_sigma,
+            'noise': noise,
+            'method': method,
+            't_overlaps': t_overlaps,
+            't_A': t_A,
+            't_b': t_b,
+            't_solve': t_solve,
+            'iterations': g.info['iterations'],
+            'rms_error': np.sqrt(np.mean(error**2)),
+            'max_error': np.max(np.abs(error))}
+
+
+def uncertainty_accuracy(n_runs, n_samples=calibration.UNCERTAINTY_SAMPLES,
+                         anchor_fraction=0.2, seed=0):
+    """Compares the 'stochastic' uncertainties of the shifts to the 'exact' ones.
+
+    Returns
+    -------
+    relative_error : array of float
+        |stochastic / exact - 1| for each run with a finite uncertainty;
+        failed stochastic estimates count as a relative error of 1.
+    """
+    cal, zeropoints = synthetic_survey(n_runs, anchor_fraction=anchor_fraction,
+                                       seed=seed)
+    g = calibration.Glazebrook(cal)
+    g.solve(method='direct')
+    exact = g.uncertainties(method='exact')
+    stochastic = g.uncertainties(method='stochastic', n_samples=n_samples)
+    use = np.isfinite(exact) & (exact > 0)
+    relative_error = np.abs(stochastic[use] / exact[use] - 1)
+    return np.where(np.isnan(relative_error), 1.0, relative_error)
+
+
+def git_revision():
+    """Returns the git revision of the code being benchmarked."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(calibration.__file__)
+                                       ).strip().decode()
+    except Exception:
+        return 'unknown'
+
+
+def write_result(filename, result):
+    """Appends a result to the csv file, writing the header if needed."""
+    is_new = not os.path.exists(filename)
+    with open(filename, 'a') as out:
+        if is_new:
+            out.write(','.join(COLUMNS) + '\n')
+        out.write(','.join([str(result[col]) for col in COLUMNS]) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--method', nargs='+', default=[calibration.SOLVER])
+    parser.add_argument('--anchor-fraction', type=float, default=0.2)
+    parser.add_argument('--zp-sigma', type=float, default=0.05)
+    parser.add_argument('--noise', type=float, default=0.02)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark-glazebrook.csv')
+    parser.add_argument('--uncertainties', action='store_true',
+                        help='measure the error of the stochastic uncertainties')
+    parser.add_argument('--samples', type=int,
+                        default=calibration.UNCERTAINTY_SAMPLES,
+                        help='probe vectors of the stochastic uncertainties')
+    args = parser.parse_args()
+
+    log.setLevel('WARNING')
+    if args.uncertainties:
+        print('{0:>8s} {1:>7s} {2:>7s} {3:>7s} {4:>7s}'.format(
+                        'runs', 'samples', 'median', 'p90', 'max'))
+        for n_runs in args.sizes:
+            error = uncertainty_accuracy(n_runs, n_samples=args.samples,
+                                         anchor_fraction=args.anchor_fraction,
+                                         seed=args.seed)
+            print('{0:>8d} {1:>7d} {2:>7.3f} {3:>7.3f} {4:>7.3f}'.format(
+                        n_runs, args.samples, np.median(error),
+                        np.percentile(error, 90), np.max(error)))
+        raise SystemExit(0)
+    date = datetime.datetime.now().isoformat()[0:19]
+    revision = git_revision()
+    print('{0:>8s} {1:>7s} {2:>10s} {3:>7s} {4:>7s} {5:>7s} {6:>7s} '
+          '{7:>6s} {8:>9s} {9:>9s}'.format('runs', 'method', 'overlaps',
+                                           'get_ov', '_A', '_b', 'solve',
+                                           'iter', 'rms', 'max'))
+    for n_runs in args.sizes:
+        for method in args.method:
+            result = benchmark(n_runs, method,
+                               anchor_fraction=args.anchor_fraction,
+                               zp_sigma=args.zp_sigma,
+                               noise=args.noise,
+                               seed=args.seed)
+            result['date'] = date
+            result['revision'] = revision
+            write_result(args.output, result)
+            print('{n_runs:>8d} {method:>7s} {n_overlaps:>10d} '
+                  '{t_overlaps:>7.2f} {t_A:>7.2f} {t_b:>7.2f} {t_solve:>7.2f} '
+                  '{iterations:>6d} {rms_error:>9.5f} {max_error:>9.5f}'.format(
+                                                                    **result))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Creates the stilts band-merging fixture used by the unit tests.
+
+For each sample field, the detections within a small radius of the field
+centre are copied from the 'detected' catalogues into
+dr2/tests/data/bandmerge/{fieldid}, and are band-merged there using
+`stilts tmatchn` and `stilts-band-merging.cmd`.
+`test_bandmerging.test_stilts_fixture` then checks every column of the
+numpy band-merger (cf. `dr2.derivedcolumns`) against the stilts output.
+
+The fixture requires a working stilts installation (`constants.STILTS`)
+and the detection catalogues of the survey, and must be re-created
+whenever `stilts-band-merging.cmd` changes. Fields in crowded and sparse
+regions, and of different quality grades, make the best samples.
+
+Usage
+-----
+    python make_bandmerge_fixture.py 0001_aug2003 4030_aug2003 --radius 60
+"""
+from __future__ import division, print_function
+import argparse
+import json
+import os
+import numpy as np
+from astropy.io import fits
+from astropy import log
+
+from dr2 import constants
+from dr2 import bandmerging
+
+OUTPUTDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'dr2', 'tests', 'data', 'bandmerge')
+
+
+class FixtureBandMerge(bandmerging.BandMerge):
+    """Band-merges the detections stored in the fixture directory."""
+
+    def __init__(self, directory, *args):
+        bandmerging.BandMerge.__init__(self, *args)
+        self.directory = directory
+        self.output = os.path.join(directory, 'stilts.fits')
+
+    def get_catalogue_path(self, run):
+        return os.path.join(self.directory, '{0}_det.fits'.format(run))
+
+
+def write_detections(path_in, path_out, ra, dec, radius):
+    """Copies the detections within `radius` arcsec of ra/dec."""
+    with fits.open(path_in) as hdulist:
+        data = hdulist[1].data
+        distance = 3600 * np.degrees(np.arccos(np.clip(
+                        np.sin(np.radians(dec)) * np.sin(np.radians(data['dec']))
+                        + np.cos(np.radians(dec)) * np.cos(np.radians(data['dec']))
+                        * np.cos(np.radians(data['ra'] - ra)), -1, 1)))
+        hdu = fits.BinTableHDU(data[distance < radius], hdulist[1].header)
+        hdu.writeto(path_out, overwrite=True)
+    log.info('{0}: {1} detections'.format(path_out, (distance < radius).sum()))
+
+
+def make_fixture(fieldid, radius, ra=None, dec=None, directory=None):
+    """Writes the input catalogues and the stilts output of a sample field."""
+    if directory is None:
+        directory = os.path.join(OUTPUTDIR, fieldid)
+    idx = np.where(constants.IPHASQC.field('id') == fieldid)[0][0]
+    runs = dict((band, int(constants.IPHASQC.field('run_' + band)[idx]))
+                for band in constants.BANDS)
+    if ra is None or dec is None:
+        ra = constants.IPHASQC.field('ra')[idx]
+        dec = constants.IPHASQC.field('dec')[idx]
+    config = {'fieldid': fieldid,
+              'fieldgrade': constants.IPHASQC.field('qflag')[idx].strip(),
+              'run_r': runs['r'], 'run_i': runs['i'], 'run_ha': runs['ha']}
+    args = (config['fieldid'], config['fieldgrade'],
+            runs['ha'], runs['r'], runs['i'])
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    survey = bandmerging.BandMerge(*args)
+    bm = FixtureBandMerge(directory, *args)
+    for band in constants.BANDS:
+        write_detections(survey.get_catalogue_path(runs[band]),
+                         bm.get_catalogue_path(runs[band]), ra, dec, radius)
+    status = bm.run('stilts')
+    if status != 0:
+        raise RuntimeError('stilts returned {0}'.format(status))
+    with open(os.path.join(directory, 'fixture.json'), 'w') as fh:
+        json.dump(config, fh, indent=1, sort_keys=True)
+    log.info('Wrote {0}'.format(bm.output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('fieldid', nargs='+', help='e.g. 0001_aug2003')
+    parser.add_argument('--radius', type=float, default=60.,
+                        help='radius around the field centre (arcsec)')
+    args = parser.parse_args()
+    for fieldid in args.fieldid:
+        make_fixture(fieldid, args.radius)